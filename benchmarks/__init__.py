@@ -0,0 +1,2 @@
+""" Benchmarks for Xenons hot paths. Each benchmark is run as a module from the programs base directory, for example `python -m benchmarks.bench_databases`. Benchmarks run inside a temporary
+workspace so they never touch the real `/instance` directory. """
@@ -0,0 +1,73 @@
+""" Measures how start up scales with the number of installed apps. For each count, the apps are indexed from scratch, then the index is brought up to date with no app changed, as on every later
+start up, & the full `create_app()` is timed. Finally, the first request to one app, which imports & loads it, & a request to the loaded app are timed.
+
+Run with `python -m benchmarks.bench_apps [--counts 10 100 1000]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, Timer
+
+# Import standard packages
+import argparse
+import json
+import os
+import shutil
+
+# Variables
+APP_SOURCE = """from flask import Blueprint
+
+blueprint = Blueprint('{app_id}', __name__)
+
+@blueprint.route('/')
+def index():
+    return '{app_id}'
+"""
+
+def install_apps(count: int) -> None:
+    """ Replaces the installed apps with `count` minimal apps. """
+
+    shutil.rmtree('apps', ignore_errors=True)
+    for index in range(count):
+        app_id = f'app_{index}'
+        os.makedirs(os.path.join('apps', app_id))
+        with open(os.path.join('apps', app_id, 'app.json'), 'w') as file:
+            json.dump({'name': f'App {index}', 'version': '1.0.0', 'description': 'A benchmark app. ' * 8}, file)
+        with open(os.path.join('apps', app_id, '__init__.py'), 'w') as file:
+            file.write(APP_SOURCE.format(app_id=app_id))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000])
+    arguments = parser.parse_args()
+
+    enter_workspace()
+
+    from source.apps import AppRegistry
+    from source.paths import Paths
+    from source.server import create_app
+
+    # Builds the assets once, so the create_app timings only differ by the apps.
+    create_app()
+
+    print(f'{"apps":>6} {"cold index":>12} {"warm index":>12} {"create_app":>12} {"first request":>14} {"loaded request":>15}')
+    for count in arguments.counts:
+        install_apps(count)
+        if os.path.exists(Paths.APPS_INDEX_ABS_PATH):
+            os.remove(Paths.APPS_INDEX_ABS_PATH)
+
+        with Timer() as cold:
+            AppRegistry().refresh()
+        with Timer() as warm:
+            AppRegistry().refresh()
+        with Timer() as startup:
+            app = create_app()
+
+        client = app.test_client()
+        with Timer() as first:
+            client.get('/apps/app_0/').close()
+        with Timer() as loaded:
+            client.get('/apps/app_0/').close()
+
+        print(f'{count:>6} {cold.elapsed * 1000:>9.2f} ms {warm.elapsed * 1000:>9.2f} ms {startup.elapsed * 1000:>9.2f} ms {first.elapsed * 1000:>11.2f} ms {loaded.elapsed * 1000:>12.2f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+""" Measures the bandwidth & modelled time to first paint of a dashboard page before & after the asset pipeline. Before, the page links its assets through flasks static route, which sends them
+uncompressed & has browsers revalidate them on every visit. After, the page links the fingerprinted assets from `source.assets`, which are sent compressed & cached as `immutable`.
+
+Both a first & a repeat visit are simulated through the flask test client, following the browser caching rules. The time to first paint is modelled for a given link as the page round trip plus one
+round trip for the assets, which browsers fetch in parallel, plus the transfer time of every byte.
+
+Run with `python -m benchmarks.bench_assets [--rtt-ms MS] [--mbps MBPS]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace
+
+# Import standard packages
+import argparse
+import os
+import random
+import re
+
+# Variables
+ASSETS = ('css/dashboard.css', 'js/vendor.js', 'js/dashboard.js', 'images/logo.svg', 'images/background.png')
+
+TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <title>Dashboard</title>
+    {%- for path in stylesheets %}
+    <link rel="stylesheet" href="{{ link(path) }}">
+    {%- endfor %}
+</head>
+<body>
+    {%- for path in images %}
+    <img src="{{ link(path) }}">
+    {%- endfor %}
+    {%- for path in scripts %}
+    <script src="{{ link(path) }}"></script>
+    {%- endfor %}
+</body>
+</html>
+"""
+
+def write_assets() -> None:
+    """ Writes assets resembling a real dashboard: stylesheets & scripts which compress well, & an image which does not. """
+
+    generator = random.Random(0)
+    words = ['panel', 'widget', 'header', 'active', 'hidden', 'grid', 'row', 'column', 'button', 'status', 'value', 'chart', 'label', 'icon']
+
+    def write(path: str, content: str | bytes) -> None:
+        os.makedirs(os.path.dirname(os.path.join('static', path)), exist_ok=True)
+        with open(os.path.join('static', path), 'wb') as file:
+            file.write(content.encode() if isinstance(content, str) else content)
+
+    write('css/dashboard.css', ''.join(f'.{generator.choice(words)}-{index} {{ margin: {index % 16}px; color: #{generator.randrange(16 ** 6):06x}; display: flex; }}\n' for index in range(1500)))
+    write('js/vendor.js', ''.join(f'function {generator.choice(words)}{index}(a, b) {{ return a.{generator.choice(words)} + b * {index}; }}\n' for index in range(4000)))
+    write('js/dashboard.js', ''.join(f'document.querySelector(".{generator.choice(words)}").addEventListener("click", () => update({index}));\n' for index in range(1200)))
+    write('images/logo.svg', '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100">' + ''.join(f'<circle cx="{generator.randrange(100)}" cy="{generator.randrange(100)}" r="3"/>' for _ in range(200)) + '</svg>')
+    write('images/background.png', generator.randbytes(60000))
+
+def response_bytes(response: object) -> int:
+    # Counts the status line, the headers & the body, as sent on the wire.
+    return len(f'HTTP/1.1 {response.status}\r\n') + sum(len(f'{key}: {value}\r\n') for key, value in response.headers.items()) + 2 + len(response.get_data())
+
+def visit(client: object, page: str, cache: dict, headers: dict) -> tuple:
+    """ Loads a page & its assets like a browser with the given cache. Returns the bytes received for the page, the bytes received for the assets & the number of asset requests. """
+
+    page_response = client.get(page, headers=headers)
+    asset_bytes = requests = 0
+    for url in re.findall(r'(?:href|src)="([^"]+)"', page_response.get_data(as_text=True)):
+        cached = cache.get(url)
+
+        # Fresh immutable responses are used without a request. Anything else is revalidated if it has a validator.
+        if cached is not None and 'immutable' in cached.headers.get('Cache-Control', ''):
+            continue
+
+        request_headers = dict(headers)
+        if cached is not None and cached.headers.get('ETag'):
+            request_headers['If-None-Match'] = cached.headers['ETag']
+
+        response = client.get(url, headers=request_headers)
+        asset_bytes += response_bytes(response)
+        requests += 1
+        if response.status_code == 200:
+            cache[url] = response
+
+    return response_bytes(page_response), asset_bytes, requests
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rtt-ms', type=float, default=50.0)
+    parser.add_argument('--mbps', type=float, default=10.0)
+    arguments = parser.parse_args()
+
+    enter_workspace()
+    write_assets()
+    os.makedirs('templates')
+    with open(os.path.join('templates', 'dashboard.html'), 'w') as file:
+        file.write(TEMPLATE)
+
+    from flask import render_template, url_for
+    from source.assets import asset_url
+    from source.server import create_app
+
+    app = create_app()
+    context = {
+        'stylesheets': [path for path in ASSETS if path.endswith('.css')],
+        'scripts': [path for path in ASSETS if path.endswith('.js')],
+        'images': [path for path in ASSETS if path.startswith('images/')]
+    }
+
+    @app.route('/before')
+    def before():
+        return render_template('dashboard.html', link=lambda path: url_for('static', filename=path), **context)
+
+    @app.route('/after')
+    def after():
+        return render_template('dashboard.html', link=asset_url, **context)
+
+    client = app.test_client()
+    headers = {'Accept-Encoding': 'br, gzip'}
+    bytes_per_second = arguments.mbps * 1e6 / 8
+
+    print(f'Modelled link: {arguments.rtt_ms:.0f} ms round trip, {arguments.mbps:g} Mbit/s')
+    for name in ('before', 'after'):
+        cache = {}
+        for visit_name in ('first', 'repeat'):
+            page_bytes, asset_bytes, requests = visit(client, f'/{name}', cache, headers)
+            first_paint = arguments.rtt_ms / 1000 * (1 + (1 if requests else 0)) + (page_bytes + asset_bytes) / bytes_per_second
+            print(f'{name:<7} {visit_name:<7} {page_bytes + asset_bytes:>10,} bytes   {requests} asset requests   first paint {first_paint * 1000:7.1f} ms')
+
+if __name__ == '__main__':
+    main()
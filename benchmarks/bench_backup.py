@@ -0,0 +1,112 @@
+""" Measures online backups of the instance directory & their effect on concurrent database work. The system database is filled to the given size, then client threads run a mix of reads &
+writes through the `DatabasesManager`, as request threads would, while their latency is recorded. The latency is measured on its own, during a full snapshot, & during an incremental snapshot after
+some rows changed, for a stepped copy & for a copy made in a single step. Finally, the time to restore a snapshot is measured.
+
+Run with `python -m benchmarks.bench_backup [--megabytes 128] [--clients 4] [--baseline 3]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, Timer
+
+# Import standard packages
+import argparse
+import random
+import shutil
+import statistics
+import threading
+import time
+
+def measure(databases_manager: object, clients: int, stop: threading.Event, rows: int) -> list:
+    """ Runs the client threads until `stop` is set & returns the latency of every operation in seconds. One in ten operations is a write. """
+
+    from sqlalchemy import select
+    from source.databases import ProfileTypes
+
+    latencies = []
+
+    def client() -> None:
+        generator = random.Random()
+        while not stop.is_set():
+            row_id = generator.randint(1, rows)
+            started = time.perf_counter()
+            if generator.random() < 0.1:
+                databases_manager.update_rows(ProfileTypes, [{'id': row_id, 'description': f'Updated {generator.random()} ' * 20}])
+            else:
+                databases_manager.session.execute(select(ProfileTypes).where(ProfileTypes.id == row_id)).first()
+                databases_manager.session.rollback()
+            latencies.append(time.perf_counter() - started)
+        databases_manager.remove_sessions()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def run(databases_manager: object, clients: int, rows: int, action: object, seconds: float = None) -> tuple:
+    """ Runs the clients while `action` runs, or for `seconds`, & returns the result of the action & the median & 99th percentile latencies. """
+
+    stop = threading.Event()
+    result = []
+    measured = []
+    measuring = threading.Thread(target=lambda: measured.extend(measure(databases_manager, clients, stop, rows)))
+    measuring.start()
+    with Timer() as timer:
+        if action is None:
+            time.sleep(seconds)
+        else:
+            result.append(action())
+    stop.set()
+    measuring.join()
+
+    measured.sort()
+    return (result[0] if result else None), timer.elapsed, statistics.median(measured), measured[int(len(measured) * 0.99)], len(measured) / timer.elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--megabytes', type=int, default=128)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--baseline', type=float, default=3.0)
+    arguments = parser.parse_args()
+
+    path = enter_workspace()
+
+    from source.databases import ProfileTypes
+    from source.server import create_app
+
+    app = create_app()
+    services = app.extensions['xenon']
+    databases_manager = services.databases_manager
+    backup_manager = services.backup_manager
+
+    # Fills the database with compressible rows of about 1 KiB.
+    rows = arguments.megabytes * 1024
+    for start in range(0, rows, 10000):
+        databases_manager.add_rows(ProfileTypes, [{'name': f'type-{index}', 'description': f'Profile type {index} ' * 64} for index in range(start, min(rows, start + 10000))])
+
+    print(f'{arguments.megabytes} MiB database, {arguments.clients} clients')
+    print(f'{"phase":<28} {"duration":>10} {"stored":>10} {"ops/s":>8} {"p50":>9} {"p99":>9}')
+
+    def report(phase: str, snapshot: dict, elapsed: float, p50: float, p99: float, throughput: float) -> None:
+        stored = f'{snapshot["stored_bytes"] / 2 ** 20:.1f} MiB' if snapshot else ''
+        print(f'{phase:<28} {elapsed:>8.2f} s {stored:>10} {throughput:>8,.0f} {p50 * 1000:>6.2f} ms {p99 * 1000:>6.2f} ms')
+
+    report('no backup', None, *run(databases_manager, arguments.clients, rows, None, arguments.baseline)[1:])
+
+    # Compares a stepped copy with a copy made in one step, each taking a full snapshot into an empty backups directory & then an incremental one.
+    for label, pages_per_step, step_sleep in (('stepped', 1024, 0.005), ('single step', 2 ** 30, 0.0)):
+        services.settings_manager.update('BACKUP', {'pages_per_step': pages_per_step, 'step_sleep': step_sleep, 'retention': 100})
+        shutil.rmtree(backup_manager.path, ignore_errors=True)
+
+        snapshot, *measured = run(databases_manager, arguments.clients, rows, backup_manager.create_snapshot)
+        report(f'{label}, first snapshot', snapshot, *measured)
+        snapshot, *measured = run(databases_manager, arguments.clients, rows, backup_manager.create_snapshot)
+        report(f'{label}, incremental', snapshot, *measured)
+
+    # Restores the latest snapshot into another directory.
+    with Timer() as timer:
+        backup_manager.restore(snapshot['id'], f'{path}/restored')
+    print(f'{"restore":<28} {timer.elapsed:>8.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+""" Compares the rows per second of the per-row `DatabasesManager.add_row()`/`delete_row()` path with the bulk & unit of work paths.
+
+Run with `python -m benchmarks.bench_databases [rows]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, rate, Timer
+
+# Import standard packages
+import sys
+
+def main(rows: int) -> None:
+    enter_workspace()
+
+    from source.config import SettingsManager
+    from source.databases import DatabasesManager, ProfileTypes
+
+    databases_manager = DatabasesManager(SettingsManager())
+
+    def make_rows(prefix: str) -> list[dict]:
+        return [{'name': f'{prefix}-{index}', 'description': 'Benchmark profile type.'} for index in range(rows)]
+
+    # Per-row inserts, each its own transaction.
+    with Timer() as timer:
+        for row in make_rows('row'):
+            databases_manager.add_row(ProfileTypes(**row))
+    print(f'add_row        {rate(rows, timer.elapsed):>12}')
+
+    # Bulk insert with one executemany.
+    with Timer() as timer:
+        databases_manager.add_rows(ProfileTypes, make_rows('bulk'))
+    print(f'add_rows       {rate(rows, timer.elapsed):>12}')
+
+    # Unit of work, one transaction.
+    with Timer() as timer:
+        with databases_manager.unit_of_work() as unit:
+            for row in make_rows('unit'):
+                unit.add(ProfileTypes(**row))
+    print(f'unit_of_work   {rate(rows, timer.elapsed):>12}')
+
+    # Bulk upsert over the rows which already exist.
+    existing = databases_manager.session.query(ProfileTypes.id, ProfileTypes.name).all()
+    with Timer() as timer:
+        databases_manager.upsert_rows(ProfileTypes, [{'id': id_, 'name': name, 'description': 'Updated.'} for id_, name in existing])
+    print(f'upsert_rows    {rate(len(existing), timer.elapsed):>12}')
+
+    # Per-row deletes against a bulk delete.
+    ids = [id_ for id_, name in existing if name.startswith('row-')]
+    with Timer() as timer:
+        for id_ in ids:
+            databases_manager.delete_row(databases_manager.session.get(ProfileTypes, id_))
+    print(f'delete_row     {rate(len(ids), timer.elapsed):>12}')
+
+    ids = [id_ for id_, name in existing if not name.startswith('row-')]
+    with Timer() as timer:
+        databases_manager.delete_rows(ProfileTypes, ids)
+    print(f'delete_rows    {rate(len(ids), timer.elapsed):>12}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,56 @@
+""" Compares `source.directories.DirectoryOperations` with the serial `shutil` equivalents on a tree of thousands of small files, as found in app packages.
+
+Run with `python -m benchmarks.bench_directories [files]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, Timer
+
+# Import standard packages
+import os
+import shutil
+import sys
+
+def make_tree(path: str, files: int) -> None:
+    # Spreads the files over directories of 50 files, two levels deep, like a package of static assets & modules.
+    for index in range(files):
+        directory = os.path.join(path, f'module-{index // 500}', f'package-{index // 50}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'file-{index}.py'), 'w') as f:
+            f.write('# A small source file.\n' * 20)
+
+def main(files: int) -> None:
+    workspace = enter_workspace()
+
+    from source.directories import DirectoryOperations
+
+    operations = DirectoryOperations()
+    source = os.path.join(workspace, 'source')
+    make_tree(source, files)
+
+    def compare(name: str, serial: callable, parallel: callable) -> None:
+        with Timer() as serial_timer:
+            serial()
+        with Timer() as parallel_timer:
+            parallel()
+        print(f'{name:<10} shutil {serial_timer.elapsed * 1000:9.1f} ms   engine {parallel_timer.elapsed * 1000:9.1f} ms   ({operations.workers} threads)')
+
+    print(f'{files} files')
+    compare('copy', lambda: shutil.copytree(source, 'copy-a'), lambda: operations.copy_tree(source, 'copy-b'))
+    compare('delete', lambda: shutil.rmtree('copy-a'), lambda: operations.delete_tree('copy-b'))
+
+    # Replacing an installed package: copying over the old one & deleting it against a staged copy & swap.
+    operations.copy_tree(source, 'installed-a')
+    operations.copy_tree(source, 'installed-b')
+
+    def shutil_replace() -> None:
+        shutil.rmtree('installed-a')
+        shutil.copytree(source, 'installed-a')
+
+    compare('replace', shutil_replace, lambda: operations.replace_directory(source, 'installed-b'))
+
+    with Timer() as timer:
+        report = operations.delete_tree('installed-b', dry_run=True)
+    print(f'dry run    {timer.elapsed * 1000:9.1f} ms   {report}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,93 @@
+""" Measures the ingest throughput of `source.eventlog.EventLog` & the latency of time range queries over it. Also checks that a batch larger than a segment is appended whole, & measures how long
+appends wait while small segments are compacted.
+
+Run with `python -m benchmarks.bench_eventlog [records]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, rate, Timer
+
+# Import standard packages
+import random
+import statistics
+import sys
+import threading
+import time
+
+def main(records: int) -> None:
+    enter_workspace()
+
+    from source.eventlog import EventLog
+
+    log = EventLog('bench', segment_bytes=8 * 1024 * 1024)
+    readings = [{'sensor': f'sensor-{index % 64}', 'celsius': round(random.uniform(15, 25), 2)} for index in range(1000)]
+
+    # Records spread one millisecond apart, starting at a fixed time.
+    base_timestamp = 1_700_000_000 * 10 ** 9
+    step = 10 ** 6
+
+    # Appends one record per call.
+    single = records // 10
+    with Timer() as timer:
+        for index in range(single):
+            log.append(readings[index % len(readings)], base_timestamp + index * step)
+    print(f'append           {rate(single, timer.elapsed):>14}')
+
+    # Appends batches of 1000 records, as a sensor gateway would.
+    with Timer() as timer:
+        for index in range(single, records, 1000):
+            log.append_many(readings[:min(1000, records - index)], base_timestamp + index * step)
+    print(f'append_many      {rate(records - single, timer.elapsed):>14}')
+
+    with Timer() as timer:
+        log.flush()
+    print(f'flush            {timer.elapsed * 1000:>11.1f} ms')
+
+    # Queries one second windows at random positions.
+    latencies = []
+    for _ in range(200):
+        start = base_timestamp + random.randrange(records) * step
+        with Timer() as timer:
+            count = sum(1 for _ in log.range(start, start + 10 ** 9))
+        latencies.append(timer.elapsed)
+    print(f'range (1 s, ~{count} records)  median {statistics.median(latencies) * 1000:.2f} ms   max {max(latencies) * 1000:.2f} ms')
+
+    # Reads the whole log.
+    with Timer() as timer:
+        total = sum(1 for _ in log)
+    print(f'full scan        {rate(total, timer.elapsed):>14}')
+
+    log.close()
+
+    # Appends a batch which spans many segments. Every record shares the batches timestamp, so the segments all start at the same timestamp.
+    batch_log = EventLog('batch', segment_bytes=4096)
+    with Timer() as timer:
+        batch_log.append_many(readings, base_timestamp)
+    stored = sum(1 for _ in batch_log)
+    assert stored == len(readings), f'{stored} of {len(readings)} records were stored.'
+    print(f'oversized batch  {rate(len(readings), timer.elapsed):>14}   ({len(batch_log._segments)} segments)')
+    batch_log.close()
+
+    # Fills many small segments, then appends from another thread while they are compacted, recording how long each append takes.
+    compact_log = EventLog('compact', segment_bytes=64 * 1024 * 1024, segment_seconds=0.001, maintenance_interval=3600)
+    for index in range(2000):
+        compact_log.append_many(readings[:100], base_timestamp + index * 10 ** 7)
+    compact_log.segment_nanoseconds = 3600 * 10 ** 9
+    latencies, done = [], threading.Event()
+
+    def appender() -> None:
+        while not done.is_set():
+            started = time.perf_counter()
+            compact_log.append(readings[0])
+            latencies.append(time.perf_counter() - started)
+
+    thread = threading.Thread(target=appender)
+    thread.start()
+    with Timer() as timer:
+        removed = compact_log.compact()
+    done.set()
+    thread.join()
+    print(f'compact          {timer.elapsed * 1000:>11.1f} ms   ({removed} segments merged, append max {max(latencies) * 1000:.2f} ms over {len(latencies):,} appends)')
+    compact_log.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,71 @@
+""" Measures the fan-out throughput & end-to-end latency of the event bus with thousands of subscribers. Each run subscribes the given number of handlers to wildcard patterns matching one sensor
+topic, publishes events to it from another thread, as a flask handler would, & waits until every handler has seen every event. Throughput is measured with every event published in one burst. Latency,
+from the `publish_threadsafe()` call to the handler call, is measured with the events published one at a time, each once every handler has seen the previous one. Runs are repeated with batch
+delivery, where each handler receives lists of up to `--batch-size` events.
+
+Run with `python -m benchmarks.bench_events [--subscribers 100 1000 5000] [--events 200] [--batch-size 64]`. """
+
+# Import internal packages
+from benchmarks.workspace import Timer
+
+# Import standard packages
+import argparse
+import statistics
+import threading
+import time
+
+def run(subscribers: int, events: int, batch_size: int, paced: bool) -> tuple:
+    """ Returns the deliveries per second, & the median & 99th percentile latencies in seconds, of one run. """
+
+    from source.events import EventBus
+
+    bus = EventBus(queue_size=events)
+    latencies = []
+    remaining = [subscribers * events]
+    done = threading.Event()
+    delivered = threading.Event()
+
+    def handler(event_or_batch: object) -> None:
+        now = time.perf_counter()
+        batch = event_or_batch if isinstance(event_or_batch, list) else [event_or_batch]
+        latencies.extend(now - event.payload for event in batch)
+        remaining[0] -= len(batch)
+        if remaining[0] % subscribers == 0:
+            delivered.set()
+        if remaining[0] == 0:
+            done.set()
+
+    # Spreads the subscribers over patterns which all match the published topic.
+    patterns = ('sensors/+/temperature', 'sensors/kitchen/+', 'sensors/#', 'sensors/kitchen/temperature')
+    for index in range(subscribers):
+        bus.subscribe(patterns[index % len(patterns)], handler, batch_size=batch_size, batch_interval=0.001 if batch_size > 1 else 0.0)
+
+    with Timer() as timer:
+        for _ in range(events):
+            delivered.clear()
+            bus.publish_threadsafe('sensors/kitchen/temperature', time.perf_counter(), wait=False)
+            if paced:
+                delivered.wait(10)
+        done.wait(120)
+
+    bus.stop()
+    latencies.sort()
+    return subscribers * events / timer.elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=64)
+    arguments = parser.parse_args()
+
+    print(f'{"delivery":<10} {"subscribers":>11} {"deliveries/s":>14} {"p50 latency":>13} {"p99 latency":>13}')
+    for batch_size in (1, arguments.batch_size):
+        for subscribers in arguments.subscribers:
+            throughput = run(subscribers, arguments.events, batch_size, paced=False)[0]
+            _, p50, p99 = run(subscribers, arguments.events, batch_size, paced=True)
+            delivery = 'single' if batch_size == 1 else f'batch {batch_size}'
+            print(f'{delivery:<10} {subscribers:>11} {throughput:>14,.0f} {p50 * 1000:>10.2f} ms {p99 * 1000:>10.2f} ms')
+
+if __name__ == '__main__':
+    main()
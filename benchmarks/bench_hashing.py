@@ -0,0 +1,60 @@
+""" Measures login latency (p50/p99 of password verification) under concurrent login attempts, hashing inline on the request threads against the `source.hashing` process pool. A request which
+does no hashing is timed alongside the logins, to show how much the logins stall the rest of the server.
+
+Run with `python -m benchmarks.bench_hashing [concurrent_logins] [rounds]`. """
+
+# Import internal packages
+from benchmarks.workspace import Timer
+
+# Import standard packages
+import concurrent.futures
+import os
+import statistics
+import sys
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def other_request() -> float:
+    # A small amount of pure python work, standing in for a request which does no hashing.
+    with Timer() as timer:
+        sum(index * index for index in range(20000))
+    return timer.elapsed
+
+def run(hasher: object, hashed_password: str, concurrency: int, rounds: int) -> None:
+    def login() -> float:
+        with Timer() as timer:
+            assert hasher.verify(hashed_password, 'correct horse battery staple')
+        return timer.elapsed
+
+    logins, others = [], []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency + 1) as threads:
+        for _ in range(rounds):
+            login_futures = [threads.submit(login) for _ in range(concurrency)]
+            other_future = threads.submit(other_request)
+            logins.extend(future.result() for future in login_futures)
+            others.append(other_future.result())
+
+    print(f'  login  p50 {percentile(logins, 0.5) * 1000:8.1f} ms   p99 {percentile(logins, 0.99) * 1000:8.1f} ms')
+    print(f'  other  p50 {percentile(others, 0.5) * 1000:8.1f} ms   p99 {percentile(others, 0.99) * 1000:8.1f} ms   (alone {statistics.median(other_request() for _ in range(20)) * 1000:.1f} ms)')
+
+def main(concurrency: int, rounds: int) -> None:
+    from source.hashing import PasswordHasher
+
+    workers = os.cpu_count() or 2
+    inline = PasswordHasher(workers=0)
+    pooled = PasswordHasher(workers=workers, max_pending=concurrency * 2)
+    hashed_password = inline.hash('correct horse battery staple')
+
+    print(f'inline, {concurrency} concurrent logins')
+    run(inline, hashed_password, concurrency, rounds)
+
+    # Warms the pool up so process start up is not measured.
+    pooled.verify(hashed_password, 'correct horse battery staple')
+    print(f'process pool ({workers} workers), {concurrency} concurrent logins')
+    run(pooled, hashed_password, concurrency, rounds)
+    pooled.shutdown()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
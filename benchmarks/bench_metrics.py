@@ -0,0 +1,52 @@
+""" Measures the overhead of the `source.metrics` instrumentation: the time per request of a route which runs a few SQL statements, with the metrics turned on & off, & the time taken to render the
+metrics.
+
+Run with `python -m benchmarks.bench_metrics [requests]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, Timer
+
+# Import standard packages
+import sys
+
+def main() -> None:
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    enter_workspace()
+
+    from source.metrics import metrics
+    from source.server import create_app
+    from source.databases import Users
+
+    app = create_app()
+    databases_manager = app.extensions['xenon'].databases_manager
+
+    # A route running a few statements, as most real routes do.
+    @app.route('/bench')
+    def bench():
+        for user_id in range(3):
+            databases_manager.session.query(Users).filter_by(id=user_id).first()
+        return 'ok'
+
+    client = app.test_client()
+    for _ in range(200):
+        client.get('/bench')
+
+    # Times the requests with the metrics off, then on.
+    results = {}
+    for enabled in (False, True):
+        metrics.enabled = enabled
+        with Timer() as timer:
+            for _ in range(requests):
+                client.get('/bench')
+        results[enabled] = timer.elapsed / requests
+
+    with Timer() as timer:
+        for _ in range(100):
+            metrics.render()
+
+    print(f'metrics off     {results[False] * 1e6:8.1f} us/request')
+    print(f'metrics on      {results[True] * 1e6:8.1f} us/request   overhead {(results[True] - results[False]) * 1e6:6.1f} us ({(results[True] / results[False] - 1) * 100:.1f}%)')
+    print(f'render          {timer.elapsed / 100 * 1000:8.2f} ms')
+
+if __name__ == '__main__':
+    main()
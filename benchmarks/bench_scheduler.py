@@ -0,0 +1,108 @@
+""" Measures the automation scheduler with a large number of jobs. Schedules the given number of cron & interval jobs due in the future, timing the inserts & cancels & measuring the memory they
+take, then measures the CPU the running scheduler uses while they wait. Lateness is measured by scheduling jobs due within the next few seconds, each recording when it actually ran. Finally, the same
+number of persisted schedules is written to the system database, & the time a newly started scheduler takes to restore them is measured.
+
+Run with `python -m benchmarks.bench_scheduler [--jobs 100000] [--due 1000] [--idle 5]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, rate, Timer
+
+# Import standard packages
+import argparse
+import datetime
+import json
+import os
+import resource
+import statistics
+import time
+import tracemalloc
+
+# Variables
+ran = []
+
+def noop() -> None:
+    """ The function run by the benchmark jobs. """
+
+def record(due: float) -> None:
+    """ Records how late a job ran. """
+
+    ran.append(time.time() - due)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=100000)
+    parser.add_argument('--due', type=int, default=1000)
+    parser.add_argument('--idle', type=float, default=5.0)
+    arguments = parser.parse_args()
+
+    enter_workspace()
+
+    from source.databases import Schedules
+    from source.scheduler import Scheduler, CronTrigger, DateTrigger, IntervalTrigger
+    from source.server import create_app
+
+    app = create_app()
+    databases_manager = app.extensions['xenon'].databases_manager
+
+    # Schedules the jobs, a mix of cron triggers in a few timezones & long intervals, none due during the benchmark.
+    scheduler = Scheduler(timezone='UTC')
+    triggers = [CronTrigger(f'{minute} {hour} * * *', timezone) for minute in range(0, 60, 7) for hour in (3, 9, 15, 21)
+                for timezone in ('Europe/London', 'America/New_York', 'Asia/Tokyo')] + [IntervalTrigger(3600 * hours) for hours in (6, 12, 24)]
+    scheduler.start()
+    with Timer() as insert:
+        jobs = [scheduler.schedule(triggers[index % len(triggers)], noop, job_id=f'job-{index}') for index in range(arguments.jobs)]
+
+    # Measures the memory of each job on a separate scheduler, as tracing slows the inserts down.
+    sample = Scheduler(timezone='UTC')
+    sample_size = min(arguments.jobs, 10000)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(sample_size):
+        sample.schedule(triggers[index % len(triggers)], noop, job_id=f'job-{index}')
+    memory = (tracemalloc.get_traced_memory()[0] - before) / sample_size
+    tracemalloc.stop()
+    sample.stop()
+
+    print(f'{arguments.jobs:,} jobs')
+    print(f'  schedule      {insert.elapsed * 1000:>9.0f} ms  {rate(arguments.jobs, insert.elapsed):>12}  {insert.elapsed / arguments.jobs * 1e6:.1f} us/job')
+    print(f'  memory        {memory * arguments.jobs / 2 ** 20:>9.1f} MB  {memory:>9.0f} B/job  (max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB)')
+
+    # Measures the CPU used by the scheduler thread while every job waits.
+    started = time.process_time()
+    time.sleep(arguments.idle)
+    idle = time.process_time() - started
+    print(f'  idle CPU      {idle / arguments.idle * 100:>9.2f} %    over {arguments.idle:g} s')
+
+    # Measures how late jobs due in the next few seconds run, with every other job still scheduled.
+    now = time.time()
+    dues = [now + 1 + 2 * index / arguments.due for index in range(arguments.due)]
+    for index, due in enumerate(dues):
+        scheduler.schedule(DateTrigger(datetime.datetime.fromtimestamp(due, datetime.timezone.utc)), record, args=(due,), job_id=f'due-{index}')
+    while len(ran) < arguments.due and time.time() < now + 30:
+        time.sleep(0.1)
+    lateness = sorted(ran)
+    print(f'  lateness      p50 {statistics.median(lateness) * 1000:.1f} ms  p99 {lateness[int(len(lateness) * 0.99)] * 1000:.1f} ms  max {lateness[-1] * 1000:.1f} ms  ({len(ran):,} runs, '
+          f'{scheduler.skipped} skipped)')
+
+    with Timer() as cancel:
+        for job in jobs:
+            scheduler.cancel(job.id)
+    print(f'  cancel        {cancel.elapsed * 1000:>9.0f} ms  {rate(arguments.jobs, cancel.elapsed):>12}')
+    scheduler.stop()
+
+    # Writes the persisted schedules directly, as a previous run of the server would have, & measures how long a new scheduler takes to restore them.
+    next_run = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(hours=1)
+    arguments_json = json.dumps({'args': [], 'kwargs': {}})
+    rows = [{'id': f'persisted-{index}', 'trigger': triggers[index % len(triggers)].spec, 'timezone': triggers[index % len(triggers)].timezone_name or '',
+             'target': f'{__name__}:noop', 'arguments': arguments_json, 'owner': None, 'next_run': next_run, 'revision': index + 1, 'cancelled': False} for index in range(arguments.jobs)]
+    with app.app_context():
+        databases_manager.upsert_rows(Schedules, rows)
+
+    restored = Scheduler(timezone='UTC', lock_path=os.path.abspath('scheduler.lock'))
+    restored.app = app
+    with Timer() as restore:
+        restored._sync()
+    print(f'  restore       {restore.elapsed * 1000:>9.0f} ms  {rate(len(restored.jobs), restore.elapsed):>12}  ({len(restored.jobs):,} persisted jobs)')
+
+if __name__ == '__main__':
+    main()
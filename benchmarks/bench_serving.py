@@ -0,0 +1,129 @@
+""" Load tests the server in development & production mode. Each mode runs `main.py` in its own workspace with debug off, & a number of client threads request a url over keep-alive connections
+for a fixed time. Reports requests per second & latency percentiles for each mode.
+
+Run with `python -m benchmarks.bench_serving [url] [--clients N] [--seconds S] [--workers N] [--threads N]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace
+
+# Import standard packages
+import argparse
+import http.client
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+# Variables
+BASE_ABS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 5731
+
+# A minimal template, as `/startup/` renders `index.html`.
+TEMPLATE = '<!DOCTYPE html><html><head><title>Xenon</title></head><body><h1>Xenon</h1></body></html>\n'
+
+def start_server(directory: str, mode: str, arguments: argparse.Namespace) -> subprocess.Popen:
+    """ Starts `main.py` in its own process group & waits until it accepts connections. """
+
+    # Writes the settings & the template.
+    os.makedirs(os.path.join(directory, 'instance'))
+    os.makedirs(os.path.join(directory, 'templates'))
+    with open(os.path.join(directory, 'instance', 'system.ini'), 'w') as file:
+        file.write(f'[SERVER]\nhost = 127.0.0.1\nport = {PORT}\ndebug = false\nmode = {mode}\nworkers = {arguments.workers}\nthreads = {arguments.threads}\n')
+    with open(os.path.join(directory, 'templates', 'index.html'), 'w') as file:
+        file.write(TEMPLATE)
+
+    # Starts the server & waits for the port to open.
+    environment = dict(os.environ, PYTHONPATH=BASE_ABS_PATH)
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_ABS_PATH, 'main.py')], cwd=directory, env=environment, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', PORT), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    stop_server(process)
+    raise RuntimeError(f'The {mode} server did not start.')
+
+def stop_server(process: subprocess.Popen) -> None:
+    """ Stops the server & every process it started. """
+
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+def load(url: str, clients: int, seconds: float) -> tuple:
+    """ Requests the url from a number of client threads for a number of seconds. Returns the number of successful requests, the number of failures & the latencies in seconds. """
+
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client() -> None:
+        connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+        own_latencies = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', url)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 500:
+                    raise http.client.HTTPException(response.status)
+                own_latencies.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    failures[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+        connection.close()
+
+        with lock:
+            latencies.extend(own_latencies)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(latencies), failures[0], latencies
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('url', nargs='?', default='/startup/')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--threads', type=int, default=8)
+    arguments = parser.parse_args()
+
+    workspace = enter_workspace()
+
+    for mode in ('development', 'production'):
+        process = start_server(os.path.join(workspace, mode), mode, arguments)
+        try:
+            # Warms up the server before measuring.
+            load(arguments.url, arguments.clients, 1.0)
+            count, failures, latencies = load(arguments.url, arguments.clients, arguments.seconds)
+        finally:
+            stop_server(process)
+
+        if not latencies:
+            print(f'{mode:<12} no successful requests, {failures} failures')
+            continue
+
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f'{mode:<12} {count / arguments.seconds:10,.0f} req/s   p50 {statistics.median(latencies) * 1000:7.2f} ms   p99 {p99 * 1000:7.2f} ms   {failures} failures')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Measures cold start up time in fresh processes: importing `source.server`, building the app with `create_app()`, & serving the first request (which creates the databases manager). Each
+measurement is the median of several runs & is checked against a budget, so the script exits with status 1 if start up has regressed.
+
+Run with `python -m benchmarks.bench_startup [runs] [--budget-import MS] [--budget-create MS] [--budget-first-request MS]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace
+
+# Import standard packages
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Variables
+BASE_ABS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BUDGETS = {
+    'import': 600.0,
+    'create_app': 150.0,
+    'first_request': 1000.0
+}
+
+# Run in each fresh process. Prints the milliseconds taken by each stage as JSON.
+PROBE = """
+import json, time
+started = time.perf_counter()
+from source.server import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.extensions['xenon'].databases_manager
+app.test_client().get('/startup/')
+served = time.perf_counter()
+print(json.dumps({'import': (imported - started) * 1000, 'create_app': (created - imported) * 1000, 'first_request': (served - created) * 1000}))
+"""
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('runs', type=int, nargs='?', default=7)
+    for stage, budget in DEFAULT_BUDGETS.items():
+        parser.add_argument(f'--budget-{stage.replace("_", "-")}', type=float, default=budget, dest=stage)
+    arguments = parser.parse_args()
+
+    workspace = enter_workspace()
+    environment = dict(os.environ, PYTHONPATH=BASE_ABS_PATH)
+
+    # Runs the probe in fresh processes, each with its own empty instance directory so the first request always creates the database.
+    samples = {stage: [] for stage in DEFAULT_BUDGETS}
+    for run in range(arguments.runs):
+        run_directory = os.path.join(workspace, f'run-{run}')
+        os.mkdir(run_directory)
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=run_directory, env=environment, check=True, capture_output=True, text=True).stdout
+        for stage, milliseconds in json.loads(output.splitlines()[-1]).items():
+            samples[stage].append(milliseconds)
+
+    # Reports each stage against its budget.
+    failed = False
+    for stage, values in samples.items():
+        median = statistics.median(values)
+        budget = getattr(arguments, stage)
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        failed = failed or median > budget
+        print(f'{stage:<14} median {median:8.1f} ms   budget {budget:8.1f} ms   {status}')
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
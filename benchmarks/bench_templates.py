@@ -0,0 +1,168 @@
+""" Measures template rendering & the start up of a cold worker. A dashboard page, whose panel lists the profile types through a few macros, is rendered with `render_template()` with the
+panel uncached after querying its rows, with the panel from the fragment cache, & again after its table changed. Then fresh processes build the app & serve the first request for the dashboard,
+once without the bytecode cache, once filling it & then with it filled, as a newly forked worker would.
+
+Run with `python -m benchmarks.bench_templates [--rows 200] [--renders 2000] [--runs 7]`. """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace, rate, Timer
+
+# Import standard packages
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Variables
+BASE_ABS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAYOUT = """<!DOCTYPE html>
+<html>
+<head><title>{% block title %}Xenon{% endblock %}</title></head>
+<body>
+<nav>{% for section in ('Home', 'Apps', 'Devices', 'Automations', 'Settings') %}<a href="/{{ section | lower }}">{{ section }}</a>{% endfor %}</nav>
+<main>{% block content %}{% endblock %}</main>
+</body>
+</html>
+"""
+
+MACROS = """{% macro badge(count) %}<span class="badge{% if count > 10 %} badge-large{% endif %}">{{ count }}</span>{% endmacro %}
+{% macro card(profile_type) %}
+<article class="card" id="profile-type-{{ profile_type.id }}">
+    <h2>{{ profile_type.name | title }} {{ badge(profile_type.user_count) }}</h2>
+    <p>{{ profile_type.description | truncate(80) }}</p>
+</article>
+{% endmacro %}
+"""
+
+# The page is rendered for each request, with the panel, which is the same for every user of a profile type, cached as a fragment.
+DASHBOARD = """{% extends 'layout.html' %}
+{% block title %}{{ title }}{% endblock %}
+{% block content %}
+<h1>{{ title }}</h1>
+{{ panel }}
+{% endblock %}
+"""
+
+# Many conditions, so compiling the panel takes about as long as it would for a real dashboard.
+PANEL = """{% from 'macros.html' import card %}
+{% for profile_type in profile_types %}{{ card(profile_type) }}{% endfor %}
+""" + ''.join(f"""{{% if profile_types | length > {index} %}}<section id="panel-{index}">{{{{ profile_types[{index}].name | upper }}}} {{{{ '%d' | format({index}) }}}}</section>{{% else %}}<p>Panel {index} is empty.</p>{{% endif %}}
+""" for index in range(300))
+
+# Run in each fresh process. Prints the milliseconds taken to build the app & to serve the first request as JSON.
+PROBE = """
+import json, time
+import dashboard_route
+from source.server import create_app
+started = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.extensions['xenon'].databases_manager
+app.test_client().get('/dashboard/')
+served = time.perf_counter()
+print(json.dumps({'create_app': (created - started) * 1000, 'first_response': (served - created) * 1000}))
+"""
+
+# Imported by the probe before the app is built, so the fresh processes have the benchmarks dashboard route.
+ROUTE = """
+from flask import Blueprint, render_template
+from source.rendering import render_cached
+from source.databases import ProfileTypes
+import routes
+
+dashboard_r = Blueprint('dashboard', __name__, url_prefix='/dashboard')
+
+@dashboard_r.route('/')
+def index():
+    from source.server import get_databases_manager
+    load = lambda: {'profile_types': get_databases_manager().session.query(ProfileTypes).order_by(ProfileTypes.id).all()}
+    return render_template('dashboard.html', title='Dashboard', panel=render_cached('panel.html', tables=(ProfileTypes,), load=load))
+
+routes.base_r.register_blueprint(dashboard_r)
+"""
+
+def write_files(directory: str, bytecode: bool) -> None:
+    """ Writes the templates, the settings & the dashboard route into a directory. """
+
+    os.makedirs(os.path.join(directory, 'templates'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'instance'), exist_ok=True)
+    for name, content in (('layout.html', LAYOUT), ('macros.html', MACROS), ('dashboard.html', DASHBOARD), ('panel.html', PANEL)):
+        with open(os.path.join(directory, 'templates', name), 'w') as file:
+            file.write(content)
+    with open(os.path.join(directory, 'instance', 'system.ini'), 'w') as file:
+        file.write(f'[CACHE]\ntemplate_bytecode = {str(bytecode).lower()}\n')
+    with open(os.path.join(directory, 'dashboard_route.py'), 'w') as file:
+        file.write(ROUTE)
+
+def probe(directory: str, runs: int) -> dict:
+    """ Runs the probe in fresh processes & returns the median milliseconds of each stage. The database is removed before each run, so only the template caches carry over. """
+
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join((directory, BASE_ABS_PATH)))
+    samples = {'create_app': [], 'first_response': []}
+    for _ in range(runs):
+        for name in os.listdir(os.path.join(directory, 'instance')):
+            if name.startswith('xenon.db'):
+                os.remove(os.path.join(directory, 'instance', name))
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=directory, env=environment, check=True, capture_output=True, text=True).stdout
+        for stage, milliseconds in json.loads(output.splitlines()[-1]).items():
+            samples[stage].append(milliseconds)
+
+    return {stage: statistics.median(values) for stage, values in samples.items()}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--renders', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=7)
+    arguments = parser.parse_args()
+
+    workspace = enter_workspace()
+    write_files(workspace, True)
+
+    from flask import render_template
+    from markupsafe import Markup
+    from source.databases import ProfileTypes
+    from source.rendering import fragment_cache, render_cached
+    from source.server import create_app
+
+    app = create_app()
+    databases_manager = app.extensions['xenon'].databases_manager
+    databases_manager.add_rows(ProfileTypes, [{'name': f'type {index}', 'description': f'Profile type number {index}. ' * 8} for index in range(arguments.rows)])
+
+    # Measures the query & render time of the dashboard, with its panel uncached, from the fragment cache & after its table changed, which renders the panel again.
+    print(f'dashboard of {arguments.rows} profile types, {arguments.renders:,} renders')
+    load = lambda: {'profile_types': databases_manager.session.query(ProfileTypes).order_by(ProfileTypes.id).all()}
+    cached_page = lambda: render_template('dashboard.html', title='Dashboard', panel=render_cached('panel.html', tables=(ProfileTypes,), load=load))
+    with app.test_request_context('/dashboard/'):
+        size = len(cached_page())
+
+        with Timer() as uncached:
+            for _ in range(arguments.renders):
+                render_template('dashboard.html', title='Dashboard', panel=Markup(render_template('panel.html', **load())))
+        with Timer() as cached:
+            for _ in range(arguments.renders):
+                cached_page()
+        with Timer() as changed:
+            for _ in range(arguments.renders // 10):
+                fragment_cache.tables_changed(('profile_types',))
+                cached_page()
+
+    print(f'  uncached      {uncached.elapsed / arguments.renders * 1e6:>9.1f} us  {rate(arguments.renders, uncached.elapsed):>10}  ({size / 1024:.0f} KiB)')
+    print(f'  cached        {cached.elapsed / arguments.renders * 1e6:>9.1f} us  {rate(arguments.renders, cached.elapsed):>10}')
+    print(f'  after change  {changed.elapsed / (arguments.renders // 10) * 1e6:>9.1f} us  {rate(arguments.renders // 10, changed.elapsed):>10}')
+
+    # Measures cold workers without the bytecode cache, filling it, & with it filled.
+    print(f'cold worker, median of {arguments.runs} processes')
+    without = os.path.join(workspace, 'without')
+    with_cache = os.path.join(workspace, 'with')
+    write_files(without, False)
+    write_files(with_cache, True)
+    results = {'no bytecode cache': probe(without, arguments.runs), 'filling the cache': probe(with_cache, 1), 'cache filled': probe(with_cache, arguments.runs)}
+    for label, result in results.items():
+        print(f'  {label:<18}  create_app {result["create_app"]:>7.1f} ms  first response {result["first_response"]:>7.1f} ms')
+
+if __name__ == '__main__':
+    main()
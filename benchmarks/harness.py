@@ -0,0 +1,219 @@
+""" A small offline benchmark harness. Benchmarks are registered with the `benchmark` decorator, run a number of times each, & summarized by their median, minimum & 95th percentile time per call. The
+results can be saved as JSON & compared against a stored baseline, in which case the run fails when a benchmark is slower than the baseline by more than its threshold. Example:
+```python
+from benchmarks.harness import benchmark, main
+
+@benchmark('sum', repeat=20, number=1000)
+def sum_benchmark(calls: int) -> callable:
+    values = list(range(1000))
+    return lambda: sum(values)
+
+if __name__ == '__main__':
+    main()
+```
+
+A benchmark function does its set up & returns the callable which is timed. It is given the total number of times the callable will be called, so it can prepare one input per call. If the callable
+returns a number, that number is used as the time of the call in seconds rather than the measured time, for benchmarks which time themselves (for example in a separate process). """
+
+# Import internal packages
+from benchmarks.workspace import enter_workspace
+
+# Import standard packages
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import NamedTuple
+
+# Variables
+BENCHMARKS_ABS_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE_ABS_PATH = os.path.join(BENCHMARKS_ABS_PATH, 'baseline.json')
+
+DEFAULT_REPEAT = 10 # Samples taken of each benchmark.
+DEFAULT_NUMBER = 10 # Calls timed together in each sample.
+DEFAULT_THRESHOLD = 0.25 # Fraction a median may grow by before it counts as a regression.
+
+class Benchmark(NamedTuple):
+    """ A registered benchmark.
+
+    Properties:
+        - name (str) - The unique name of the benchmark, used in the results & the baseline.
+        - setup (callable) - Prepares the benchmark & returns the callable to time. Given the total number of calls.
+        - repeat (int) - The number of samples taken.
+        - number (int) - The number of calls timed together in each sample.
+        - threshold (float) - The fraction the median may grow by, compared to the baseline, before the benchmark fails. """
+
+    name: str
+    setup: object
+    repeat: int
+    number: int
+    threshold: float
+
+# The registered benchmarks, in the order they were registered.
+BENCHMARKS = {}
+
+def benchmark(name: str, repeat: int = DEFAULT_REPEAT, number: int = DEFAULT_NUMBER, threshold: float = DEFAULT_THRESHOLD) -> callable:
+    """ Registers a benchmark function. See the module for details.
+
+    Params:
+        - name (str) - The unique name of the benchmark.
+        - repeat (int) - The number of samples taken.
+        - number (int) - The number of calls timed together in each sample.
+        - threshold (float) - The fraction the median may grow by, compared to the baseline, before the benchmark fails. """
+
+    def register(setup: callable) -> callable:
+        if name in BENCHMARKS:
+            raise ValueError(f'Benchmark \'{name}\' is already registered.')
+        BENCHMARKS[name] = Benchmark(name, setup, repeat, number, threshold)
+        return setup
+
+    return register
+
+def run_benchmark(bench: Benchmark, scale: float = 1.0) -> dict:
+    """ Runs a benchmark & returns its summary, in seconds per call.
+
+    Params:
+        - bench (Benchmark) - The benchmark to run.
+        - scale (float) - Multiplies the number of samples, for quicker or more stable runs. At least 3 samples are always taken. """
+
+    repeat = max(3, round(bench.repeat * scale))
+    operation = bench.setup(repeat * bench.number)
+
+    # Takes each sample, using the time reported by the callable if it reports one.
+    samples = []
+    for _ in range(repeat):
+        reported = 0.0
+        started = time.perf_counter()
+        for _ in range(bench.number):
+            result = operation()
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                reported += result
+        elapsed = time.perf_counter() - started
+        samples.append((reported or elapsed) / bench.number)
+
+    samples.sort()
+    return {
+        'median': statistics.median(samples),
+        'min': samples[0],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'samples': repeat,
+        'number': bench.number
+    }
+
+def compare(results: dict, baseline: dict, thresholds: dict) -> list:
+    """ Compares results against a baseline. Returns a list of `(name, median, baseline median, change, threshold, status)`, where the status is `ok`, `REGRESSED`, `faster` or `new`.
+
+    Params:
+        - results (dict) - The results of this run, by benchmark name.
+        - baseline (dict) - The results of the baseline run, by benchmark name.
+        - thresholds (dict) - The threshold of each benchmark, by benchmark name. """
+
+    rows = []
+    for name, result in results.items():
+        threshold = thresholds[name]
+        if name not in baseline:
+            rows.append((name, result['median'], None, None, threshold, 'new'))
+            continue
+
+        change = result['median'] / baseline[name]['median'] - 1
+        status = 'REGRESSED' if change > threshold else 'faster' if change < -threshold else 'ok'
+        rows.append((name, result['median'], baseline[name]['median'], change, threshold, status))
+
+    return rows
+
+def _format_seconds(seconds: float) -> str:
+    if seconds is None:
+        return '-'
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return f'{seconds * factor:.3g} {unit}'
+    return f'{seconds * 1e9:.3g} ns'
+
+def _metadata() -> dict:
+    # Describes the machine & the commit, so results from different machines are not mistaken for regressions.
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_ABS_PATH, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def main(argv: list = None) -> None:
+    """ Runs the registered benchmarks from the command line. Exits with status 1 if a benchmark regressed against the baseline. See `--help` for the options. """
+
+    parser = argparse.ArgumentParser(description='Runs the registered benchmarks & compares them against a baseline.')
+    parser.add_argument('-k', '--filter', action='append', default=[], help='Only run benchmarks whose name contains this text. May be given more than once.')
+    parser.add_argument('-o', '--output', help='Saves the results as JSON to this path.')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE_ABS_PATH, help='The baseline to compare against. Defaults to benchmarks/baseline.json.')
+    parser.add_argument('--save-baseline', action='store_true', help='Saves the results as the new baseline instead of comparing against it.')
+    parser.add_argument('-t', '--threshold', type=float, help='Overrides the threshold of every benchmark, as a fraction (0.25 is 25%% slower).')
+    parser.add_argument('--threshold-for', action='append', default=[], metavar='NAME=FRACTION', help='Overrides the threshold of one benchmark. May be given more than once.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of samples of every benchmark.')
+    parser.add_argument('-l', '--list', action='store_true', help='Lists the benchmarks & exits.')
+    arguments = parser.parse_args(argv)
+
+    # Selects the benchmarks & their thresholds.
+    selected = [bench for name, bench in BENCHMARKS.items() if not arguments.filter or any(text in name for text in arguments.filter)]
+    if arguments.list:
+        for bench in selected:
+            print(bench.name)
+        return
+
+    thresholds = {bench.name: bench.threshold if arguments.threshold is None else arguments.threshold for bench in selected}
+    for override in arguments.threshold_for:
+        name, _, fraction = override.partition('=')
+        if name not in thresholds:
+            parser.error(f'Unknown benchmark \'{name}\' in --threshold-for.')
+        thresholds[name] = float(fraction)
+
+    # Resolves the paths before moving into the workspace.
+    output = os.path.abspath(arguments.output) if arguments.output else None
+    baseline_path = os.path.abspath(arguments.baseline)
+    enter_workspace()
+
+    # Runs the benchmarks.
+    results = {}
+    for bench in selected:
+        results[bench.name] = run_benchmark(bench, arguments.scale)
+        print(f'{bench.name:<40} {_format_seconds(results[bench.name]["median"]):>10} median   {_format_seconds(results[bench.name]["p95"]):>10} p95', flush=True)
+
+    document = {'metadata': _metadata(), 'results': results}
+    if output:
+        with open(output, 'w') as file:
+            json.dump(document, file, indent=4)
+
+    if arguments.save_baseline:
+        with open(baseline_path, 'w') as file:
+            json.dump(document, file, indent=4)
+        print(f'\nSaved the baseline to {baseline_path}.')
+        return
+
+    # Compares against the baseline & fails if anything regressed.
+    if not os.path.exists(baseline_path):
+        print(f'\nNo baseline at {baseline_path}. Run with --save-baseline to create one.')
+        return
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    rows = compare(results, baseline['results'], thresholds)
+    print(f'\nCompared against the baseline from {baseline["metadata"].get("created")} (commit {baseline["metadata"].get("commit")}).')
+    for name, median, baseline_median, change, threshold, status in rows:
+        change_text = '-' if change is None else f'{change * 100:+.1f}%'
+        print(f'{name:<40} {_format_seconds(median):>10} vs {_format_seconds(baseline_median):>10}   {change_text:>8}   limit {threshold * 100:+.0f}%   {status}')
+
+    regressed = [row[0] for row in rows if row[5] == 'REGRESSED']
+    if regressed:
+        print(f'\n{len(regressed)} benchmark(s) regressed: {", ".join(regressed)}.')
+        sys.exit(1)
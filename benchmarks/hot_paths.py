@@ -0,0 +1,211 @@
+""" Benchmarks of the systems hot paths: loading users, verifying passwords, adding & deleting rows at different table sizes, reading & writing large JSON files, constructing the settings
+manager, importing `source.server` in a fresh process & rendering the start up page through the flask test client.
+
+Run with `python -m benchmarks.hot_paths [options]`, see `--help` & `/benchmarks/harness.py`. Save a baseline on the machine which will run the comparisons with `--save-baseline`; results from
+different machines are not comparable. """
+
+# Import internal packages
+from benchmarks.harness import benchmark, main
+
+# Import standard packages
+import datetime
+import functools
+import itertools
+import os
+import subprocess
+import sys
+
+# Variables
+BASE_ABS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TABLE_SIZES = (100, 10000) # Users in the table when adding & deleting rows.
+PASSWORD = 'correct horse battery staple'
+LOADED_USERS = 1000 # Users loaded by the load_user benchmarks.
+JSON_DOCUMENT_ITEMS = 20000 # Items in the large JSON document, about 2 MiB.
+
+# The template rendered by `startup.index`.
+TEMPLATE = '<!DOCTYPE html><html><head><title>{{ title|default("Xenon") }}</title></head><body><h1>Xenon</h1></body></html>\n'
+
+# Run in a fresh process by the cold import benchmark. Prints the seconds taken to import `source.server`.
+IMPORT_PROBE = """
+import time
+started = time.perf_counter()
+import source.server
+print(time.perf_counter() - started)
+"""
+
+_unique = itertools.count()
+
+# Fixtures, created once & shared by the benchmarks which need them.
+
+@functools.cache
+def settings_manager() -> object:
+    from source.config import SettingsManager
+    return SettingsManager()
+
+@functools.cache
+def hashed_password() -> str:
+    from source.hashing import password_hasher
+    return password_hasher.hash(PASSWORD)
+
+def user_rows(count: int, profile_type: int) -> list[dict]:
+    """ Returns rows for new users, all sharing one precomputed password hash so creating them does not hash. """
+
+    created = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    rows = []
+    for _ in range(count):
+        index = next(_unique)
+        rows.append({
+            'forename': 'Bench', 'surname': f'User {index}', 'email': f'user-{index}@bench.test', 'username': f'user-{index}', 'date_of_birth': datetime.date(1990, 1, 1),
+            'datetime_of_creation': created, 'hashed_password': hashed_password(), 'profile_type': profile_type
+        })
+    return rows
+
+@functools.cache
+def databases_manager(users: int) -> tuple:
+    """ Returns a databases manager for a database of its own holding the given number of users, & the id of the profile type the users have. """
+
+    from source.databases import DatabasesManager, ProfileTypes, Users
+
+    manager = DatabasesManager(settings_manager(), db_path=f'sqlite:///{os.path.abspath(f"bench-{users}.db")}')
+    profile_type = ProfileTypes(name='Member', description='Benchmark profile type.')
+    manager.add_row(profile_type)
+    manager.add_rows(Users, user_rows(users, profile_type.id))
+    return manager, profile_type.id
+
+@functools.cache
+def app() -> object:
+    os.makedirs('templates', exist_ok=True)
+    with open(os.path.join('templates', 'index.html'), 'w') as file:
+        file.write(TEMPLATE)
+
+    from source.server import create_app
+    return create_app(settings_manager())
+
+# Benchmarks
+
+@benchmark('settings_manager.construct', number=50)
+def settings_manager_construct(calls: int) -> callable:
+    from source.config import SettingsManager
+
+    settings_manager()
+    return SettingsManager
+
+@benchmark('load_user.cached', number=1000)
+def load_user_cached(calls: int) -> callable:
+    manager, _ = databases_manager(LOADED_USERS)
+    user_ids = itertools.cycle(range(1, LOADED_USERS + 1))
+    return lambda: manager.load_user(next(user_ids))
+
+@benchmark('load_user.uncached', number=200)
+def load_user_uncached(calls: int) -> callable:
+    manager, _ = databases_manager(LOADED_USERS)
+    user_ids = itertools.cycle(range(1, LOADED_USERS + 1))
+
+    def load() -> None:
+        user_id = next(user_ids)
+        manager.users_cache.invalidate(user_id)
+        manager.load_user(user_id)
+
+    return load
+
+@benchmark('users.verify_password', repeat=5, number=1)
+def users_verify_password(calls: int) -> callable:
+    from source.databases import Users
+
+    manager, _ = databases_manager(LOADED_USERS)
+    user = manager.session.get(Users, 1)
+    return lambda: user.verify_password(PASSWORD)
+
+def register_row_benchmarks(users: int) -> None:
+    """ Registers the add_row & delete_row benchmarks for a table of the given size. """
+
+    @benchmark(f'databases.add_row[{users}]', number=20)
+    def add_row(calls: int) -> callable:
+        from source.databases import Users
+
+        manager, profile_type = databases_manager(users)
+        return lambda: manager.add_row(Users(**user_rows(1, profile_type)[0]))
+
+    @benchmark(f'databases.delete_row[{users}]', number=20)
+    def delete_row(calls: int) -> callable:
+        from source.databases import Users
+
+        # Adds one user for each call, so the table keeps its size.
+        manager, profile_type = databases_manager(users)
+        rows = user_rows(calls, profile_type)
+        manager.add_rows(Users, rows)
+        instances = manager.session.query(Users).filter(Users.username.in_([row['username'] for row in rows])).all()
+        return lambda: manager.delete_row(instances.pop())
+
+for table_size in TABLE_SIZES:
+    register_row_benchmarks(table_size)
+
+@functools.cache
+def json_document_path() -> str:
+    from source.paths import write_file_json
+
+    document = {'items': [{'id': index, 'name': f'item-{index}', 'tags': ['a', 'b', 'c'], 'enabled': index % 2 == 0, 'score': index / 7} for index in range(JSON_DOCUMENT_ITEMS)]}
+    path = os.path.abspath('large.json')
+    write_file_json(path, document)
+    return path
+
+@benchmark('paths.write_file_json', number=5)
+def paths_write_file_json(calls: int) -> callable:
+    from source.paths import read_file_json, write_file_json
+
+    document = read_file_json(json_document_path())
+    path = os.path.abspath('written.json')
+    return lambda: write_file_json(path, document)
+
+@benchmark('paths.read_file_json.cached', number=5)
+def paths_read_file_json_cached(calls: int) -> callable:
+    from source.paths import read_file_json
+
+    # The default read, which returns a copy the caller may modify.
+    path = json_document_path()
+    read_file_json(path)
+    return lambda: read_file_json(path)
+
+@benchmark('paths.read_file_json.shared', number=1000)
+def paths_read_file_json_shared(calls: int) -> callable:
+    from source.paths import read_file_json
+
+    path = json_document_path()
+    read_file_json(path, copy=False)
+    return lambda: read_file_json(path, copy=False)
+
+@benchmark('paths.read_file_json.cold', number=5)
+def paths_read_file_json_cold(calls: int) -> callable:
+    from source.paths import read_file_json
+
+    # Changes the files modification time before each read, so every read misses the cache & parses the file.
+    path = json_document_path()
+    modified = itertools.count(os.stat(path).st_mtime_ns + 1)
+
+    def read() -> None:
+        timestamp = next(modified)
+        os.utime(path, ns=(timestamp, timestamp))
+        read_file_json(path)
+
+    return read
+
+@benchmark('import.source_server', repeat=5, number=1, threshold=0.5)
+def import_source_server(calls: int) -> callable:
+    environment = dict(os.environ, PYTHONPATH=BASE_ABS_PATH)
+
+    # Returns the import time measured inside the fresh process, leaving out the interpreters own start up.
+    return lambda: float(subprocess.run([sys.executable, '-c', IMPORT_PROBE], env=environment, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+
+@benchmark('startup.index', number=200)
+def startup_index(calls: int) -> callable:
+    client = app().test_client()
+
+    def render() -> None:
+        response = client.get('/startup/')
+        assert response.status_code == 200, response.status_code
+
+    return render
+
+if __name__ == '__main__':
+    main()
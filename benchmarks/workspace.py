@@ -0,0 +1,36 @@
+""" Helpers shared by the benchmarks. """
+
+# Import standard packages
+import os
+import tempfile
+import time
+
+def enter_workspace() -> str:
+    """ Creates a temporary directory & makes it the working directory. This must be called before anything from `source` is imported, as `source.paths.Paths` resolves its paths from the working
+    directory at import time. Returns the path of the workspace. """
+
+    # Creates the workspace & moves into it.
+    path = tempfile.mkdtemp(prefix='xenon-bench-')
+    os.chdir(path)
+
+    # Returns the path to the caller.
+    return path
+
+def rate(count: int, seconds: float) -> str:
+    """ Returns a formatted operations per second string.
+
+    Params:
+        - count (int) - The number of operations performed.
+        - seconds (float) - The time the operations took. """
+
+    return f'{count / seconds:,.0f}/s'
+
+class Timer():
+    """ A context manager which measures the wall time of its block in seconds. The result is stored in `elapsed`. """
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.elapsed = time.perf_counter() - self.started
@@ -1,9 +1,71 @@
-""" This is the script which should be run. This configures, loads & deploys the system functionality. """
+""" This is the script which should be run. This configures, loads & deploys the system functionality.
+
+Run with `--profile-startup` to print how long each stage of the start up sequence takes & exit, or set the `XENON_PROFILE_STARTUP` environment variable to print it & carry on serving.
+
+Run with `--backup` to take a snapshot of the `/instance` directory & exit, or with `--restore <snapshot id>` to restore one & exit. Snapshots must only be restored while the server is stopped.
+See `/source/backup.py`.
+
+The server runs in the `mode` set in the `SERVER` section of `/instance/system.ini`: `development` runs the flask development server, `production` (the default) runs the multi-worker server in
+`/source/serving.py`. """
 
 # Import internal packages
-from source.server import server, settings_manager
+from source.profiling import startup_profiler
+
+with startup_profiler.stage('import source.server'):
+    from source.server import create_app
+
+# Import standard packages
+import os
+import sys
 
 if __name__ == '__main__':
+    profile_only = '--profile-startup' in sys.argv
+
+    server = create_app()
+    services = server.extensions['xenon']
+    settings_manager = services.settings_manager
+
+    # Creates the databases manager up front when profiling, so it is included in the report.
+    if profile_only or startup_profiler.enabled:
+        services.databases_manager
+        startup_profiler.report()
+
+        if profile_only:
+            sys.exit(0)
+
+    # Takes or restores a snapshot of the instance directory & exits.
+    if '--backup' in sys.argv:
+        snapshot = services.backup_manager.create_snapshot()
+        print(f'Took snapshot {snapshot["id"]}: {snapshot["bytes"]} bytes, {snapshot["stored_bytes"]} bytes stored.')
+        sys.exit(0)
+
+    if '--restore' in sys.argv:
+        snapshot = services.backup_manager.restore(sys.argv[sys.argv.index('--restore') + 1])
+        print(f'Restored snapshot {snapshot["id"]}.')
+        sys.exit(0)
+
+    # Saves the schedule of the automatic snapshots, which the scheduler runs in one process. Only done when a schedule is set, so start up does not create the databases manager otherwise; a
+    # schedule left from a removed setting cancels itself the next time it runs.
+    if settings_manager.backup_schedule:
+        from source.backup import schedule_backups
+        schedule_backups(services.databases_manager, settings_manager.settings)
+
+    # Runs the pre-forking server in production mode, which watches the settings file once it has forked its workers. Platforms without `os.fork` fall back to the development server.
+    if settings_manager.server_mode == 'production' and not hasattr(os, 'fork'):
+        print('The production server requires a platform with \'os.fork\', running the development server instead.')
+    elif settings_manager.server_mode == 'production':
+        from source.serving import PreforkServer
+        PreforkServer(server).run()
+        sys.exit(0)
+
+    # Reloads the settings whenever `/instance/system.ini` changes.
+    settings_manager.start_watching()
+
+    # Starts the automation scheduler. With the reloader, only in the process which serves requests.
+    if not settings_manager.server_debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from source.scheduler import scheduler
+        scheduler.start(server)
+
     server.run(
         host=settings_manager.server_host,
         port=settings_manager.server_port,
@@ -4,10 +4,14 @@
 from flask import Blueprint
 
 # Import blueprints
+from routes.assets import assets_r
+from routes.metrics import metrics_r
 from routes.startup import startup_r
 
 # Base blueprint declaration
 base_r = Blueprint('base', __name__)
 
 # Base blueprint registration
-base_r.register_blueprint(startup_r)
\ No newline at end of file
+base_r.register_blueprint(startup_r)
+base_r.register_blueprint(metrics_r)
+base_r.register_blueprint(assets_r)
\ No newline at end of file
@@ -0,0 +1,76 @@
+""" A route script which serves the fingerprinted assets built by `/source/assets.py`. As a built files name changes whenever its content does, responses are cached by browsers for a year & marked
+`immutable`, so they are not even revalidated. The smallest compressed variant the client accepts is sent, each variant with its own strong ETag, & conditional requests are answered with
+`304 Not Modified`. Files are handed to the server with `wsgi.file_wrapper`, which the production server sends with `sendfile`. """
+
+# Import internal packages
+from source.assets import asset_pipeline, ENCODING_SUFFIXES
+
+# Import external packages
+from flask import Blueprint, current_app, request, abort
+from werkzeug.wsgi import wrap_file
+
+# Import standard packages
+import os
+
+# Variables
+MAX_AGE = 31536000 # One year, in seconds.
+
+# Blueprint registration
+assets_r = Blueprint('assets', __name__, url_prefix='/assets')
+
+def choose_encoding(entry: dict) -> str:
+    """ Returns the content coding of the variant to send, or `None` for the uncompressed file. Picks the variant the client prefers, preferring brotli over gzip when it has no preference.
+
+    Params:
+        - entry (dict) - The manifest entry of the asset. """
+
+    best_encoding, best_quality = None, request.accept_encodings['identity'] or 0.001
+    for encoding in ENCODING_SUFFIXES:
+        quality = request.accept_encodings[encoding]
+        if encoding in entry['encodings'] and quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+
+    return best_encoding
+
+# Routes
+@assets_r.route('/<path:filename>')
+def index(filename):
+    entry = asset_pipeline.lookup(filename)
+    if entry is None:
+        abort(404)
+
+    encoding = choose_encoding(entry)
+    path = asset_pipeline.file_path(entry, encoding)
+    etag = entry['hash'] + (ENCODING_SUFFIXES[encoding] if encoding else '')
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+
+    # Builds the headers shared by full & not modified responses.
+    response = current_app.response_class(mimetype=entry['mimetype'])
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+
+    # Answers conditional requests. `If-Modified-Since` is only used when there is no `If-None-Match`.
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and int(stat.st_mtime) <= request.if_modified_since.timestamp()
+
+    if not_modified:
+        response.status_code = 304
+        return response
+
+    # Sends the file.
+    if encoding:
+        response.content_encoding = encoding
+    response.content_length = stat.st_size
+    response.response = wrap_file(request.environ, open(path, 'rb'))
+    response.direct_passthrough = True
+    return response
@@ -0,0 +1,21 @@
+""" A route script which exposes the servers metrics, such as request latencies, SQL statement timings & cache statistics, in the Prometheus text format. The metrics are recorded by
+`/source/metrics.py`. The metrics include raw SQL, so they are only served to the addresses allowed in the `METRICS` section of the `/instance/system.ini` file, by default the local
+machine. """
+
+# Import internal packages
+from source.metrics import metrics, CONTENT_TYPE
+
+# Import external packages
+from flask import Blueprint, Response, abort, request
+
+# Blueprint registration
+metrics_r = Blueprint('metrics', __name__)
+
+# Routes
+@metrics_r.route('/metrics')
+def index():
+    # Hides the endpoint when the metrics are turned off in the `METRICS` section of the `/instance/system.ini` file, or from addresses which are not allowed to read them.
+    if not metrics.enabled or not metrics.allows(request.remote_addr):
+        abort(404)
+
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,365 @@
+""" The app registry. Apps are installed in their own directories under `/apps`, each holding an `app.json` manifest & a python package whose entry module defines a flask `blueprint`. Example of an
+app directory:
+```
+apps/
+    weather/
+        app.json        {"name": "Weather", "version": "1.0.0", "description": "Forecasts for the household."}
+        __init__.py     blueprint = Blueprint('weather', __name__)
+        templates/
+```
+
+The manifests of the installed apps are kept in an index in `/instance/apps.json`. On start up, only the apps whose directory or manifest changed since the index was written are read again, so boot time
+does not depend on how many apps are installed. Nothing of an app is imported at start up: its package, blueprint & databases (see `/source/engines.py`) are loaded by the first request to its url
+prefix (`/apps/<app id>`), & apps which receive no requests for the `idle_timeout` set in the `APPS` section of `/instance/system.ini` are unloaded again, by a scheduler job which every process
+that has loaded an app runs every `IDLE_CHECK_INTERVAL`. An app which is changed or removed while it is handling requests is marked stale & unloaded once they finish.
+
+Flask does not allow blueprints to be registered once an app has handled its first request, so each loaded app is served by a child flask app which shares the configuration, login manager &
+services of the main app. `AppDispatcher` sends the requests under `/apps/<app id>` to it. An app package may also define `setup(loaded_app)` & `teardown(loaded_app)` functions, which are called
+when it is loaded & unloaded. Unloading an app also closes its databases & removes its event bus subscriptions made with `owner` set to its id, see `/source/events.py`. """
+
+# Import internal packages
+from source.paths import Paths, read_file_json, write_file_json
+from source.scheduler import scheduler, IntervalTrigger
+
+# Import external packages
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.exceptions import NotFound
+
+# Import standard packages
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+# Variables
+MANIFEST_NAME = 'app.json'
+ENTRY_MODULE = '__init__.py'
+PACKAGE_PREFIX = 'xenon_apps' # Apps are imported as `xenon_apps.<app id>`.
+URL_PREFIX = '/apps'
+
+DEFAULT_IDLE_TIMEOUT = 600.0 # Seconds without a request before an app is unloaded. `0` keeps apps loaded.
+IDLE_CHECK_INTERVAL = 30.0 # Seconds between checks for idle apps.
+REFRESH_INTERVAL = 5.0 # Seconds between rescans of `/apps` triggered by requests for unknown apps.
+IDLE_JOB_ID = 'apps-idle-sweep'
+
+logger = logging.getLogger(__name__)
+
+class LoadedApp():
+    """ An app which has been imported & is serving requests.
+
+    Properties:
+        - id (str) - The name of the apps directory, used in its url prefix & package name.
+        - directory (str) - The absolute path of the apps directory.
+        - manifest (dict) - The contents of the apps `app.json`.
+        - module (module) - The apps imported package.
+        - flask (Flask) - The child flask app serving the apps blueprint.
+        - last_used (float) - The `time.monotonic()` of the apps last request.
+        - active (int) - The number of requests the app is handling.
+        - stale (bool) - Whether the app was changed or removed while handling requests, so it is unloaded once they finish. """
+
+    def __init__(self, app_id: str, directory: str, manifest: dict, module: types.ModuleType, flask: object) -> None:
+        self.id = app_id
+        self.directory = directory
+        self.manifest = manifest
+        self.module = module
+        self.flask = flask
+        self.last_used = time.monotonic()
+        self.active = 0
+        self.stale = False
+
+class AppRegistry():
+    """ Keeps the index of the installed apps & loads & unloads them. See the module for details. Example:
+    ```python
+    from source.apps import AppRegistry
+
+    app_registry = AppRegistry()
+    app_registry.refresh()
+
+    app_registry.installed # Returns the manifest of every installed app, by app id.
+    ```
+
+    Params:
+        - apps_path (str) - The directory the apps are installed in. Defaults to the `/apps` directory.
+        - index_path (str) - The index file. Defaults to the `/instance/apps.json` file.
+        - idle_timeout (float) - The number of seconds without a request before an app is unloaded. `0` keeps apps loaded.
+        - on_unload (callable) - Called with the app id after an app is unloaded, for example to close its databases. """
+
+    def __init__(self, apps_path: str = Paths.APPS_ABS_PATH, index_path: str = Paths.APPS_INDEX_ABS_PATH, idle_timeout: float = DEFAULT_IDLE_TIMEOUT, on_unload: callable = None) -> None:
+        self.apps_path = apps_path
+        self.index_path = index_path
+        self.idle_timeout = idle_timeout
+        self.on_unload = on_unload
+
+        # The index entries by app id, stored as `{'signature': [...], 'manifest': {...}}`, & the loaded apps by app id.
+        self.index = {}
+        self.loaded = {}
+
+        self._lock = threading.RLock()
+        self._last_refresh = 0.0
+        self._last_idle_check = time.monotonic()
+
+        # The process which has scheduled the idle sweep. Scheduled by the first app loaded in each process, as the scheduler drops the jobs inherited from a parent process.
+        self._sweep_pid = None
+
+    @property
+    def installed(self) -> dict:
+        """ The manifest of every installed app, by app id. """
+
+        return {app_id: entry['manifest'] for app_id, entry in self.index.items()}
+
+    def refresh(self) -> dict:
+        """ Brings the index up to date with the apps directory. Apps whose directory & manifest have the same modification times & sizes as when they were indexed are not read again. Returns the
+        counts of read, unchanged, removed & invalid apps. """
+
+        counts = {'read': 0, 'unchanged': 0, 'removed': 0, 'invalid': 0}
+
+        with self._lock:
+            if not self.index and os.path.exists(self.index_path):
+                self.index = read_file_json(self.index_path)
+
+            # Reads the manifests of the new & changed apps.
+            index = {}
+            if os.path.isdir(self.apps_path):
+                with os.scandir(self.apps_path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(('.', '_')) or not entry.is_dir() or not entry.name.isidentifier():
+                            continue
+
+                        manifest_path = os.path.join(entry.path, MANIFEST_NAME)
+                        try:
+                            manifest_stat = os.stat(manifest_path)
+                        except FileNotFoundError:
+                            continue
+
+                        directory_stat = entry.stat()
+                        signature = [directory_stat.st_mtime_ns, manifest_stat.st_mtime_ns, manifest_stat.st_size]
+                        previous = self.index.get(entry.name)
+                        if previous is not None and previous['signature'] == signature:
+                            index[entry.name] = previous
+                            counts['unchanged'] += 1
+                            continue
+
+                        try:
+                            manifest = read_file_json(manifest_path)
+                            if not isinstance(manifest, dict) or not isinstance(manifest.get('name'), str):
+                                raise ValueError('the manifest must be an object with a \'name\'')
+                        except ValueError as exception:
+                            logger.warning('Skipping app \'%s\': invalid %s: %s.', entry.name, MANIFEST_NAME, exception)
+                            counts['invalid'] += 1
+                            continue
+
+                        index[entry.name] = {'signature': signature, 'manifest': manifest}
+                        counts['read'] += 1
+
+            # Unloads the apps which were removed or changed, so their next request loads the new version. Apps handling requests are unloaded once they finish.
+            for app_id in list(self.loaded):
+                if app_id not in index or index[app_id] is not self.index.get(app_id):
+                    self._retire(app_id)
+
+            counts['removed'] = len(self.index.keys() - index.keys())
+            changed = counts['read'] or counts['removed'] or not os.path.exists(self.index_path)
+            self.index = index
+            self._last_refresh = time.monotonic()
+
+            # Writes the index only when it changed.
+            if changed:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                write_file_json(self.index_path, index)
+
+        return counts
+
+    def get(self, app_id: str, create_flask: callable) -> LoadedApp:
+        """ Returns the loaded app, loading it if it is not loaded yet. Returns `None` if no app with that id is installed.
+
+        Params:
+            - app_id (str) - The id of the app.
+            - create_flask (callable) - Given the app id & directory, returns the child flask app to register the apps blueprint on. """
+
+        loaded_app = self.loaded.get(app_id)
+        if loaded_app is not None:
+            return loaded_app
+
+        with self._lock:
+            # Rescans the apps directory for apps installed since the last scan, at most every few seconds.
+            if app_id not in self.index and time.monotonic() - self._last_refresh >= REFRESH_INTERVAL:
+                self.refresh()
+
+            if app_id not in self.index:
+                return None
+
+            if app_id not in self.loaded:
+                self.loaded[app_id] = self._load(app_id, create_flask)
+                self._schedule_sweep()
+
+            return self.loaded[app_id]
+
+    def acquire(self, app_id: str, create_flask: callable) -> LoadedApp:
+        """ Returns the loaded app, loading it if it is not loaded yet, & counts a request as active on it until `release()` is called. Returns `None` if no app with that id is installed. The
+        lookup & the count are made under the registry lock, which `unload_idle()` checks the counts under, so an app is never unloaded between being returned & being counted.
+
+        Params:
+            - app_id (str) - The id of the app.
+            - create_flask (callable) - Given the app id & directory, returns the child flask app to register the apps blueprint on. """
+
+        with self._lock:
+            loaded_app = self.get(app_id, create_flask)
+            if loaded_app is not None:
+                loaded_app.active += 1
+                loaded_app.last_used = time.monotonic()
+
+            return loaded_app
+
+    def release(self, loaded_app: LoadedApp) -> None:
+        """ Counts a request acquired with `acquire()` as finished.
+
+        Params:
+            - loaded_app (LoadedApp) - The app returned by `acquire()`. """
+
+        with self._lock:
+            loaded_app.active -= 1
+            loaded_app.last_used = time.monotonic()
+
+            # Unloads the app once its last request finishes if it was changed or removed meanwhile.
+            if loaded_app.stale and loaded_app.active == 0 and self.loaded.get(loaded_app.id) is loaded_app:
+                self.unload(loaded_app.id)
+
+    def _retire(self, app_id: str) -> None:
+        """ Unloads a changed or removed app, or marks it stale if it is handling requests, so `release()` unloads it once they finish. Until then its requests are still served by the loaded
+        version. Must be called with the lock held.
+
+        Params:
+            - app_id (str) - The id of the app. """
+
+        loaded_app = self.loaded[app_id]
+        if loaded_app.active > 0:
+            loaded_app.stale = True
+        else:
+            self.unload(app_id)
+
+    def _schedule_sweep(self) -> None:
+        """ Schedules `unload_idle()` to run every `IDLE_CHECK_INTERVAL` in this process, if it has not been scheduled in this process yet. Must be called with the lock held. """
+
+        if self._sweep_pid != os.getpid():
+            self._sweep_pid = os.getpid()
+            scheduler.schedule(IntervalTrigger(IDLE_CHECK_INTERVAL), self.unload_idle, job_id=IDLE_JOB_ID)
+
+    def _load(self, app_id: str, create_flask: callable) -> LoadedApp:
+        """ Imports an app & registers its blueprint on a new child flask app. """
+
+        started = time.perf_counter()
+        directory = os.path.join(self.apps_path, app_id)
+        manifest = self.index[app_id]['manifest']
+
+        # Imports the app as a package, so its modules can import each other relatively.
+        if PACKAGE_PREFIX not in sys.modules:
+            package = types.ModuleType(PACKAGE_PREFIX)
+            package.__path__ = []
+            sys.modules[PACKAGE_PREFIX] = package
+
+        name = f'{PACKAGE_PREFIX}.{app_id}'
+        spec = importlib.util.spec_from_file_location(name, os.path.join(directory, ENTRY_MODULE), submodule_search_locations=[directory])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+
+            # Registers the blueprint under the apps url prefix.
+            flask = create_flask(app_id, directory)
+            flask.register_blueprint(module.blueprint, url_prefix=f'{URL_PREFIX}/{app_id}')
+
+            loaded_app = LoadedApp(app_id, directory, manifest, module, flask)
+            if hasattr(module, 'setup'):
+                module.setup(loaded_app)
+        except BaseException:
+            self._forget_modules(app_id)
+            raise
+
+        logger.info('Loaded app \'%s\' in %.1f ms.', app_id, (time.perf_counter() - started) * 1000)
+        return loaded_app
+
+    def _forget_modules(self, app_id: str) -> None:
+        # Removes the apps modules from the import system, so they are freed & imported afresh when the app is loaded again.
+        name = f'{PACKAGE_PREFIX}.{app_id}'
+        for module_name in [module_name for module_name in sys.modules if module_name == name or module_name.startswith(name + '.')]:
+            del sys.modules[module_name]
+
+    def unload(self, app_id: str) -> None:
+        """ Unloads an app, calling its `teardown()` function. The next request to the app loads it again.
+
+        Params:
+            - app_id (str) - The id of the app. """
+
+        with self._lock:
+            loaded_app = self.loaded.pop(app_id, None)
+            if loaded_app is None:
+                return
+
+            try:
+                if hasattr(loaded_app.module, 'teardown'):
+                    loaded_app.module.teardown(loaded_app)
+            finally:
+                self._forget_modules(app_id)
+                if self.on_unload is not None:
+                    self.on_unload(app_id)
+
+        logger.info('Unloaded app \'%s\'.', app_id)
+
+    def unload_idle(self) -> None:
+        """ Unloads every app which is not handling a request & has not had one for longer than `idle_timeout`. Does nothing if it ran less than a few seconds ago. The active requests are
+        counted under the same lock, see `acquire()`. Run by the scheduler every `IDLE_CHECK_INTERVAL` & on each request. """
+
+        now = time.monotonic()
+        if not self.idle_timeout or now - self._last_idle_check < min(IDLE_CHECK_INTERVAL, self.idle_timeout):
+            return
+
+        self._last_idle_check = now
+        with self._lock:
+            for app_id, loaded_app in list(self.loaded.items()):
+                if loaded_app.active == 0 and now - loaded_app.last_used > self.idle_timeout:
+                    self.unload(app_id)
+
+class AppDispatcher():
+    """ WSGI middleware which sends the requests under `/apps/<app id>` to the apps child flask app, loading the app first if needed, & every other request to the main app.
+
+    Params:
+        - wsgi_app (callable) - The WSGI application of the main app.
+        - registry (AppRegistry) - The registry of the installed apps.
+        - create_flask (callable) - Given an app id & directory, returns a child flask app configured like the main app. """
+
+    def __init__(self, wsgi_app: callable, registry: AppRegistry, create_flask: callable) -> None:
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+        self.create_flask = create_flask
+
+    def __call__(self, environ: dict, start_response: callable) -> object:
+        self.registry.unload_idle()
+
+        # Sends the request to the main app unless it is under an apps url prefix.
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(URL_PREFIX + '/'):
+            return self.wsgi_app(environ, start_response)
+
+        # Counts the request as active until its response is closed, so the app is not unloaded while it is responding.
+        app_id = path[len(URL_PREFIX) + 1:].split('/', 1)[0]
+        try:
+            loaded_app = self.registry.acquire(app_id, self.create_flask)
+        except Exception:
+            logger.exception('Failed to load app \'%s\'.', app_id)
+            loaded_app = None
+
+        if loaded_app is None:
+            return NotFound()(environ, start_response)
+
+        def finished() -> None:
+            self.registry.release(loaded_app)
+
+        try:
+            response = loaded_app.flask.wsgi_app(environ, start_response)
+        except BaseException:
+            finished()
+            raise
+
+        return ClosingIterator(response, finished)
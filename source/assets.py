@@ -0,0 +1,231 @@
+""" The static asset pipeline. Every file in the `/static` directory is copied to `/instance/assets` under a content hashed name (`css/site.css` becomes `css/site.3f2a9c41d0b7e865.css`), along with
+gzip & brotli compressed variants of the files worth compressing. A manifest maps each original path to its built file. As a built files name changes whenever its content does, the files are
+served by `/routes/assets.py` with long-lived `immutable` cache headers, so browsers never download an asset twice.
+
+Templates resolve asset urls with the `asset_url` helper, which falls back to flasks static route for files which are not in the manifest. The pipeline runs at start up if `build_on_startup` is set
+in the `ASSETS` section of `/instance/system.ini`, or at build time with `python -m source.assets`. Unchanged files are not hashed or compressed again. Example:
+```html
+<link rel="stylesheet" href="{{ asset_url('css/site.css') }}">
+```
+
+Brotli variants are only created when the optional `brotli` package is installed. """
+
+# Import internal packages
+from source.paths import Paths, read_file_json, write_file_atomic, write_file_json
+
+# Import external packages
+from flask import url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Import standard packages
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+
+# Variables
+MANIFEST_NAME = 'manifest.json'
+
+FINGERPRINT_LENGTH = 16 # Hex characters of the sha256 digest kept in built file names.
+MIN_COMPRESS_SIZE = 256 # Bytes. Smaller files are not worth compressing.
+MIN_COMPRESS_SAVING = 0.1 # Fraction a variant must save over the original to be kept.
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# The types of file which compress well. Images, fonts & archives are already compressed.
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.html', '.txt', '.xml', '.ico', '.wasm', '.ttf', '.otf')
+
+# The suffix of each compressed variant, by content coding.
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+logger = logging.getLogger(__name__)
+
+class AssetPipeline():
+    """ Builds the fingerprinted & compressed assets & resolves their urls. See the module for details. The `asset_pipeline` instance is shared by the whole program. Example:
+    ```python
+    from source.assets import asset_pipeline
+
+    asset_pipeline.build()
+    asset_pipeline.url('css/site.css') # Returns `/assets/css/site.3f2a9c41d0b7e865.css`.
+    ```
+
+    Params:
+        - source_path (str) - The directory holding the original assets. Defaults to the `/static` directory.
+        - build_path (str) - The directory the built assets & the manifest are written to. Defaults to the `/instance/assets` directory. """
+
+    def __init__(self, source_path: str = Paths.STATIC_ABS_PATH, build_path: str = Paths.ASSETS_ABS_PATH) -> None:
+        self.source_path = source_path
+        self.build_path = build_path
+        self.manifest_path = os.path.join(build_path, MANIFEST_NAME)
+
+        # The manifest entries by original path, & by built file name for serving.
+        self.manifest = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """ Loads the manifest written by the last build, if there is one. """
+
+        manifest = read_file_json(self.manifest_path) if os.path.exists(self.manifest_path) else {}
+        self._set_manifest(manifest)
+
+    def _set_manifest(self, manifest: dict) -> None:
+        with self._lock:
+            self.manifest = manifest
+            self._files = {entry['file']: entry for entry in manifest.values()}
+
+    def _scan(self) -> list:
+        """ Returns the relative paths of every original asset, skipping hidden files & directories. """
+
+        paths = []
+        pending = ['']
+        while pending:
+            relative_directory = pending.pop()
+            with os.scandir(os.path.join(self.source_path, relative_directory)) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    relative_path = f'{relative_directory}/{entry.name}' if relative_directory else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(relative_path)
+                    elif entry.is_file():
+                        paths.append(relative_path)
+
+        return sorted(paths)
+
+    def _build_file(self, relative_path: str, stat: os.stat_result) -> dict:
+        """ Writes the fingerprinted copy & compressed variants of one asset & returns its manifest entry. """
+
+        with open(os.path.join(self.source_path, relative_path), 'rb') as file:
+            data = file.read()
+
+        # Names the built file after the content hash, keeping the extension last so the type can still be guessed from it.
+        digest = hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+        stem, extension = os.path.splitext(relative_path)
+        built_file = f'{stem}.{digest}{extension}'
+        built_path = os.path.join(self.build_path, built_file)
+
+        os.makedirs(os.path.dirname(built_path), exist_ok=True)
+        if not os.path.exists(built_path):
+            write_file_atomic(built_path, data)
+
+        # Writes the compressed variants which save enough to be worth serving.
+        encodings = {}
+        if extension.lower() in COMPRESSIBLE_EXTENSIONS and len(data) >= MIN_COMPRESS_SIZE:
+            compressors = {'gzip': lambda: gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)}
+            if brotli is not None:
+                compressors['br'] = lambda: brotli.compress(data, quality=BROTLI_QUALITY)
+
+            for encoding, compress in compressors.items():
+                variant_path = built_path + ENCODING_SUFFIXES[encoding]
+                if os.path.exists(variant_path):
+                    encodings[encoding] = os.path.getsize(variant_path)
+                    continue
+
+                compressed = compress()
+                if len(compressed) <= len(data) * (1 - MIN_COMPRESS_SAVING):
+                    write_file_atomic(variant_path, compressed)
+                    encodings[encoding] = len(compressed)
+
+        # Returns the manifest entry. The source size & modification time let the next build skip the file if it has not changed.
+        return {
+            'file': built_file,
+            'hash': digest,
+            'size': len(data),
+            'mimetype': mimetypes.guess_type(relative_path)[0] or 'application/octet-stream',
+            'encodings': encodings,
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns
+        }
+
+    def build(self) -> dict:
+        """ Builds every asset which changed since the last build, writes the new manifest & removes built files which neither the new nor the previous manifest refers to. Files from the
+        previous build are kept, so pages which were rendered before the build can still load them. Returns the counts of built, unchanged & removed files. """
+
+        self.load()
+        previous = self.manifest
+        manifest = {}
+        counts = {'built': 0, 'unchanged': 0, 'removed': 0}
+
+        # Builds the assets, reusing the previous entries of the files whose size & modification time have not changed.
+        if os.path.isdir(self.source_path):
+            for relative_path in self._scan():
+                stat = os.stat(os.path.join(self.source_path, relative_path))
+                entry = previous.get(relative_path)
+                if entry is not None and (entry['source_size'], entry['source_mtime_ns']) == (stat.st_size, stat.st_mtime_ns) and os.path.exists(os.path.join(self.build_path, entry['file'])):
+                    manifest[relative_path] = entry
+                    counts['unchanged'] += 1
+                else:
+                    manifest[relative_path] = self._build_file(relative_path, stat)
+                    counts['built'] += 1
+
+        # Writes the manifest once every file it refers to exists.
+        os.makedirs(self.build_path, exist_ok=True)
+        write_file_json(self.manifest_path, manifest)
+        self._set_manifest(manifest)
+
+        # Removes the built files which are no longer referred to.
+        keep = {MANIFEST_NAME}
+        for entry in (*previous.values(), *manifest.values()):
+            keep.add(entry['file'])
+            keep.update(entry['file'] + ENCODING_SUFFIXES[encoding] for encoding in entry['encodings'])
+
+        for directory, _, names in os.walk(self.build_path):
+            for name in names:
+                relative_path = os.path.relpath(os.path.join(directory, name), self.build_path).replace(os.sep, '/')
+                if relative_path not in keep:
+                    os.remove(os.path.join(directory, name))
+                    counts['removed'] += 1
+
+        logger.info('Built %(built)d assets, %(unchanged)d unchanged, %(removed)d removed.', counts)
+        return counts
+
+    def lookup(self, built_file: str) -> dict:
+        """ Returns the manifest entry of a built file, or `None` if the file is not in the manifest.
+
+        Params:
+            - built_file (str) - The fingerprinted path of the file, relative to the build directory. """
+
+        return self._files.get(built_file)
+
+    def file_path(self, entry: dict, encoding: str = None) -> str:
+        """ Returns the absolute path of a built file or one of its compressed variants.
+
+        Params:
+            - entry (dict) - The manifest entry of the file.
+            - encoding (str) - The content coding of the variant, `br` or `gzip`. If `None`, the uncompressed file. """
+
+        return os.path.join(self.build_path, entry['file'] + (ENCODING_SUFFIXES[encoding] if encoding else ''))
+
+    def url(self, path: str) -> str:
+        """ Returns the url of an asset. Assets in the manifest get their fingerprinted url on the `base.assets.index` route of `/routes/assets.py`, anything else is served by flasks static route.
+
+        Params:
+            - path (str) - The path of the asset, relative to the `/static` directory. """
+
+        entry = self.manifest.get(path)
+        if entry is None:
+            return url_for('static', filename=path)
+
+        return url_for('base.assets.index', filename=entry['file'])
+
+# The asset pipeline shared by the whole program.
+asset_pipeline = AssetPipeline()
+
+def asset_url(path: str) -> str:
+    """ Returns the url of an asset. Registered as a template global, see the module for details.
+
+    Params:
+        - path (str) - The path of the asset, relative to the `/static` directory. """
+
+    return asset_pipeline.url(path)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    asset_pipeline.build()
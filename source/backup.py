@@ -0,0 +1,452 @@
+""" Online backups of the instance directory. A snapshot captures everything in `/instance` other than what is rebuilt at start up (the built assets, the apps index & lock files):
+    - Databases (`*.db`) are copied with sqlites online backup API, a number of pages per step with a pause between steps, so requests keep reading & writing while the copy is made. The copy is
+    a consistent image of the database. If writes keep restarting the copy, the remainder is copied in a single step, which in WAL mode still does not block writers.
+    - The settings & JSON files are read together straight after the databases are copied, with pending delayed JSON writes flushed & settings updates held back, so they match each other & the
+    databases. Other files, such as event log segments, are read up to the size they had when the snapshot started.
+
+Files are split into fixed size chunks which are stored once, compressed, under the SHA-256 of their content. Database copies keep the page layout of the database, so unchanged pages produce
+the same chunks & each snapshot only stores what changed since the previous one. Each snapshot is a JSON manifest listing the chunks of every file. After a snapshot is taken the oldest snapshots
+beyond the retention are deleted, along with the chunks no remaining snapshot uses.
+
+Restoring verifies every chunk before anything is replaced, then moves the files into place. The server must be stopped while a snapshot is restored, for example with
+`python main.py --restore <snapshot id>`. Settings are read from the `BACKUP` section of `/instance/system.ini`, whose `schedule` takes snapshots automatically. Example:
+```python
+from source.server import get_services
+
+backup_manager = get_services().backup_manager
+snapshot = backup_manager.create_snapshot()
+backup_manager.restore(snapshot['id'])
+``` """
+
+# Import internal packages
+from source.exceptions import SnapshotNotFound, SnapshotCorrupt
+from source.paths import Paths, flush_json_writes, read_file_json, write_file_atomic, write_file_json
+
+# Import external packages
+from flask import current_app
+
+# Import standard packages
+import concurrent.futures
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from typing import Iterator
+
+# Variables
+CHUNK_BYTES = 1048576 # 1 MiB, a multiple of every sqlite page size, so chunks of a database copy line up with its pages.
+WORKERS = min(4, os.cpu_count() or 1) # Threads hashing & compressing chunks. zlib & hashlib release the GIL on large buffers.
+MAX_BACKUP_RESTARTS = 3 # Stepped database copies restarted by writes before the remainder is copied in one step.
+
+DATABASE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+CONSISTENT_SUFFIXES = ('.ini', '.json') # Read together straight after the databases are copied.
+EXCLUDED_SUFFIXES = ('-wal', '-shm', '-journal', '.tmp', '.lock')
+EXCLUDED_PATHS = frozenset(os.path.relpath(path, Paths.INSTANCE_ABS_PATH) for path in (Paths.ASSETS_ABS_PATH, Paths.APPS_INDEX_ABS_PATH, Paths.TEMPLATE_CACHE_ABS_PATH)) # Rebuilt at start up.
+RESTORE_PREFIX = '.restore-'
+
+SCHEDULE_ID = 'backup' # The id of the persisted schedule which takes snapshots automatically.
+
+logger = logging.getLogger(__name__)
+
+class _BackupRestarted(Exception):
+    """ Raised by the progress callback of a stepped database copy when a write restarted it. """
+
+class BackupManager():
+    """ Takes, lists, prunes & restores snapshots of the instance directory. See the module for details. Stored on the app services as `backup_manager`. Snapshots taken by different processes
+    are serialised with a file lock in the backups directory.
+
+    Params:
+        - settings_manager (SettingsManager) - The settings manager which holds the `BACKUP` settings & whose settings file is snapshotted.
+        - instance_path (str) - The directory which is snapshotted & restored. Defaults to the `/instance` directory. """
+
+    def __init__(self, settings_manager: object, instance_path: str = Paths.INSTANCE_ABS_PATH) -> None:
+        self.settings_manager = settings_manager
+        self.instance_path = instance_path
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+
+        self.runs = 0
+        self.errors = 0
+        self.last_seconds = 0.0
+        self.last_bytes = 0
+
+    @property
+    def path(self) -> str:
+        """ The backups directory, from the `path` setting. """
+
+        return os.path.abspath(self.settings_manager.backup_path or Paths.BACKUPS_ABS_PATH)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def _manifest_path(self, snapshot_id: str) -> str:
+        return os.path.join(self.path, 'snapshots', f'{snapshot_id}.json')
+
+    @contextlib.contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """ Holds the backups directory for this thread & process. """
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(os.path.join(self.path, 'backup.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    # Snapshots
+
+    def create_snapshot(self) -> dict:
+        """ Takes a snapshot of the instance directory, deletes the snapshots beyond the retention & returns the new snapshots manifest, without its file list. Safe to call while the server is
+        running. """
+
+        started = time.perf_counter()
+        try:
+            with self._exclusive():
+                manifest = self._create_snapshot()
+                self._prune(self.settings_manager.backup_retention)
+        except Exception:
+            with self._counters_lock:
+                self.errors += 1
+            raise
+
+        # Updates the counters together, so `stats()` never reports the time of one snapshot with the size of another.
+        elapsed = time.perf_counter() - started
+        with self._counters_lock:
+            self.runs += 1
+            self.last_seconds = elapsed
+            self.last_bytes = manifest['stored_bytes']
+        logger.info('Took snapshot %s in %.2f s: %d files, %d bytes, %d bytes stored.', manifest['id'], elapsed, len(manifest['files']), manifest['bytes'], manifest['stored_bytes'])
+        return _summary(manifest)
+
+    def _create_snapshot(self) -> dict:
+        # Names the snapshot after the time it was taken, so snapshots sort in the order they were taken.
+        created = datetime.datetime.now(datetime.timezone.utc)
+        snapshot_id = created.strftime('%Y%m%dT%H%M%S%fZ')
+        flush_json_writes()
+        files = self._find_files()
+
+        # Reads the chunks already stored, so only new ones are written.
+        objects_path = os.path.join(self.path, 'objects')
+        stored = {prefix + name for prefix in _list_directory(objects_path) for name in _list_directory(os.path.join(objects_path, prefix))}
+        counters = {'bytes': 0, 'stored_bytes': 0, 'new_chunks': 0}
+        entries = []
+
+        staging = tempfile.mkdtemp(prefix='staging-', dir=self.path)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(WORKERS, thread_name_prefix='backup') as executor:
+                # Copies the databases, then reads the settings & JSON files together, so they match the databases.
+                for relative_path in files['databases']:
+                    copy_path = os.path.join(staging, f'{len(entries)}.db')
+                    self._copy_database(os.path.join(self.instance_path, relative_path), copy_path)
+                    entries.append(self._store_file(relative_path, 'database', copy_path, executor, stored, counters))
+
+                flush_json_writes()
+                with self.settings_manager.hold_writes():
+                    contents = {relative_path: _read_file(os.path.join(self.instance_path, relative_path)) for relative_path in files['consistent']}
+
+                for relative_path, content in contents.items():
+                    if content is not None:
+                        entries.append(self._store_file(relative_path, 'file', content, executor, stored, counters))
+
+                # Reads the remaining files up to their current size, as they are only appended to.
+                for relative_path in files['other']:
+                    entry = self._store_file(relative_path, 'file', os.path.join(self.instance_path, relative_path), executor, stored, counters)
+                    if entry is not None:
+                        entries.append(entry)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        # Writes the manifest last, so a snapshot only exists once all its chunks are stored.
+        manifest = {'id': snapshot_id, 'created': created.isoformat(), 'files': entries, **counters}
+        os.makedirs(os.path.dirname(self._manifest_path(snapshot_id)), exist_ok=True)
+        write_file_json(self._manifest_path(snapshot_id), manifest)
+        return manifest
+
+    def _find_files(self) -> dict:
+        """ Returns the paths, relative to the instance directory, of the databases, the settings & JSON files & the other files to snapshot. """
+
+        files = {'databases': [], 'consistent': [], 'other': []}
+        for directory, directory_names, file_names in os.walk(self.instance_path):
+            relative_directory = os.path.relpath(directory, self.instance_path)
+            directory_names[:] = sorted(name for name in directory_names
+                                        if not name.startswith(RESTORE_PREFIX) and os.path.normpath(os.path.join(relative_directory, name)) not in EXCLUDED_PATHS)
+
+            for name in sorted(file_names):
+                relative_path = os.path.normpath(os.path.join(relative_directory, name))
+                if relative_path in EXCLUDED_PATHS or name.endswith(EXCLUDED_SUFFIXES) or not os.path.isfile(os.path.join(directory, name)):
+                    continue
+                if name.endswith(DATABASE_SUFFIXES):
+                    files['databases'].append(relative_path)
+                elif name.endswith(CONSISTENT_SUFFIXES):
+                    files['consistent'].append(relative_path)
+                else:
+                    files['other'].append(relative_path)
+
+        return files
+
+    def _copy_database(self, source_path: str, copy_path: str) -> None:
+        """ Copies a live database with the online backup API, a number of pages at a time. """
+
+        pages = max(1, self.settings_manager.backup_pages_per_step)
+        step_sleep = self.settings_manager.backup_step_sleep
+
+        source = sqlite3.connect(source_path, timeout=self.settings_manager.database_busy_timeout / 1000)
+        try:
+            for attempt in range(MAX_BACKUP_RESTARTS + 1):
+                # Copies everything in one step on the last attempt, as writes between steps restart the copy.
+                last_attempt = attempt == MAX_BACKUP_RESTARTS
+                remaining = [None]
+
+                def progress(status: int, remaining_pages: int, total_pages: int) -> None:
+                    # A step which does not reduce the remaining pages means a write restarted the copy.
+                    if remaining[0] is not None and remaining_pages >= remaining[0] and remaining_pages:
+                        raise _BackupRestarted()
+                    remaining[0] = remaining_pages
+                    if step_sleep > 0 and remaining_pages:
+                        time.sleep(step_sleep)
+
+                copy = sqlite3.connect(copy_path)
+                try:
+                    source.backup(copy, pages=-1 if last_attempt else pages, progress=None if last_attempt else progress)
+                    return
+                except _BackupRestarted:
+                    logger.info('The backup of %s was restarted by a write.', source_path)
+                finally:
+                    copy.close()
+        finally:
+            source.close()
+
+    def _store_file(self, relative_path: str, kind: str, source: str | bytes, executor: object, stored: set, counters: dict) -> dict:
+        """ Stores the chunks of a file & returns its manifest entry, or `None` if it was deleted.
+
+        Params:
+            - relative_path (str) - The path of the file in the instance directory.
+            - kind (str) - `database` or `file`.
+            - source (str | bytes) - The path to read the file from, or its content.
+            - executor (ThreadPoolExecutor) - The pool the chunks are hashed & compressed in.
+            - stored (set) - The hashes of the stored chunks, updated with the new ones.
+            - counters (dict) - The snapshots byte & chunk counters. """
+
+        try:
+            mode = os.stat(os.path.join(self.instance_path, relative_path)).st_mode & 0o777
+            if isinstance(source, bytes):
+                size, chunks = len(source), (source[offset:offset + CHUNK_BYTES] for offset in range(0, len(source), CHUNK_BYTES))
+            else:
+                size, chunks = os.path.getsize(source), _read_chunks(source, os.path.getsize(source))
+        except FileNotFoundError:
+            return None
+
+        # Stores the chunks in small batches, which bounds the memory used by large files.
+        digests = []
+        batch = []
+        level = self.settings_manager.backup_compression_level
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) == WORKERS * 2:
+                digests += executor.map(lambda data: self._store_chunk(data, level, stored, counters), batch)
+                batch = []
+        digests += executor.map(lambda data: self._store_chunk(data, level, stored, counters), batch)
+
+        counters['bytes'] += size
+        return {'path': relative_path, 'kind': kind, 'size': size, 'mode': mode, 'chunks': digests}
+
+    def _store_chunk(self, data: bytes, level: int, stored: set, counters: dict) -> str:
+        """ Stores a chunk compressed under the hash of its content, unless it is already stored, & returns the hash. """
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in stored:
+            return digest
+
+        # Concurrent writes of the same chunk are harmless, as they write the same content atomically.
+        compressed = zlib.compress(data, level)
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, compressed)
+
+        with self._counters_lock:
+            stored.add(digest)
+            counters['stored_bytes'] += len(compressed)
+            counters['new_chunks'] += 1
+        return digest
+
+    def list_snapshots(self) -> list[dict]:
+        """ Returns the manifests of the snapshots, oldest first, without their file lists. """
+
+        return [_summary(read_file_json(self._manifest_path(snapshot_id), copy=False)) for snapshot_id in self._snapshot_ids()]
+
+    def _snapshot_ids(self) -> list[str]:
+        return sorted(name[:-len('.json')] for name in _list_directory(os.path.join(self.path, 'snapshots')) if name.endswith('.json'))
+
+    # Retention
+
+    def prune(self, retention: int = None) -> int:
+        """ Deletes the oldest snapshots beyond the retention & the chunks no remaining snapshot uses. Returns the number of snapshots deleted.
+
+        Params:
+            - retention (int) - The number of snapshots to keep. Defaults to the `retention` setting. """
+
+        with self._exclusive():
+            return self._prune(retention or self.settings_manager.backup_retention)
+
+    def _prune(self, retention: int) -> int:
+        snapshot_ids = self._snapshot_ids()
+        deleted = snapshot_ids[:max(0, len(snapshot_ids) - retention)]
+        if not deleted:
+            return 0
+
+        for snapshot_id in deleted:
+            os.remove(self._manifest_path(snapshot_id))
+
+        # Deletes the chunks which none of the remaining snapshots use.
+        used = set()
+        for snapshot_id in snapshot_ids[len(deleted):]:
+            for entry in read_file_json(self._manifest_path(snapshot_id), copy=False)['files']:
+                used.update(entry['chunks'])
+
+        objects_path = os.path.join(self.path, 'objects')
+        for prefix in _list_directory(objects_path):
+            for name in _list_directory(os.path.join(objects_path, prefix)):
+                if prefix + name not in used:
+                    os.remove(os.path.join(objects_path, prefix, name))
+
+        logger.info('Deleted %d snapshots beyond the retention of %d.', len(deleted), retention)
+        return len(deleted)
+
+    # Restoring
+
+    def restore(self, snapshot_id: str, instance_path: str = None) -> dict:
+        """ Restores a snapshot into the instance directory & returns its manifest, without its file list. Every chunk is read & verified before any file is replaced. Files which are not in the
+        snapshot are left in place. The server must not be running. Raises `SnapshotNotFound` or `SnapshotCorrupt`.
+
+        Params:
+            - snapshot_id (str) - The id of the snapshot.
+            - instance_path (str) - The directory to restore into. Defaults to the instance directory. """
+
+        target = instance_path or self.instance_path
+        with self._exclusive():
+            try:
+                manifest = read_file_json(self._manifest_path(snapshot_id), copy=False)
+            except FileNotFoundError:
+                raise SnapshotNotFound(f'There is no snapshot \'{snapshot_id}\' in {self.path}.') from None
+
+            # Writes every file next to its destination first, so a missing or corrupt chunk leaves the directory untouched.
+            os.makedirs(target, exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=RESTORE_PREFIX, dir=target)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(WORKERS, thread_name_prefix='restore') as executor:
+                    for index, entry in enumerate(manifest['files']):
+                        with open(os.path.join(staging, str(index)), 'wb') as file:
+                            for data in executor.map(self._load_chunk, entry['chunks']):
+                                file.write(data)
+                            file.flush()
+                            os.fsync(file.fileno())
+
+                        if os.path.getsize(os.path.join(staging, str(index))) != entry['size']:
+                            raise SnapshotCorrupt(f'{entry["path"]} in snapshot \'{snapshot_id}\' does not have its recorded size.')
+
+                # Moves the files into place. The write-ahead log of a database is removed first, as it belongs to the database being replaced.
+                for index, entry in enumerate(manifest['files']):
+                    path = os.path.join(target, entry['path'])
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if entry['kind'] == 'database':
+                        for suffix in ('-wal', '-shm', '-journal'):
+                            if os.path.exists(path + suffix):
+                                os.remove(path + suffix)
+
+                    os.chmod(os.path.join(staging, str(index)), entry['mode'])
+                    os.replace(os.path.join(staging, str(index)), path)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        logger.info('Restored snapshot %s into %s.', snapshot_id, target)
+        return _summary(manifest)
+
+    def _load_chunk(self, digest: str) -> bytes:
+        """ Returns the content of a stored chunk. Raises `SnapshotCorrupt` if it is missing or does not match its hash. """
+
+        try:
+            with open(self._object_path(digest), 'rb') as file:
+                data = zlib.decompress(file.read())
+        except (FileNotFoundError, zlib.error) as exception:
+            raise SnapshotCorrupt(f'Chunk {digest} cannot be read: {exception}.') from None
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise SnapshotCorrupt(f'Chunk {digest} does not match its hash.')
+        return data
+
+    def stats(self) -> dict:
+        """ Returns the managers statistics, reported in the metrics as the `backups` cache. """
+
+        size = len(self._snapshot_ids())
+        with self._counters_lock:
+            return {'size': size, 'runs': self.runs, 'errors': self.errors, 'last_seconds': self.last_seconds, 'last_stored_bytes': self.last_bytes}
+
+def _summary(manifest: dict) -> dict:
+    """ Returns a manifest without its file list. """
+
+    return {key: value for key, value in manifest.items() if key != 'files'}
+
+def _list_directory(path: str) -> list[str]:
+    """ Returns the names in a directory, or an empty list if it does not exist. """
+
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+def _read_file(path: str) -> bytes:
+    """ Returns the content of a file, or `None` if it was deleted. """
+
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+def _read_chunks(path: str, size: int) -> Iterator[bytes]:
+    """ Yields the chunks of the first `size` bytes of a file. """
+
+    with open(path, 'rb') as file:
+        while size > 0:
+            chunk = file.read(min(CHUNK_BYTES, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+
+def run_scheduled_backup() -> None:
+    """ Takes a snapshot. Run by the scheduler on the `schedule` of the `BACKUP` settings, see `schedule_backups()`. """
+
+    # Cancels the schedule instead if the setting was removed while the server was stopped, as start up only saves the schedule when one is set.
+    services = current_app.extensions['xenon']
+    if not services.settings_manager.backup_schedule:
+        schedule_backups(services.databases_manager, services.settings_manager.settings)
+        return
+
+    services.backup_manager.create_snapshot()
+
+def schedule_backups(databases_manager: object, settings: object) -> None:
+    """ Saves or cancels the persisted schedule which takes snapshots automatically, if the `schedule` setting changed. Called at start up when a schedule is set, whenever the settings are
+    reloaded, & by `run_scheduled_backup()` once the setting has been removed.
+
+    Params:
+        - databases_manager (DatabasesManager) - The databases manager holding the persisted schedules.
+        - settings (Settings) - The settings snapshot. """
+
+    trigger = f'cron:{settings.backup_schedule}' if settings.backup_schedule else None
+    row = databases_manager.load_schedule(SCHEDULE_ID)
+    if trigger is None:
+        if row is not None and not row.cancelled:
+            databases_manager.cancel_schedules([SCHEDULE_ID])
+    elif row is None or row.cancelled or row.trigger != trigger:
+        databases_manager.save_schedule({
+            'id': SCHEDULE_ID, 'trigger': trigger, 'timezone': '', 'target': f'{__name__}:{run_scheduled_backup.__name__}', 'arguments': json.dumps({'args': [], 'kwargs': {}}),
+            'owner': None, 'next_run': None
+        })
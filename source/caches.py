@@ -0,0 +1,264 @@
+""" In-process caches shared by the rest of the system. Every cache is bounded, thread safe & keeps hit/miss counters so that its effectiveness can be checked while the server is running.
+Each process has its own caches, so the data they hold is versioned by the `shared_generations` counters, which every process forked from the server sees. """
+
+# Import standard packages
+import collections
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+
+# Variables
+DEFAULT_SHARED_SLOTS = 4096
+
+class LRUCache():
+    """ A bounded least-recently-used cache with an optional time-to-live. When the cache is full, the entry used least recently is evicted. Entries older than the time-to-live are treated as
+    missing. Entries can be given a cost (for example their size in bytes), in which case the cache is also bounded by the total cost of its entries. Example:
+    ```python
+    from source.caches import LRUCache
+
+    cache = LRUCache(max_size=256, ttl=60)
+
+    user = cache.get_or_load(1, lambda: load_user_from_database(1))
+    cache.invalidate(1)
+    ```
+
+    Params:
+        - max_size (int) - The maximum number of entries kept in the cache.
+        - ttl (float) - The number of seconds an entry stays valid. If `None`, entries only leave the cache when evicted or invalidated.
+        - max_cost (int) - The maximum total cost of the entries kept in the cache. If `None`, the cache is only bounded by `max_size`. """
+
+    def __init__(self, max_size: int, ttl: float = None, max_cost: int = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_cost = max_cost
+
+        # The entries are stored as `key: (expires_at, value, cost)`. The lock guards the entries & the counters.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._cost = 0
+
+        # Bumped on every invalidation, so a value loaded while an invalidation happened is not stored.
+        self._generation = 0
+
+        # Counters reported by `stats()`.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _lookup(self, key: object) -> tuple:
+        """ Returns a tuple of whether the key was found & its value. Must be called with the lock held.
+
+        Params:
+            - key (object) - The key of the entry. """
+
+        # Checks if the entry exists & has not expired.
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expires_at, value, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            return False, None
+
+        # Marks the entry as the most recently used.
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _remove(self, key: object) -> None:
+        """ Removes an entry if it exists. Must be called with the lock held.
+
+        Params:
+            - key (object) - The key of the entry. """
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._cost -= entry[2]
+
+    def _store(self, key: object, value: object, cost: int = 1) -> None:
+        """ Stores a value & evicts the least recently used entries if the cache is over its size. Must be called with the lock held.
+
+        Params:
+            - key (object) - The key of the entry.
+            - value (object) - The value to store.
+            - cost (int) - The cost of the entry, counted against `max_cost`. """
+
+        # Does not store values which could never fit.
+        self._remove(key)
+        if self.max_cost is not None and cost > self.max_cost:
+            return
+
+        # Stores the value with its expiry time.
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (expires_at, value, cost)
+        self._cost += cost
+
+        # Evicts entries until the cache is within its limits.
+        self._evict()
+
+    def _evict(self) -> None:
+        """ Evicts the least recently used entries until the cache is within its size & cost. Must be called with the lock held. """
+
+        while len(self._entries) > self.max_size or (self.max_cost is not None and self._cost > self.max_cost):
+            _, (_, _, cost) = self._entries.popitem(last=False)
+            self._cost -= cost
+            self.evictions += 1
+
+    def get(self, key: object, default: object = None) -> object:
+        """ Returns the value stored under a key, or `default` if the key is missing or expired.
+
+        Params:
+            - key (object) - The key of the entry.
+            - default (object) - The value returned when the key is not cached. """
+
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key: object, value: object, cost: int = 1) -> None:
+        """ Stores a value under a key.
+
+        Params:
+            - key (object) - The key of the entry.
+            - value (object) - The value to store.
+            - cost (int) - The cost of the entry, counted against `max_cost`. """
+
+        with self._lock:
+            self._store(key, value, cost)
+
+    def get_or_load(self, key: object, loader: callable) -> object:
+        """ Returns the value stored under a key. If the key is not cached, `loader` is called & its result is stored, unless it is `None` or the cache was invalidated while loading.
+
+        Params:
+            - key (object) - The key of the entry.
+            - loader (callable) - Called without arguments to produce the value on a miss. """
+
+        # Returns the cached value if there is one.
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            generation = self._generation
+
+        # Loads the value outside of the lock so slow loaders do not block other readers.
+        value = loader()
+
+        # Stores the value only if nothing was invalidated while it was being loaded.
+        with self._lock:
+            if value is not None and generation == self._generation:
+                self._store(key, value)
+
+        return value
+
+    def invalidate(self, key: object) -> None:
+        """ Removes an entry from the cache.
+
+        Params:
+            - key (object) - The key of the entry. """
+
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._remove(key)
+
+    def clear(self) -> None:
+        """ Removes every entry from the cache. """
+
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._entries.clear()
+            self._cost = 0
+
+    def resize(self, max_size: int, ttl: float = None, max_cost: int = None) -> None:
+        """ Changes the size, time-to-live & cost limit of the cache. Entries are evicted straight away if the cache is now over its limits.
+
+        Params:
+            - max_size (int) - The maximum number of entries kept in the cache.
+            - ttl (float) - The number of seconds an entry stays valid.
+            - max_cost (int) - The maximum total cost of the entries kept in the cache. """
+
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self.max_cost = max_cost
+            self._evict()
+
+    def stats(self) -> dict:
+        """ Returns a dictionary of the caches counters & current size. """
+
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'cost': self._cost,
+                'max_cost': self.max_cost,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+class SharedGenerations():
+    """ Generation counters shared by the process which created them & every process forked from it afterwards, such as the workers of the production server in `/source/serving.py`. A
+    process which commits a change bumps the counter of the changed data, & every process reads the counter before loading a copy into its caches & compares it again before serving the
+    copy, so copies changed by any process are dropped straight away without sending messages between the processes. Example:
+    ```python
+    from source.caches import shared_generations
+
+    generation = shared_generations.get(('user', 1)) # Read before loading the user.
+    ...
+    shared_generations.bump(('user', 1)) # Called after the change to the user is committed.
+    ```
+
+    Keys are hashed into a fixed number of counters held in an anonymous shared memory map. Two keys may share a counter, which only ever drops a copy that was still valid. Bumps are made under
+    a lock shared by the processes, so no bump is lost; reads take no lock.
+
+    Params:
+        - slots (int) - The number of counters. """
+
+    def __init__(self, slots: int = DEFAULT_SHARED_SLOTS) -> None:
+        self.slots = slots
+        self._memory = mmap.mmap(-1, slots * 8)
+        self._lock = multiprocessing.Lock()
+
+    def _offset(self, key: object) -> int:
+        """ Returns the offset of the counter of a key. The hash is computed with `crc32`, so it is the same in every process.
+
+        Params:
+            - key (object) - The key of the counter. Hashed through its `repr()`. """
+
+        return zlib.crc32(repr(key).encode()) % self.slots * 8
+
+    def get(self, key: object) -> int:
+        """ Returns the current generation of a key.
+
+        Params:
+            - key (object) - The key of the counter. """
+
+        return struct.unpack_from('Q', self._memory, self._offset(key))[0]
+
+    def bump(self, *keys: object) -> None:
+        """ Bumps the generation of some keys, retiring the copies loaded under their previous generations in every process. Must be called after the change is committed.
+
+        Params:
+            - keys (object) - The keys of the changed data. """
+
+        with self._lock:
+            for key in keys:
+                offset = self._offset(key)
+                struct.pack_into('Q', self._memory, offset, (struct.unpack_from('Q', self._memory, offset)[0] + 1) % 2 ** 64)
+
+shared_generations = SharedGenerations()
@@ -1,65 +1,598 @@
-""" This is where all the configuration of the system occurs. All system settings are kept in a config file in the `instance` directory. (`/instance/settings.ini`). If the file does not exist, the 
-settings manager will enter into a setup sequence, which automatically enters default settings for the system. This may block some features but can be modified in the servers dashboard. COMING SOON! """
+""" This is where all the configuration of the system occurs. All system settings are kept in a config file in the `instance` directory. (`/instance/settings.ini`). If the file does not exist, the
+settings manager will enter into a setup sequence, which automatically enters default settings for the system. This may block some features but can be modified in the servers dashboard. COMING SOON!
+
+The settings are read into an immutable `Settings` snapshot. When the file changes, a new snapshot is built, validated & swapped in as a whole, so readers never see half of an update & never need a
+lock. """
 
 # Import internal packages
 from source.paths import Paths
 from source.paths import directory_exists, create_directory
-from source.paths import file_exists, create_file
+from source.paths import file_exists, write_file_atomic
+from source.exceptions import InvalidSettingValue, InvalidSchedule, InvalidHashMethod
+from source.hashing import canonical_method
+from source.metrics import parse_networks
+from source.scheduler import parse_trigger
+
+import source.helpers as helpers
 
 # Import standard packages
 import configparser
+import contextlib
+import ctypes
+import ctypes.util
+import io
+import logging
+import os
+import select
+import threading
+import zoneinfo
+from typing import Iterator, NamedTuple
 
 # Variables
 DEFAULT_HOST = '0.0.0.0'
 DEFAULT_PORT = 5000
-DEFAULT_DEBUG = True #! Change to False on release
+DEFAULT_DEBUG = False
+DEFAULT_MODE = 'production' # `development` runs the flask development server, `production` runs the pre-forking server in `source/serving.py`.
+DEFAULT_WORKERS = 2 # Worker processes in production mode.
+DEFAULT_THREADS = 8 # Request threads per worker process in production mode.
+DEFAULT_KEEPALIVE = 5.0 # Seconds an idle connection is kept open in production mode.
+DEFAULT_GRACEFUL_TIMEOUT = 30.0 # Seconds a stopping worker waits for its in-flight requests in production mode.
+
+DEFAULT_DATABASE_POOL_SIZE = 5
+DEFAULT_DATABASE_MAX_OVERFLOW = 10
+DEFAULT_DATABASE_POOL_TIMEOUT = 30
+DEFAULT_DATABASE_BUSY_TIMEOUT = 5000 # Milliseconds a connection waits on a locked database before failing.
+DEFAULT_DATABASE_SYNCHRONOUS = 'NORMAL' # `NORMAL` is durable across application crashes when in WAL mode.
+DEFAULT_DATABASE_CACHE_SIZE = -16000 # Negative values are in KiB, so this is a 16 MiB page cache per connection.
+DEFAULT_DATABASE_MMAP_SIZE = 134217728 # 128 MiB.
+
+DEFAULT_CACHE_USERS_SIZE = 1024
+DEFAULT_CACHE_USERS_TTL = 300 # Seconds.
+DEFAULT_CACHE_JSON_ENTRIES = 1024
+DEFAULT_CACHE_JSON_BYTES = 33554432 # 32 MiB.
+DEFAULT_CACHE_JSON_WRITE_DELAY = 0.5 # Seconds.
+DEFAULT_CACHE_TEMPLATE_BYTECODE = True # Keeps compiled templates in `/instance/templates_cache`, so workers do not compile them again at start up.
+DEFAULT_CACHE_FRAGMENT_ENTRIES = 512
+DEFAULT_CACHE_FRAGMENT_BYTES = 8388608 # 8 MiB of rendered text.
+DEFAULT_CACHE_FRAGMENT_TTL = 60 # Seconds.
+
+DEFAULT_HASHING_WORKERS = 2
+DEFAULT_HASHING_MAX_PENDING = 64
+DEFAULT_HASHING_QUEUE_TIMEOUT = 5 # Seconds.
+DEFAULT_HASHING_METHOD = 'pbkdf2:sha256:600000'
+
+DEFAULT_METRICS_ENABLED = True
+DEFAULT_METRICS_N_PLUS_ONE_THRESHOLD = 10 # Times one statement must run in a request to be reported as an N+1 query pattern.
+DEFAULT_METRICS_ALLOWED_ADDRESSES = '127.0.0.1, ::1' # Addresses & networks which may read `/metrics`, separated by commas.
+
+DEFAULT_ASSETS_BUILD_ON_STARTUP = True # Builds the fingerprinted static assets when the app is created, see `/source/assets.py`.
+
+DEFAULT_APPS_IDLE_TIMEOUT = 600.0 # Seconds without a request before an app is unloaded, see `/source/apps.py`. `0` keeps apps loaded.
+DEFAULT_APPS_MAX_OPEN_DATABASES = 16 # App databases kept open at once, see `/source/engines.py`.
+DEFAULT_APPS_DATABASE_POOL_SIZE = 2 # Connections kept open per app database.
+DEFAULT_APPS_DATABASE_IDLE_TIMEOUT = 300.0 # Seconds without a query before an app database is closed. `0` keeps them open.
+
+DEFAULT_EVENTS_QUEUE_SIZE = 1024 # Events waiting per event bus subscription, see `/source/events.py`.
+DEFAULT_EVENTS_OVERFLOW = 'drop_oldest' # What a full subscription queue does with a new event: `drop_oldest`, `drop_newest` or `block` the publisher.
+DEFAULT_EVENTS_PUBLISH_TIMEOUT = 5.0 # Seconds a synchronous publisher waits for `block` subscriptions.
+
+DEFAULT_SCHEDULER_WORKERS = 4 # Threads running scheduled jobs, see `/source/scheduler.py`.
+DEFAULT_SCHEDULER_MAX_PENDING = 64 # Due jobs which can wait for a thread before further runs are skipped.
+DEFAULT_SCHEDULER_MISFIRE_GRACE = 300.0 # Seconds a persisted job missed while the server was down is still run after a restart.
+DEFAULT_SCHEDULER_TIMEZONE = '' # The IANA timezone cron triggers are evaluated in. Empty for the systems local timezone.
+
+DEFAULT_BACKUP_PATH = '' # The directory snapshots are stored in. Empty for the `/backups` directory.
+DEFAULT_BACKUP_SCHEDULE = '' # A cron expression of when snapshots are taken automatically, see `/source/scheduler.py`. Empty to disable them.
+DEFAULT_BACKUP_RETENTION = 7 # Snapshots kept. Older snapshots are deleted after each new one.
+DEFAULT_BACKUP_PAGES_PER_STEP = 1024 # Database pages copied per step of an online backup.
+DEFAULT_BACKUP_STEP_SLEEP = 0.005 # Seconds an online backup pauses between steps, so requests keep the disk & the database.
+DEFAULT_BACKUP_COMPRESSION_LEVEL = 6 # The zlib level chunks are compressed with, from 0 (none) to 9 (smallest).
+
+DEFAULT_WATCH_INTERVAL = 1.0 # Seconds between checks when inotify is not available.
+
+SQLITE_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+SERVER_MODES = ('development', 'production')
+EVENTS_OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+# The default value of every setting, by section & key. Each setting is available on `Settings` as `<section>_<key>`.
+DEFAULTS = {
+    'SERVER': {
+        'host': DEFAULT_HOST,
+        'port': DEFAULT_PORT,
+        'debug': DEFAULT_DEBUG,
+        'mode': DEFAULT_MODE,
+        'workers': DEFAULT_WORKERS,
+        'threads': DEFAULT_THREADS,
+        'keepalive': DEFAULT_KEEPALIVE,
+        'graceful_timeout': DEFAULT_GRACEFUL_TIMEOUT
+    },
+    'DATABASE': {
+        'pool_size': DEFAULT_DATABASE_POOL_SIZE,
+        'max_overflow': DEFAULT_DATABASE_MAX_OVERFLOW,
+        'pool_timeout': DEFAULT_DATABASE_POOL_TIMEOUT,
+        'busy_timeout': DEFAULT_DATABASE_BUSY_TIMEOUT,
+        'synchronous': DEFAULT_DATABASE_SYNCHRONOUS,
+        'cache_size': DEFAULT_DATABASE_CACHE_SIZE,
+        'mmap_size': DEFAULT_DATABASE_MMAP_SIZE
+    },
+    'CACHE': {
+        'users_size': DEFAULT_CACHE_USERS_SIZE,
+        'users_ttl': DEFAULT_CACHE_USERS_TTL,
+        'json_entries': DEFAULT_CACHE_JSON_ENTRIES,
+        'json_bytes': DEFAULT_CACHE_JSON_BYTES,
+        'json_write_delay': DEFAULT_CACHE_JSON_WRITE_DELAY,
+        'template_bytecode': DEFAULT_CACHE_TEMPLATE_BYTECODE,
+        'fragment_entries': DEFAULT_CACHE_FRAGMENT_ENTRIES,
+        'fragment_bytes': DEFAULT_CACHE_FRAGMENT_BYTES,
+        'fragment_ttl': DEFAULT_CACHE_FRAGMENT_TTL
+    },
+    'HASHING': {
+        'workers': DEFAULT_HASHING_WORKERS,
+        'max_pending': DEFAULT_HASHING_MAX_PENDING,
+        'queue_timeout': DEFAULT_HASHING_QUEUE_TIMEOUT,
+        'method': DEFAULT_HASHING_METHOD
+    },
+    'METRICS': {
+        'enabled': DEFAULT_METRICS_ENABLED,
+        'n_plus_one_threshold': DEFAULT_METRICS_N_PLUS_ONE_THRESHOLD,
+        'allowed_addresses': DEFAULT_METRICS_ALLOWED_ADDRESSES
+    },
+    'ASSETS': {
+        'build_on_startup': DEFAULT_ASSETS_BUILD_ON_STARTUP
+    },
+    'APPS': {
+        'idle_timeout': DEFAULT_APPS_IDLE_TIMEOUT,
+        'max_open_databases': DEFAULT_APPS_MAX_OPEN_DATABASES,
+        'database_pool_size': DEFAULT_APPS_DATABASE_POOL_SIZE,
+        'database_idle_timeout': DEFAULT_APPS_DATABASE_IDLE_TIMEOUT
+    },
+    'EVENTS': {
+        'queue_size': DEFAULT_EVENTS_QUEUE_SIZE,
+        'overflow': DEFAULT_EVENTS_OVERFLOW,
+        'publish_timeout': DEFAULT_EVENTS_PUBLISH_TIMEOUT
+    },
+    'SCHEDULER': {
+        'workers': DEFAULT_SCHEDULER_WORKERS,
+        'max_pending': DEFAULT_SCHEDULER_MAX_PENDING,
+        'misfire_grace': DEFAULT_SCHEDULER_MISFIRE_GRACE,
+        'timezone': DEFAULT_SCHEDULER_TIMEZONE
+    },
+    'BACKUP': {
+        'path': DEFAULT_BACKUP_PATH,
+        'schedule': DEFAULT_BACKUP_SCHEDULE,
+        'retention': DEFAULT_BACKUP_RETENTION,
+        'pages_per_step': DEFAULT_BACKUP_PAGES_PER_STEP,
+        'step_sleep': DEFAULT_BACKUP_STEP_SLEEP,
+        'compression_level': DEFAULT_BACKUP_COMPRESSION_LEVEL
+    }
+}
+
+# The settings which only accept certain values.
+CHOICES = {
+    'server_mode': SERVER_MODES,
+    'database_synchronous': SQLITE_SYNCHRONOUS_MODES,
+    'events_overflow': EVENTS_OVERFLOW_POLICIES
+}
+
+# Inotify constants, from `<sys/inotify.h>`.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+logger = logging.getLogger(__name__)
+
+class Settings(NamedTuple):
+    """ An immutable snapshot of every system setting. Snapshots are never modified, a changed settings file produces a new snapshot. Should be accessed through `SettingsManager.settings`, or
+    directly as attributes of the `SettingsManager`. """
+
+    server_host: str
+    server_port: int
+    server_debug: bool
+    server_mode: str
+    server_workers: int
+    server_threads: int
+    server_keepalive: float
+    server_graceful_timeout: float
+
+    database_pool_size: int
+    database_max_overflow: int
+    database_pool_timeout: int
+    database_busy_timeout: int
+    database_synchronous: str
+    database_cache_size: int
+    database_mmap_size: int
+
+    cache_users_size: int
+    cache_users_ttl: float
+    cache_json_entries: int
+    cache_json_bytes: int
+    cache_json_write_delay: float
+    cache_template_bytecode: bool
+    cache_fragment_entries: int
+    cache_fragment_bytes: int
+    cache_fragment_ttl: float
+
+    hashing_workers: int
+    hashing_max_pending: int
+    hashing_queue_timeout: float
+    hashing_method: str
+
+    metrics_enabled: bool
+    metrics_n_plus_one_threshold: int
+    metrics_allowed_addresses: str
+
+    assets_build_on_startup: bool
+
+    apps_idle_timeout: float
+    apps_max_open_databases: int
+    apps_database_pool_size: int
+    apps_database_idle_timeout: float
+
+    events_queue_size: int
+    events_overflow: str
+    events_publish_timeout: float
+
+    scheduler_workers: int
+    scheduler_max_pending: int
+    scheduler_misfire_grace: float
+    scheduler_timezone: str
+
+    backup_path: str
+    backup_schedule: str
+    backup_retention: int
+    backup_pages_per_step: int
+    backup_step_sleep: float
+    backup_compression_level: int
+
+    @classmethod
+    def from_config(cls, cp: configparser.ConfigParser) -> 'Settings':
+        """ Returns a snapshot of the settings held by a config parser. Missing settings use their default values. Raises `InvalidSettingValue` if a setting has the wrong type or is not one of
+        its allowed values.
+
+        Params:
+            - cp (ConfigParser) - The config parser which has read the settings file. """
+
+        # Reads every setting with the getter matching its type.
+        getters = {str: cp.get, int: cp.getint, float: cp.getfloat, bool: cp.getboolean}
+        values = {}
+        for section_name, section_defaults in DEFAULTS.items():
+            for key, default in section_defaults.items():
+                name = f'{section_name.lower()}_{key}'
+                try:
+                    values[name] = getters[cls.__annotations__[name]](section_name, key, fallback=default)
+                except ValueError as exception:
+                    raise InvalidSettingValue(f'Setting \'{key}\' in section \'{section_name}\' is invalid: {exception}.') from None
+
+        # Normalizes the values which are formatted into sqlite pragmas & checks the values which are limited to certain choices.
+        values['server_mode'] = values['server_mode'].lower()
+        values['database_synchronous'] = values['database_synchronous'].upper()
+        values['events_overflow'] = values['events_overflow'].lower()
+        for name, choices in CHOICES.items():
+            if values[name] not in choices:
+                raise InvalidSettingValue(f'Setting \'{name}\' must be one of {", ".join(choices)}.')
+
+        # Checks the hashing method is one werkzeug can make hashes with.
+        try:
+            canonical_method(values['hashing_method'])
+        except InvalidHashMethod as exception:
+            raise InvalidSettingValue(f'Setting \'method\' in section \'HASHING\' is invalid: {exception}') from None
+
+        # Checks the addresses allowed to read the metrics are valid addresses or networks.
+        try:
+            parse_networks(values['metrics_allowed_addresses'])
+        except ValueError as exception:
+            raise InvalidSettingValue(f'Setting \'allowed_addresses\' in section \'METRICS\' is invalid: {exception}.') from None
+
+        # Checks the timezone exists, so schedules are not evaluated in a timezone which cannot be loaded.
+        try:
+            helpers.get_timezone(values['scheduler_timezone'])
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            raise InvalidSettingValue(f'Setting \'timezone\' in section \'SCHEDULER\' is not a known timezone: {values["scheduler_timezone"]}.') from None
+
+        # Checks the backup schedule is a valid cron expression & the backup limits are in range.
+        if values['backup_schedule']:
+            try:
+                parse_trigger(f'cron:{values["backup_schedule"]}')
+            except InvalidSchedule as exception:
+                raise InvalidSettingValue(f'Setting \'schedule\' in section \'BACKUP\' is invalid: {exception}') from None
+        if not 0 <= values['backup_compression_level'] <= 9:
+            raise InvalidSettingValue('Setting \'compression_level\' in section \'BACKUP\' must be between 0 & 9.')
+        if values['backup_retention'] < 1 or values['backup_pages_per_step'] < 1:
+            raise InvalidSettingValue('Settings \'retention\' & \'pages_per_step\' in section \'BACKUP\' must be at least 1.')
+
+        # Checks the fragment cache limits are in range. A size of `0` turns the cache off.
+        if values['cache_fragment_entries'] < 0 or values['cache_fragment_bytes'] < 0:
+            raise InvalidSettingValue('Settings \'fragment_entries\' & \'fragment_bytes\' in section \'CACHE\' must not be negative.')
+        if values['cache_fragment_ttl'] <= 0:
+            raise InvalidSettingValue('Setting \'fragment_ttl\' in section \'CACHE\' must be above 0.')
+
+        # Returns the snapshot.
+        return cls(**values)
 
 class SettingsManager():
-    """ Handles all the system settings for Xenon. All configurable information is run strictly through this object. It will store all information in the `/instance/settings.ini` file. If this file 
+    """ Handles all the system settings for Xenon. All configurable information is run strictly through this object. It will store all information in the `/instance/settings.ini` file. If this file
     does not exist, then the settings manager will automatically create it & format the file to default values.
-    
-    NOTE: The manager auto creating the settings file may block several certain features; this can be modified in the servers dashboard. COMING SOON! """
 
-    def __init__(self) -> None:
-        # Creates the `ConfigParser` instance.
-        self.cp = configparser.ConfigParser()
+    The current settings are held in `settings`, an immutable `Settings` snapshot. Every setting can also be read as an attribute of the manager itself (for example `server_port`). Neither takes a
+    lock. Call `start_watching()` to reload the file whenever it changes, & `add_listener()` to be told when a reload changes a setting. Example:
+    ```python
+    from source.config import SettingsManager
+
+    settings_manager = SettingsManager()
+    settings_manager.add_listener(lambda old, new: print(f'Port changed from {old.server_port} to {new.server_port}.'))
+    settings_manager.start_watching()
+
+    settings_manager.update('SERVER', {'port': 5001})
+    ```
+
+    NOTE: The manager auto creating the settings file may block several certain features; this can be modified in the servers dashboard. COMING SOON!
+
+    Params:
+        - path (str) - The path of the settings file. Defaults to the `/instance/system.ini` file. """
+
+    def __init__(self, path: str = Paths.SETTINGS_ABS_PATH) -> None:
+        self.path = path
+
+        # The listeners called after a reload & the watcher thread. The lock serialises reloads with `update()`, so an older snapshot is never swapped in after a newer one. It is reentrant, as
+        # `update()` reloads while holding it.
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._watcher = None
+        self._signature = None
 
         # Checks if the `/instance` directory exists, if not it is created.
-        if not directory_exists(Paths.INSTANCE_ABS_PATH):
-            create_directory(Paths.INSTANCE_ABS_PATH)
+        directory = os.path.dirname(self.path)
+        if not directory_exists(directory):
+            create_directory(directory)
 
         # Checks if the `/instance/system.ini` file exists, it calls the format function.
-        if not file_exists(Paths.SETTINGS_ABS_PATH):
+        if not file_exists(self.path):
             self.format()
-        
+
         # Calls the `deploy_values()` function.
         self.deploy_values()
 
+    def __getattr__(self, name: str) -> object:
+        # Only called for attributes the manager does not have itself, so settings are read straight from the current snapshot.
+        try:
+            return getattr(self.__dict__['settings'], name)
+        except (KeyError, AttributeError):
+            raise AttributeError(f'\'SettingsManager\' has no attribute \'{name}\'.') from None
+
     def format(self) -> None:
         """ Creates & formats the settings config file to it's default values. """
 
-        # Creates the `/instance/system.ini` file.
-        create_file(Paths.SETTINGS_ABS_PATH)
-
-        # Creates the `SERVER` section in the `system.ini` file.
-        section_name = 'SERVER'
-        self.cp.add_section(section_name)
-
-        # Sets the host, port & debug mode.
-        self.cp.set(section_name, 'host', str(DEFAULT_HOST))
-        self.cp.set(section_name, 'port', str(DEFAULT_PORT))
-        self.cp.set(section_name, 'debug', str(DEFAULT_DEBUG))
+        # Creates a section for each group of settings & sets them to their default values.
+        cp = configparser.ConfigParser()
+        for section_name, section_defaults in DEFAULTS.items():
+            cp.add_section(section_name)
+            for key, default in section_defaults.items():
+                cp.set(section_name, key, str(default))
 
         # Writes to the `/instance/system.ini` file all the config parser data.
-        with open(Paths.SETTINGS_ABS_PATH, 'w') as f:
-            self.cp.write(f)
+        self._write(cp)
 
     def deploy_values(self) -> None:
-        """ Deploys the values stored in the settings config file. These values can now be accessed as properties. """
-
-        # Deploys the information stored under the `SERVER` section as instance properties.
-        section_name = 'SERVER'
-        self.cp.read(Paths.SETTINGS_ABS_PATH)
-        self.server_host = self.cp.get(section_name, 'host')
-        self.server_port = self.cp.getint(section_name, 'port')
-        self.server_debug = self.cp.getboolean(section_name, 'debug')
\ No newline at end of file
+        """ Deploys the values stored in the settings config file. These values can now be accessed as properties. Raises `InvalidSettingValue` if the file holds an invalid value. """
+
+        # Reads the file & swaps in the new snapshot.
+        with self._lock:
+            self._signature = self._file_signature()
+            self.settings = self._read()
+
+    def _read(self) -> Settings:
+        """ Returns a snapshot of the settings currently in the settings file. """
+
+        cp = configparser.ConfigParser()
+        cp.read(self.path)
+        return Settings.from_config(cp)
+
+    def _write(self, cp: configparser.ConfigParser) -> None:
+        """ Writes a config parsers data to the settings file atomically, so the watcher never reads a partly written file.
+
+        Params:
+            - cp (ConfigParser) - The config parser holding the settings to write. """
+
+        buffer = io.StringIO()
+        cp.write(buffer)
+        write_file_atomic(self.path, buffer.getvalue())
+
+    def _file_signature(self) -> tuple:
+        """ Returns a tuple which changes whenever the settings file is modified or replaced, or `None` if it does not exist. """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def reload(self) -> bool:
+        """ Reads the settings file again. If it is valid & any setting changed, the new snapshot is swapped in & the listeners are called. If it is invalid, the current snapshot is kept. Returns
+        a bool based on whether the settings changed. The file is read, swapped in & its listeners notified under the managers lock, so reloads & updates are applied in the order they were
+        written. """
+
+        with self._lock:
+            # Reads & validates the file, keeping the current snapshot if it is invalid.
+            self._signature = self._file_signature()
+            try:
+                settings = self._read()
+            except (configparser.Error, InvalidSettingValue) as exception:
+                logger.error('Keeping the current settings, %s is invalid: %s', self.path, exception)
+                return False
+
+            # Swaps in the snapshot if anything changed.
+            old_settings = self.settings
+            if settings == old_settings:
+                return False
+
+            self.settings = settings
+
+            # Notifies the listeners. A failing listener does not stop the others.
+            for listener in list(self._listeners):
+                try:
+                    listener(old_settings, settings)
+                except Exception:
+                    logger.exception('Settings listener %r failed.', listener)
+
+            return True
+
+    def add_listener(self, listener: callable) -> callable:
+        """ Registers a function which is called with the old & new `Settings` snapshots whenever a reload changes a setting. Returns the function, so this can be used as a decorator.
+
+        Params:
+            - listener (callable) - The function to call. """
+
+        self._listeners.append(listener)
+        return listener
+
+    def remove_listener(self, listener: callable) -> None:
+        """ Unregisters a function registered with `add_listener()`.
+
+        Params:
+            - listener (callable) - The function to remove. """
+
+        self._listeners.remove(listener)
+
+    def update(self, section_name: str, values: dict) -> None:
+        """ Changes settings in the settings file & reloads it. The file is rewritten atomically. Raises `InvalidSettingValue` (& leaves the file untouched) if any of the new values are invalid.
+
+        Params:
+            - section_name (str) - The section the settings are in. For example `SERVER`.
+            - values (dict) - The keys & new values of the settings. """
+
+        with self._lock:
+            # Applies the new values to the current contents of the file.
+            cp = configparser.ConfigParser()
+            cp.read(self.path)
+            if not cp.has_section(section_name):
+                cp.add_section(section_name)
+            for key, value in values.items():
+                cp.set(section_name, key, str(value))
+
+            # Validates the new values before anything is written.
+            Settings.from_config(cp)
+
+            # Writes the file & reloads it.
+            self._write(cp)
+            self.reload()
+
+    @contextlib.contextmanager
+    def hold_writes(self) -> Iterator[None]:
+        """ A context manager which holds back `update()` & reloads while its block runs, so the settings file can be read at a single point in time, for example by a backup. """
+
+        with self._lock:
+            yield
+
+    def start_watching(self, interval: float = DEFAULT_WATCH_INTERVAL) -> None:
+        """ Starts a background thread which reloads the settings file whenever it changes. Inotify is used where it is available, otherwise the file is checked every `interval` seconds.
+
+        Params:
+            - interval (float) - The number of seconds between checks when inotify is not available. """
+
+        if self._watcher is None:
+            self._watcher = SettingsWatcher(self, interval)
+            self._watcher.start()
+
+    def stop_watching(self) -> None:
+        """ Stops the background thread started by `start_watching()`. """
+
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def reset_after_fork(self) -> None:
+        """ Resets the state inherited from the parent process. The parents watcher thread did not survive the fork, so it is forgotten & its inotify file descriptor is closed, letting the
+        child start its own watcher. The lock is replaced, as another thread of the parent may have held it during the fork. """
+
+        if self._watcher is not None:
+            if self._watcher._inotify_fd is not None:
+                os.close(self._watcher._inotify_fd)
+            self._watcher = None
+        self._lock = threading.RLock()
+
+    def _check_for_changes(self) -> None:
+        """ Reloads the settings file if it has been modified since it was last read. Called by the watcher. """
+
+        if self._file_signature() != self._signature:
+            self.reload()
+
+class SettingsWatcher(threading.Thread):
+    """ A daemon thread which calls `SettingsManager._check_for_changes()` whenever the settings file may have changed. On Linux it sleeps on inotify events for the settings directory, elsewhere it
+    polls every `interval` seconds. Should be created through `SettingsManager.start_watching()`.
+
+    Params:
+        - settings_manager (SettingsManager) - The settings manager to reload.
+        - interval (float) - The number of seconds between checks. When using inotify, this is only how often the thread checks if it has been stopped. """
+
+    def __init__(self, settings_manager: SettingsManager, interval: float) -> None:
+        super().__init__(name='settings-watcher', daemon=True)
+        self.settings_manager = settings_manager
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._inotify_fd = self._open_inotify(os.path.dirname(settings_manager.path))
+
+    @staticmethod
+    def _open_inotify(directory: str) -> int:
+        """ Returns an inotify file descriptor watching a directory for files being written or replaced, or `None` if inotify is not available.
+
+        Params:
+            - directory (str) - The directory to watch. """
+
+        # Loads inotify from the C library.
+        library_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(library_name, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError, TypeError):
+            return None
+
+        # Creates the inotify instance & watches the directory.
+        fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+
+        if inotify_add_watch(fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) < 0:
+            os.close(fd)
+            return None
+
+        return fd
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            # Waits for an inotify event, or for the interval to pass.
+            if self._inotify_fd is not None:
+                readable, _, _ = select.select([self._inotify_fd], [], [], self.interval)
+                if readable:
+                    self._drain_inotify()
+            else:
+                self._stopped.wait(self.interval)
+
+            # Reloads the settings if the file changed.
+            if not self._stopped.is_set():
+                try:
+                    self.settings_manager._check_for_changes()
+                except Exception:
+                    logger.exception('Failed to reload the settings.')
+
+        # Closes the inotify file descriptor.
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+
+    def _drain_inotify(self) -> None:
+        """ Reads & discards the pending inotify events. Which file changed does not matter, as `_check_for_changes()` compares the settings files signature. """
+
+        try:
+            while os.read(self._inotify_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def stop(self) -> None:
+        """ Stops the thread & waits for it to finish. """
+
+        self._stopped.set()
+        self.join()
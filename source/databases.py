@@ -5,50 +5,466 @@ NOTE: Only the system tables are modeled in this file. All application database
 # Import internal packages
 from source.paths import Paths
 from source.exceptions import ProfileTypeStillActive
+from source.caches import LRUCache, shared_generations
+from source.hashing import password_hasher
+from source.metrics import metrics
+from source.rendering import fragment_cache
+from source.engines import create_sqlite_engine
 
 import source.helpers as helpers
 
+# Import standard packages
+import contextlib
+import threading
+import time
+from typing import Iterator
+
 # Import external packages
-from sqlalchemy import create_engine, Column
-from sqlalchemy.types import String, Integer, DateTime, Date
-from sqlalchemy.orm import sessionmaker, declarative_base
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, select, insert, update, delete, func, text, Column, ForeignKey
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.types import String, Text, Integer, DateTime, Date, Boolean
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base, object_session
 from flask_login import UserMixin
 
 # Variables
 base = declarative_base()
 
+SQLITE_MAX_VARIABLES = 500 # The number of bound parameters used per `IN` clause, kept below sqlites limit.
+
+# Triggers which keep `ProfileTypes.user_count` up to date whenever a user is added, deleted or assigned a different profile type, including through bulk statements.
+USER_COUNT_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS users_profile_type_insert AFTER INSERT ON users WHEN NEW.profile_type IS NOT NULL BEGIN
+        UPDATE profile_types SET user_count = user_count + 1 WHERE id = NEW.profile_type;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_profile_type_delete AFTER DELETE ON users WHEN OLD.profile_type IS NOT NULL BEGIN
+        UPDATE profile_types SET user_count = user_count - 1 WHERE id = OLD.profile_type;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_profile_type_update AFTER UPDATE OF profile_type ON users WHEN OLD.profile_type IS NOT NEW.profile_type BEGIN
+        UPDATE profile_types SET user_count = user_count - 1 WHERE id = OLD.profile_type;
+        UPDATE profile_types SET user_count = user_count + 1 WHERE id = NEW.profile_type;
+    END"""
+)
+
 class DatabasesManager():
-    """ In charge of the all the tables used for system functionality. Upon initialization (this should be done in the `/source/server.py`), the engine, session maker & all tables are created & 
+    """ In charge of the all the tables used for system functionality. Upon initialization (this should be done in the `/source/server.py`), the engines, session makers & all tables are created & 
     formatted in the `/instance/xenon.db` database file.
+
+    The database is opened in WAL mode so that reads never wait on a write. Reads & writes are sent through separate paths:
+        - `session` - A thread scoped session bound to the pooled read engine. Each request thread gets its own session, which is removed at the end of the request by `remove_sessions()`.
+        - `write_session` - A thread scoped session bound to the write engine. The write engine holds a single connection, so writers queue on the pool rather than failing with 'database is 
+        locked'. All writes should go through `add_row()` & `delete_row()`.
+
+    The pool sizes & sqlite pragmas are configured in the `DATABASE` section of the `/instance/system.ini` file.
+
+    Users loaded through `load_user()` are served from `users_cache`, which holds read-only `UserSnapshot` copies. Entries are invalidated whenever a `Users` row written through either session is
+    committed. Each worker process has its own cache, so every commit also bumps the users counter in `shared_generations` & a cached snapshot is only served while the counters it was loaded under
+    are unchanged, which retires users changed by any process straight away. Every write also retires the cached template fragments rendered from the written tables, see `/source/rendering.py`.
      
     To query any database, you must use `session.query(<TABLE>)`. Example: To query from the `Users` table, you write the following:
     ```python
     from source.databases import DatabasesManager, Users
 
-    databases_manager = DatabasesManager()
+    databases_manager = DatabasesManager(settings_manager)
 
     found_user = databases_manager.session.query(Users).filter_by(id=1).first() # Returns the first row in which `id=1`.
     found_user = databases_manager.session.query(Users).filter_by(profile_type=1) # Returns a list of all rows where `profile_type=1`.
-    ``` """
-    def __init__(self) -> None:
-        # Create the database engine.
-        db_engine = create_engine(Paths.DB_ABS_PATH, echo=False)
+    ``` 
+    
+    Params:
+        - settings_manager (SettingsManager) - The settings manager which holds the pool sizes & sqlite pragmas.
+        - db_path (str) - The database url of the system database. Defaults to the `/instance/xenon.db` database file. """
+
+    def __init__(self, settings_manager: object, db_path: str = Paths.DB_ABS_PATH) -> None:
+        self.settings_manager = settings_manager
+        self.db_path = db_path
+
+        # Create the database engines. The read engine is pooled, the write engine only ever holds one connection.
+        self._engine_settings = self._get_engine_settings(self.settings_manager.settings)
+        self.read_engine = self._create_engine('read', self.settings_manager.database_pool_size, self.settings_manager.database_max_overflow)
+        self.write_engine = self._create_engine('write', 1, 0)
+
+        # Create all the tables & the `/instance/xenon.db` file, then bring tables made by older versions up to date.
+        base.metadata.create_all(bind=self.write_engine)
+        self._upgrade_schema()
+
+        # Initialize the thread scoped sessions. Instances written through the write session stay readable after the commit.
+        self.session = scoped_session(sessionmaker(bind=self.read_engine))
+        self.write_session = scoped_session(sessionmaker(bind=self.write_engine, expire_on_commit=False))
+
+        # Create the users cache & invalidate its entries whenever a user is inserted, changed or deleted through either session. The flushed users are collected in the sessions `info` & only
+        # invalidated once they are committed, so a concurrent load can not cache the row as it was before the commit.
+        self.users_cache = LRUCache(self.settings_manager.cache_users_size, self.settings_manager.cache_users_ttl)
+        for session_factory in (self.session.session_factory, self.write_session.session_factory):
+            event.listen(session_factory, 'after_flush', self._collect_flushed_users)
+            event.listen(session_factory, 'after_commit', self._invalidate_committed_users)
+            event.listen(session_factory, 'after_rollback', self._discard_flushed_users)
+        metrics.register_cache('users', self.users_cache.stats)
+
+        # Retires the cached fragments rendered from any table written through either session, once the write is committed, like the users cache. See `/source/rendering.py`.
+        for session_factory in (self.session.session_factory, self.write_session.session_factory):
+            event.listen(session_factory, 'after_flush', self._collect_flushed_tables)
+            event.listen(session_factory, 'after_commit', self._invalidate_committed_fragments)
+            event.listen(session_factory, 'after_rollback', self._discard_flushed_tables)
+
+        # The compiled permission mask of every profile type, loaded on first use & cleared whenever a profile type changes. Stored with the shared profile types generation it was loaded
+        # under, as `(generation, masks)`. See `/source/permissions.py`.
+        self._permission_masks = None
+        self._permission_generation = 0
+        self._permission_lock = threading.Lock()
+
+    @staticmethod
+    def _get_engine_settings(settings: object) -> tuple:
+        """ Returns a tuple of the settings which the engines are created with. If any of them change, the engines must be replaced.
+         
+        Params:
+            - settings (Settings) - The settings snapshot. """
 
-        # Create all the tables & the `/instance/xenon.db` file.
-        base.metadata.create_all(bind=db_engine)
+        return (
+            settings.database_pool_size, settings.database_max_overflow, settings.database_pool_timeout, settings.database_busy_timeout, settings.database_synchronous,
+            settings.database_cache_size, settings.database_mmap_size
+        )
 
-        # Initialize the session maker. 
-        _session = sessionmaker(bind=db_engine)
-        self.session = _session()
+    def apply_settings(self, settings: object) -> None:
+        """ Applies a new settings snapshot without dropping any connections. The users cache is resized straight away. If the pool or pragma settings changed, new engines are created & bound to
+        the session makers; sessions which are already open keep their connections until they are removed at the end of their request, after which the old pools are discarded. This is registered
+        as a `SettingsManager` listener in the `/source/server.py`.
+         
+        Params:
+            - settings (Settings) - The new settings snapshot. """
+
+        # Resizes the users cache.
+        self.users_cache.resize(settings.cache_users_size, settings.cache_users_ttl)
+
+        # Returns if the engines do not need to be replaced.
+        engine_settings = self._get_engine_settings(settings)
+        if engine_settings == self._engine_settings:
+            return
+
+        # Creates the new engines & binds the session makers to them.
+        old_engines = (self.read_engine, self.write_engine)
+        self._engine_settings = engine_settings
+        self.read_engine = self._create_engine('read', settings.database_pool_size, settings.database_max_overflow)
+        self.write_engine = self._create_engine('write', 1, 0)
+        self.session.session_factory.configure(bind=self.read_engine)
+        self.write_session.session_factory.configure(bind=self.write_engine)
+
+        # Discards the old pools without closing the connections which are still checked out.
+        for engine in old_engines:
+            engine.dispose(close=False)
+
+    def _create_engine(self, name: str, pool_size: int, max_overflow: int) -> object:
+        """ Returns a new engine for the system database which applies the sqlite pragmas to every new connection & records its statements in the metrics.
+         
+        Params:
+            - name (str) - The name of the engine in the metrics, `read` or `write`.
+            - pool_size (int) - The number of connections kept open in the pool.
+            - max_overflow (int) - The number of connections which can be opened on top of `pool_size` when the pool is exhausted. """
+
+        # Creates the engine with the pragmas shared by the apps databases, see `/source/engines.py`.
+        return create_sqlite_engine(self.db_path, self.settings_manager, name, pool_size, max_overflow)
+
+    def _upgrade_schema(self) -> None:
+        """ Adds the columns, indexes & triggers which `create_all()` does not add to tables that already exist. Each step is skipped if it has already been done, so this is safe to run on 
+        every start up. """
+
+        with self.write_engine.begin() as connection:
+            # Adds the `user_count` column to the `profile_types` table & counts the users of each profile type.
+            profile_types_columns = [column['name'] for column in inspect(connection).get_columns('profile_types')]
+            if 'user_count' not in profile_types_columns:
+                connection.execute(text('ALTER TABLE profile_types ADD COLUMN user_count INTEGER NOT NULL DEFAULT 0'))
+                connection.execute(text('UPDATE profile_types SET user_count = (SELECT COUNT(*) FROM users WHERE users.profile_type = profile_types.id)'))
+
+            # Adds the permission columns added to `ProfileTypes` since the table was created. Existing profile types are not granted the new permissions.
+            for name in PERMISSION_BITS:
+                if name not in profile_types_columns:
+                    connection.execute(text(f'ALTER TABLE profile_types ADD COLUMN "{name}" BOOLEAN NOT NULL DEFAULT 0'))
+
+            # Creates the indexes of the `users` table.
+            for index in Users.__table__.indexes:
+                index.create(connection, checkfirst=True)
+
+            # Creates the triggers which maintain the `user_count` column.
+            for trigger in USER_COUNT_TRIGGERS:
+                connection.execute(text(trigger))
+
+    def remove_sessions(self, exception: BaseException = None) -> None:
+        """ Closes & removes the current threads sessions, returning their connections to the pools. This is registered as a teardown function in the `/source/server.py` so it runs at the end of 
+        every request.
+         
+        Params:
+            - exception (BaseException) - The exception which ended the request, if any. Passed by flask. """
+
+        # Removes both of the threads sessions.
+        self.session.remove()
+        self.write_session.remove()
+
+    def reset_after_fork(self) -> None:
+        """ Drops the connections & sessions inherited from the parent process without closing them, as they still belong to the parent. Must be called in a forked child before the databases
+        are used, for example by a worker of the production server in `/source/serving.py`. """
+
+        # Discards the pooled connections, leaving them open for the parent.
+        self.read_engine.dispose(close=False)
+        self.write_engine.dispose(close=False)
+
+        # Forgets the sessions of the forking thread rather than closing them.
+        self.session.registry.clear()
+        self.write_session.registry.clear()
+
+    def _collect_flushed_users(self, session: object, flush_context: object) -> None:
+        """ Collects the users & profile types flushed by a session in its `info`, so they are invalidated when the transaction commits. Called by the sessions `after_flush` event, so password,
+        profile type & any other changes are picked up.
+         
+        Params:
+            - session (Session) - The session which was flushed.
+            - flush_context (object) - The flushes internal state. Passed by SQLAlchemy. """
+
+        # Collects every user which was inserted, changed or deleted, & whether any profile type was.
+        for instance in (*session.new, *session.dirty, *session.deleted):
+            if isinstance(instance, Users) and instance.id is not None:
+                session.info.setdefault('flushed_users', set()).add(instance.id)
+            elif isinstance(instance, ProfileTypes):
+                session.info['flushed_profile_types'] = True
+
+    def _invalidate_committed_users(self, session: object) -> None:
+        """ Removes the users committed by a session from the users cache. Called by the sessions `after_commit` event. A committed profile type clears the permission masks & every cached user,
+        as the users snapshots hold the mask of their profile type.
+         
+        Params:
+            - session (Session) - The session which was committed. """
+
+        user_ids = session.info.pop('flushed_users', ())
+        if session.info.pop('flushed_profile_types', False):
+            self.invalidate_permissions()
+            return
+
+        if user_ids:
+            self.invalidate_users(user_ids)
+
+    def _discard_flushed_users(self, session: object) -> None:
+        """ Forgets the users collected by a session, as its transaction was rolled back. Called by the sessions `after_rollback` event.
+         
+        Params:
+            - session (Session) - The session which was rolled back. """
+
+        session.info.pop('flushed_users', None)
+        session.info.pop('flushed_profile_types', None)
+
+    @staticmethod
+    def _collect_flushed_tables(session: object, flush_context: object) -> None:
+        """ Collects the names of the tables flushed by a session in its `info`, so their fragments are retired when the transaction commits. Called by the sessions `after_flush` event.
+         
+        Params:
+            - session (Session) - The session which was flushed.
+            - flush_context (object) - The flushes internal state. Passed by SQLAlchemy. """
+
+        session.info.setdefault('flushed_tables', set()).update(instance.__tablename__ for instance in (*session.new, *session.dirty, *session.deleted))
+
+    @staticmethod
+    def _invalidate_committed_fragments(session: object) -> None:
+        """ Retires the cached fragments rendered from the tables committed by a session. Called by the sessions `after_commit` event, so a concurrent render can not cache the rows as they were
+        before the commit.
+         
+        Params:
+            - session (Session) - The session which was committed. """
+
+        table_names = session.info.pop('flushed_tables', None)
+        if table_names:
+            fragment_cache.tables_changed(table_names)
+
+    @staticmethod
+    def _discard_flushed_tables(session: object) -> None:
+        """ Forgets the tables collected by a session, as its transaction was rolled back. Called by the sessions `after_rollback` event.
+         
+        Params:
+            - session (Session) - The session which was rolled back. """
+
+        session.info.pop('flushed_tables', None)
+
+    def invalidate_users(self, user_ids: list[int] = None) -> None:
+        """ Removes users from the users cache of every process. Must be called after the change is committed.
+
+        Params:
+            - user_ids (list[int]) - The primary keys (ids) of the changed users. If `None`, every user is removed. """
+
+        if user_ids is None:
+            shared_generations.bump('users')
+            self.users_cache.clear()
+            return
+
+        shared_generations.bump(*(('user', user_id) for user_id in user_ids))
+        for user_id in user_ids:
+            self.users_cache.invalidate(user_id)
+
+    def invalidate_permissions(self) -> None:
+        """ Clears the permission masks & the users cache of every process, so the next users loaded get the current permissions of their profile type. Must be called after the change is
+        committed. """
+
+        shared_generations.bump('profile_types')
+        with self._permission_lock:
+            self._permission_generation += 1
+            self._permission_masks = None
+        self.users_cache.clear()
+
+    def permission_mask(self, profile_type_id: int) -> int:
+        """ Returns the compiled permission mask of a profile type, or `0` if there is no such profile type. The masks of every profile type are loaded with a single query the first time one
+        is needed, & kept until a profile type changes in any process.
+         
+        Params:
+            - profile_type_id (int) - The primary key (id) of the profile type. """
+
+        # Returns the cached mask unless a profile type changed since the masks were loaded, in this or another process.
+        shared_generation = shared_generations.get('profile_types')
+        cached = self._permission_masks
+        if cached is not None and cached[0] == shared_generation:
+            return cached[1].get(profile_type_id, 0)
+
+        with self._permission_lock:
+            generation = self._permission_generation
+
+        # Loads the permission columns of every profile type in a new transaction, skipping the query when there are no permissions.
+        masks = {}
+        if PERMISSION_BITS:
+            columns = [getattr(ProfileTypes, name) for name in PERMISSION_BITS]
+            with self.session.session_factory() as session:
+                for id_, *values in session.execute(select(ProfileTypes.id, *columns)):
+                    masks[id_] = compile_permission_mask(zip(PERMISSION_BITS.values(), values))
+
+        # Keeps the masks unless a profile type changed in this process while they were loading. A change in another process bumped the shared generation, so they are loaded again next time.
+        with self._permission_lock:
+            if generation == self._permission_generation:
+                self._permission_masks = (shared_generation, masks)
+
+        return masks.get(profile_type_id, 0)
+
+    def load_user(self, user_id: object) -> 'UserSnapshot':
+        """ Returns a read-only `UserSnapshot` of the user with the given id, or `None` if there is no such user. Snapshots are cached, so repeated calls do not touch the database. This is used
+        as the `flask_login` user loader.
+         
+        Params:
+            - user_id (object) - The primary key (id) of the user. May be a string, as stored in the flask session. """
+
+        # Converts the id to an integer so it matches the keys used when invalidating.
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+        # Returns the cached snapshot, loading it from the read session on a miss. The snapshot is stored with the shared generations it was loaded under, which are read before loading.
+        generations = self._user_generations(user_id)
+        loader = lambda: self._load_user_entry(user_id, generations)
+        entry = self.users_cache.get_or_load(user_id, loader)
+
+        # Loads the user again if the cached snapshot was changed by another process since it was loaded.
+        if entry is not None and entry[0] != generations:
+            self.users_cache.invalidate(user_id)
+            entry = self.users_cache.get_or_load(user_id, loader)
+
+        return entry[1] if entry is not None else None
+
+    @staticmethod
+    def _user_generations(user_id: int) -> tuple:
+        """ Returns the shared generations a snapshot of a user depends on: every user, the user itself & the profile types, whose permission mask the snapshot holds.
+
+        Params:
+            - user_id (int) - The primary key (id) of the user. """
+
+        return (shared_generations.get('users'), shared_generations.get(('user', user_id)), shared_generations.get('profile_types'))
+
+    def _load_user_entry(self, user_id: int, generations: tuple) -> tuple:
+        """ Returns a tuple of the shared generations & a `UserSnapshot` of the user, as stored in the users cache, or `None` if there is no such user.
+
+        Params:
+            - user_id (int) - The primary key (id) of the user.
+            - generations (tuple) - The shared generations read before loading, see `_user_generations()`. """
+
+        snapshot = self._load_user_snapshot(user_id)
+        return (generations, snapshot) if snapshot is not None else None
+
+    def _load_user_snapshot(self, user_id: int) -> 'UserSnapshot':
+        """ Returns a `UserSnapshot` of the user with the given id loaded from the database, or `None` if there is no such user.
+         
+        Params:
+            - user_id (int) - The primary key (id) of the user. """
+
+        # Loads the user in a new transaction & copies it into a snapshot. The threads read session is not used, as it may hold an older copy of the row or a transaction started before the
+        # latest commit.
+        with self.session.session_factory() as session:
+            user = session.get(Users, user_id)
+            if user is None:
+                return None
+
+            return UserSnapshot(user, self.permission_mask(user.profile_type))
+
+    def _attach(self, instance: object) -> object:
+        """ Returns the instance attached to the write session. If the instance was loaded through the read session, it is moved to the write session with its changes, so the read session never
+        flushes them itself. If the write session already holds the same row, the changes are merged into its copy instead & that copy is returned.
+         
+        Params:
+            - instance (object) - The instance of the table object that should be written. """
+
+        # Removes the instance from the session which owns it, if that is not the write session.
+        owner = object_session(instance)
+        if owner is not None and owner is not self.write_session():
+            owner.expunge(instance)
+
+            # Merges the instance if the write session already holds the row.
+            identity_key = inspect(instance).key
+            if identity_key is not None and identity_key in self.write_session.identity_map:
+                return self.write_session.merge(instance)
+
+        # Adds the instance to the write session.
+        self.write_session.add(instance)
+        return instance
+
+    def _commit(self) -> None:
+        """ Commits the write session to the database. If the commit fails, the session is rolled back so it can be used again & the exception is raised. """
+
+        # Commits the write session, rolling back on failure.
+        try:
+            self.write_session.commit()
+        except BaseException:
+            self.write_session.rollback()
+            raise
+
+    def _delete(self, instance: object) -> None:
+        """ Checks an instance is allowed to be deleted & deletes it from the write session. Raises the relevant exception if it is not allowed.
+         
+        Params:
+            - instance (object) - The instance of the table object that should be deleted. """
+
+        # Checks if the instance is of `ProfileTypes`. If so it gets the number of users assigned to that profile type.
+        if isinstance(instance, ProfileTypes):
+            user_count = self.count_users(instance.id)
+
+            # If there are users discovered to be assigned under that profile type, then raise an exception.
+            if user_count:
+                raise ProfileTypeStillActive(instance.name)
+
+        # Deletes the row from the write session.
+        self.write_session.delete(self._attach(instance))
+
+    def count_users(self, profile_type_id: int) -> int:
+        """ Returns the number of users assigned to a profile type. The count is maintained by the database, so this is a single primary key lookup no matter how many users exist.
+         
+        Params:
+            - profile_type_id (int) - The primary key (id) of the profile type. """
+
+        # Returns the stored count, or 0 if the profile type does not exist.
+        return self.write_session.scalar(select(ProfileTypes.user_count).where(ProfileTypes.id == profile_type_id)) or 0
+
+    def users_per_profile_type(self) -> dict[str, int]:
+        """ Returns a dictionary of each profile types name & the number of users assigned to it. """
+
+        # Reads the stored counts of every profile type.
+        return dict(self.session.execute(select(ProfileTypes.name, ProfileTypes.user_count)).all())
 
     def add_row(self, instance: object) -> None:
         """ Adds an instance to the databases table. To do this create an instance of the object table you would like to add to. Then format the property values & then pass that instance to this 
-        function. Example:
+        function. Instances already in the database which have been modified can also be passed to save the changes. Example:
         ```python
         from source.databases import DatabasesManager, ProfileTypes
 
-        databases_manager = DatabasesManager()
+        databases_manager = DatabasesManager(settings_manager)
 
         profile_type = ProfileTypes()
         profile_type.name = 'Admin'
@@ -60,18 +476,18 @@ class DatabasesManager():
         Params:
             - instance (object) - The instance of the table object that should be added. """
 
-        # Add the row to the session.
-        self.session.add(instance)
+        # Add the row to the write session.
+        self._attach(instance)
 
-        # Commits the session to the database.
-        self.session.commit()
+        # Commits the write session to the database.
+        self._commit()
 
     def delete_row(self, instance: object) -> None:
         """ Deletes an instance from the databases table. To do this query the database to get the instance of the row you would like to delete. Pass the instance to this function. Example:
         ```python
         from source.databases import DatabasesManager, Users
 
-        databases_manager = DatabasesManager()
+        databases_manager = DatabasesManager(settings_manager)
          
         user = databases_manager.session.query(Users).filter_by(email='johndoe@test.com').first()
         databases_manager.delete_row(user) 
@@ -83,19 +499,275 @@ class DatabasesManager():
         Params: 
             - instance (object) - The instance of the table object that should be deleted. """
 
-        # Checks if the instance is of `ProfileTypes`. If so it gets a list of all users assigned to that profile type.
-        if isinstance(instance, ProfileTypes):
-            users_with_profile_type = self.session.query(Users).filter_by(ProfileTypes=instance.id)
+        # Checks the row can be deleted & deletes it from the write session.
+        self._delete(instance)
 
-            # If there are used discovered to be assigned under that profile type, then raise an exception.
-            if users_with_profile_type:
-                raise ProfileTypeStillActive(instance.name)
+        # Commits the write session to the database.
+        self._commit()
+
+    def add_rows(self, table: type, rows: list[dict]) -> None:
+        """ Adds many rows to a databases table in a single transaction. The rows are given as dictionaries of column values & are inserted using an executemany, so no instances are created.
+        This is much faster than calling `add_row()` for each row. Example:
+        ```python
+        from source.databases import DatabasesManager, ProfileTypes
+
+        databases_manager = DatabasesManager(settings_manager)
+
+        databases_manager.add_rows(ProfileTypes, [
+            {'name': 'Adult', 'description': 'A standard household member.'},
+            {'name': 'Child', 'description': 'Blocks access to the admin panel.'}
+        ])
+        ```
+
+        NOTE: Properties which are not columns are not available. For example, `Users` rows must be given a `hashed_password` rather than a `password`.
+
+        Params:
+            - table (type) - The table object the rows should be added to.
+            - rows (list[dict]) - The column values of each row. """
+
+        # Returns if there is nothing to insert.
+        if not rows:
+            return
+
+        # Inserts all the rows with a single executemany & commits the write session to the database.
+        self.write_session.execute(insert(table), rows)
+        self._commit()
+
+        # Bulk statements are not flushed, so the cached fragments & permission masks are invalidated here.
+        fragment_cache.tables_changed((table.__tablename__,))
+        if table is ProfileTypes:
+            self.invalidate_permissions()
+
+    def delete_rows(self, table: type, ids: list[int]) -> None:
+        """ Deletes many rows from a databases table in a single transaction, given their primary keys (ids). The same exceptions as `delete_row()` apply, in which case no rows are deleted.
+
+        Params:
+            - table (type) - The table object the rows should be deleted from.
+            - ids (list[int]) - The primary keys (ids) of the rows that should be deleted. """
+
+        # Returns if there is nothing to delete.
+        ids = list(ids)
+        if not ids:
+            return
+
+        # Checks if the rows are of `ProfileTypes`. If so, checks that none of them are still assigned to a user.
+        if table is ProfileTypes:
+            for chunk in _chunks(ids, SQLITE_MAX_VARIABLES):
+                active_name = self.write_session.scalars(select(ProfileTypes.name).where(ProfileTypes.id.in_(chunk), ProfileTypes.user_count > 0).limit(1)).first()
+                if active_name is not None:
+                    raise ProfileTypeStillActive(active_name)
+
+        # Deletes the rows in chunks which fit sqlites parameter limit & commits the write session to the database.
+        primary_key = inspect(table).primary_key[0]
+        for chunk in _chunks(ids, SQLITE_MAX_VARIABLES):
+            self.write_session.execute(delete(table).where(primary_key.in_(chunk)))
+        self._commit()
+
+        # Bulk statements are not flushed, so the cached fragments, deleted users & profile types are invalidated here.
+        fragment_cache.tables_changed((table.__tablename__,))
+        if table is Users:
+            self.invalidate_users(ids)
+        elif table is ProfileTypes:
+            self.invalidate_permissions()
+
+    def upsert_rows(self, table: type, rows: list[dict], conflict_columns: list[str] = None) -> None:
+        """ Inserts many rows into a databases table in a single transaction, updating the existing row instead whenever a row conflicts. Every row must have the same keys.
+
+        Params:
+            - table (type) - The table object the rows should be inserted into.
+            - rows (list[dict]) - The column values of each row.
+            - conflict_columns (list[str]) - The unique columns which identify an existing row. Defaults to the primary key. """
+
+        # Returns if there is nothing to insert.
+        if not rows:
+            return
+
+        # Builds the statement, updating every given column other than the conflict columns when a row already exists.
+        mapper = inspect(table)
+        conflict_columns = conflict_columns or [column.key for column in mapper.primary_key]
+        statement = sqlite_insert(table)
+        updated_columns = {key: statement.excluded[key] for key in rows[0] if key not in conflict_columns}
+
+        if updated_columns:
+            statement = statement.on_conflict_do_update(index_elements=conflict_columns, set_=updated_columns)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=conflict_columns)
+
+        # Executes the statement with an executemany & commits the write session to the database.
+        self.write_session.execute(statement, rows)
+        self._commit()
+
+        # Bulk statements are not flushed, so the cached fragments, updated users & profile types are invalidated here.
+        fragment_cache.tables_changed((table.__tablename__,))
+        if table is Users:
+            self.invalidate_users()
+        elif table is ProfileTypes:
+            self.invalidate_permissions()
+
+    def update_rows(self, table: type, rows: list[dict]) -> None:
+        """ Updates many rows of a databases table in a single transaction, given their primary keys & the new values of some columns. Every row must have the same keys.
+
+        Params:
+            - table (type) - The table object the rows belong to.
+            - rows (list[dict]) - The primary key & new column values of each row. """
+
+        # Returns if there is nothing to update.
+        if not rows:
+            return
+
+        # Updates the rows by primary key with an executemany & commits the write session to the database.
+        self.write_session.execute(update(table), rows)
+        self._commit()
+
+        # Bulk statements are not flushed, so the cached fragments, updated users & profile types are invalidated here.
+        fragment_cache.tables_changed((table.__tablename__,))
+        if table is Users:
+            self.invalidate_users()
+        elif table is ProfileTypes:
+            self.invalidate_permissions()
+
+    def save_schedule(self, row: dict) -> None:
+        """ Inserts or replaces a persisted schedule, giving it the next revision so the process running the schedules picks it up. See `/source/scheduler.py`.
+
+        Params:
+            - row (dict) - The column values of the schedule, other than `revision` & `cancelled`. """
+
+        # The revision is computed in the statement, so schedules saved by different processes never share one.
+        statement = sqlite_insert(Schedules).values(**row, cancelled=False, revision=_next_schedule_revision())
+        statement = statement.on_conflict_do_update(index_elements=['id'], set_={key: statement.excluded[key] for key in (*row, 'cancelled', 'revision') if key != 'id'})
+        self.write_session.execute(statement)
+        self._commit()
+
+    def cancel_schedules(self, schedule_ids: list[str]) -> None:
+        """ Marks persisted schedules as cancelled under the next revision. The process running the schedules removes them & prunes the rows.
+
+        Params:
+            - schedule_ids (list[str]) - The ids of the schedules. """
+
+        # Returns if there is nothing to cancel.
+        schedule_ids = list(schedule_ids)
+        if not schedule_ids:
+            return
+
+        for chunk in _chunks(schedule_ids, SQLITE_MAX_VARIABLES):
+            self.write_session.execute(update(Schedules).where(Schedules.id.in_(chunk)).values(cancelled=True, revision=_next_schedule_revision()))
+        self._commit()
+
+    def prune_schedules(self) -> None:
+        """ Deletes the cancelled schedules, other than the one with the latest revision, which is kept so revisions keep increasing. """
+
+        self.write_session.execute(delete(Schedules).where(Schedules.cancelled, Schedules.revision < select(func.max(Schedules.revision)).scalar_subquery()))
+        self._commit()
+
+    def load_schedule(self, schedule_id: str) -> object:
+        """ Returns the row of a persisted schedule, or `None` if it does not exist.
+
+        Params:
+            - schedule_id (str) - The id of the schedule. """
+
+        return self.write_session.execute(select(Schedules.__table__).where(Schedules.id == schedule_id)).first()
+
+    def schedule_changes(self, after_revision: int = 0) -> list:
+        """ Returns the persisted schedules saved or cancelled since a revision, in revision order. `0` returns every schedule.
+
+        Params:
+            - after_revision (int) - The last revision which has been read. """
+
+        return self.write_session.execute(select(Schedules.__table__).where(Schedules.revision > after_revision).order_by(Schedules.revision)).all()
+
+    @contextlib.contextmanager
+    def unit_of_work(self, flush_size: int = None, flush_interval: float = None) -> 'UnitOfWork':
+        """ A context manager which groups many changes into one transaction. Rows added or deleted through the yielded `UnitOfWork` are committed together when the block exits, or rolled back if
+        it raises. For long running imports, the work can be committed in batches every `flush_size` changes or every `flush_interval` seconds. Example:
+        ```python
+        from source.databases import DatabasesManager, Users
+
+        databases_manager = DatabasesManager(settings_manager)
+
+        with databases_manager.unit_of_work(flush_size=500) as unit:
+            for user in household_users:
+                unit.add(user)
+        ```
+
+        NOTE: The unit of work uses the threads write session, so `add_row()` & `delete_row()` must not be called inside the block as they would commit the unit early.
+
+        Params:
+            - flush_size (int) - Commits the pending changes once this many have been made. If `None`, changes are not committed by count.
+            - flush_interval (float) - Commits the pending changes once this many seconds have passed since the last commit. If `None`, changes are not committed by time. """
 
-        # Deletes the row from the session.
-        self.session.delete(instance)
+        unit = UnitOfWork(self, flush_size, flush_interval)
 
-        # Commits the session to the database.
-        self.session.commit()
+        # Rolls back the pending changes if the block raises, else commits them.
+        try:
+            yield unit
+        except BaseException:
+            self.write_session.rollback()
+            raise
+
+        unit.commit()
+
+class UnitOfWork():
+    """ Collects changes to the system database so they are committed in as few transactions as possible. Should be created through `DatabasesManager.unit_of_work()`.
+     
+    Params:
+        - databases_manager (DatabasesManager) - The databases manager whose write session is used.
+        - flush_size (int) - Commits the pending changes once this many have been made.
+        - flush_interval (float) - Commits the pending changes once this many seconds have passed since the last commit. """
+
+    def __init__(self, databases_manager: DatabasesManager, flush_size: int = None, flush_interval: float = None) -> None:
+        self.databases_manager = databases_manager
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        # The number of changes made since the last commit & when that commit happened.
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def add(self, instance: object) -> None:
+        """ Adds an instance to the unit. See `DatabasesManager.add_row()`.
+         
+        Params:
+            - instance (object) - The instance of the table object that should be added. """
+
+        self.databases_manager._attach(instance)
+        self._changed()
+
+    def delete(self, instance: object) -> None:
+        """ Deletes an instance in the unit. See `DatabasesManager.delete_row()`.
+         
+        Params:
+            - instance (object) - The instance of the table object that should be deleted. """
+
+        self.databases_manager._delete(instance)
+        self._changed()
+
+    def _changed(self) -> None:
+        """ Counts a change & commits the pending changes if the size or time limit has been reached. """
+
+        self.pending += 1
+
+        # Commits the unit if either limit has been reached.
+        if self.flush_size is not None and self.pending >= self.flush_size:
+            self.commit()
+        elif self.flush_interval is not None and time.monotonic() - self.last_commit >= self.flush_interval:
+            self.commit()
+
+    def commit(self) -> None:
+        """ Commits all the pending changes to the database. """
+
+        self.databases_manager._commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    """ Yields consecutive slices of a list which are at most `size` long.
+     
+    Params:
+        - items (list) - The list to split.
+        - size (int) - The maximum length of each slice. """
+
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
 class ProfileTypes(base):
     """ Holds information about profile types. So in Xenon, the consumers can create different profile types which change what privileges & permissions that user has. Examples of profile types can be
@@ -106,7 +778,12 @@ class ProfileTypes(base):
     Properties: 
         - id (int) - This is the rows primary key.
         - name (str) - This is the name of the profile type. May also be called a profile title. 
-        - description (str) - A general description to describe what the profile type does. """
+        - description (str) - A general description to describe what the profile type does. 
+        - user_count (int) - The number of users assigned to the profile type. This is maintained by database triggers & must not be set manually. NOTE: The value on a loaded instance is not 
+        refreshed when users change, use `DatabasesManager.count_users()` for the current count. 
+        
+    Every `Boolean` column is a permission, compiled into a bitmask by `DatabasesManager.permission_mask()` & checked with the helpers in `/source/permissions.py`. Permission columns should be
+    declared as `Column('<name>', Boolean, nullable=False, default=False)`; they are added to existing databases on start up. """
     
     # Create the table name.
     __tablename__ = 'profile_types'
@@ -115,7 +792,22 @@ class ProfileTypes(base):
     id = Column('id', Integer, primary_key=True)
     name = Column('name', String, unique=True)
     description = Column('description', String)
+    user_count = Column('user_count', Integer, nullable=False, default=0, server_default='0')
+
+# The bit of each permission, by the name of its `ProfileTypes` column, in the order the columns are declared.
+PERMISSION_BITS = {column.key: 1 << index for index, column in enumerate(column for column in ProfileTypes.__table__.columns if isinstance(column.type, Boolean))}
 
+def compile_permission_mask(bits_and_values: object) -> int:
+    """ Returns the bitmask of the permissions which are granted.
+
+    Params:
+        - bits_and_values (iterable) - Pairs of a permissions bit & whether it is granted. """
+
+    mask = 0
+    for bit, granted in bits_and_values:
+        if granted:
+            mask |= bit
+    return mask
 
 class Users(base, UserMixin):
     """ The users database table is used to store information about the users. Each person in the household should have a profile. These profiles are stored in this table. The main use of these 
@@ -130,7 +822,7 @@ class Users(base, UserMixin):
         - email () - This needs to be a valid, unique & active email address. 
         - username () - This needs to be a unique username. 
         - date_of_birth () - The ISO 8601 date that the user was born. 
-        - datetime_of_creation () - This is the ISO 8601 datetime of when the row was created. 
+        - datetime_of_creation () - This is the UTC datetime of when the row was created. 
         - hashed_password () - This is the hashed version of the users password. 
         - profile_type () - This is the primary key (id) of the profile type the user is assigned to. """
 
@@ -143,18 +835,18 @@ class Users(base, UserMixin):
     forename = Column('forename', String)
     surname = Column('surname', String)
 
-    email = Column('email', String, unique=True)
-    username = Column('username', String, unique=True)
+    email = Column('email', String, unique=True, index=True)
+    username = Column('username', String, unique=True, index=True)
 
     date_of_birth = Column('date_of_birth', Date)
-    datetime_of_creation = Column('datetime_of_creation', DateTime, default=helpers.convert_to_iso(helpers.get_current_datetime()))
+    datetime_of_creation = Column('datetime_of_creation', DateTime, default=helpers.get_current_utc_datetime)
 
     hashed_password = Column('hashed_password', String)
 
-    profile_type = Column('profile_type', Integer)
+    profile_type = Column('profile_type', Integer, ForeignKey('profile_types.id'), index=True)
 
     def set_profile_type(self, profile_type_id: Column[int]) -> None:
-        """ Sets the property `profile_type` to the profile type row id.
+        """ Sets the property `profile_type` to the profile type row id. The user counts of the old & new profile types are updated by the database when the change is committed.
          
         Params:
             - profile_type_id (Column[int]) - The primary key (id) of the row in the `ProfilesTable` table that the user should be assigned to. """
@@ -171,19 +863,99 @@ class Users(base, UserMixin):
     
     @password.setter
     def password(self, password: str) -> None:
-        """ Sets the `hashed_password` property to a hashed version of the given clear text password.
+        """ Sets the `hashed_password` property to a hashed version of the given clear text password. The hashing is run in the `source.hashing.password_hasher` pool.
          
         Params:
             - password (str) - The clear text password which will be hashed & stored. """
         
         # Sets the property `hashed_password` to a hashed version of parameter `password`.
-        self.hashed_password = generate_password_hash(password)
+        self.hashed_password = password_hasher.hash(password)
 
     def verify_password(self, password: str) -> bool:
-        """ Returns a bool based on whether a given clear text password matches a stored hashed version.
+        """ Returns a bool based on whether a given clear text password matches a stored hashed version. The check is run in the `source.hashing.password_hasher` pool.
+        If the password matches but the stored hash was made with outdated parameters, `hashed_password` is replaced with a new hash. Pass the user to `DatabasesManager.add_row()` to save it.
          
         Params:
             - Password (str) - The clear text password you would like to check. """
         
-        # Returns the value from the `werkzeug.security.check_password_hash` function.
-        return check_password_hash(self.hashed_password, password)
\ No newline at end of file
+        # Checks the password against the stored hash.
+        verified = password_hasher.verify(self.hashed_password, password)
+
+        # Rehashes the password if the stored hash is outdated.
+        if verified and password_hasher.needs_rehash(self.hashed_password):
+            self.password = password
+
+        # Returns whether the password matched.
+        return verified
+
+class Schedules(base):
+    """ Holds the persisted schedules of `/source/scheduler.py`, so they are restored after a restart. Rows are written through `DatabasesManager.save_schedule()` & `cancel_schedules()`.
+
+    Properties:
+        - id (str) - The id of the schedule.
+        - trigger (str) - The trigger specification, such as `cron:0 7 * * mon-fri`.
+        - timezone (str) - The IANA name of the timezone cron triggers are evaluated in. Empty for the systems local timezone.
+        - target (str) - The function to run, as `<module>:<qualified name>`.
+        - arguments (str) - The JSON encoded positional & keyword arguments of the function.
+        - owner (str) - The owner given when scheduling, such as an app id.
+        - next_run (datetime) - The UTC datetime the schedule is next due.
+        - revision (int) - Increased whenever the schedule is saved or cancelled, so the changes since a revision can be read.
+        - cancelled (bool) - Whether the schedule has been cancelled & is waiting to be removed. """
+
+    # Create the table name.
+    __tablename__ = 'schedules'
+
+    # Initialize the table columns.
+    id = Column('id', String, primary_key=True)
+    trigger = Column('trigger', String, nullable=False)
+    timezone = Column('timezone', String, nullable=False, default='')
+    target = Column('target', String, nullable=False)
+    arguments = Column('arguments', Text, nullable=False, default='{}')
+    owner = Column('owner', String)
+    next_run = Column('next_run', DateTime)
+    revision = Column('revision', Integer, nullable=False, index=True)
+    cancelled = Column('cancelled', Boolean, nullable=False, default=False)
+
+def _next_schedule_revision() -> object:
+    """ Returns a scalar subquery for the revision after the highest revision of the `Schedules` table. """
+
+    return select(func.coalesce(func.max(Schedules.revision), 0) + 1).scalar_subquery()
+
+class UserSnapshot(UserMixin):
+    """ A detached, read-only copy of a `Users` row. These are returned by `DatabasesManager.load_user()` & are what `flask_login.current_user` holds, so they can be cached & shared between 
+    request threads. The columns are readable as attributes, exactly like on `Users`. To modify a user, query it through `DatabasesManager.session` & pass it to `DatabasesManager.add_row()`.
+     
+    Params:
+        - user (Users) - The user row which should be copied.
+        - permissions (int) - The compiled permission mask of the users profile type, readable as `permissions`. See `/source/permissions.py`. """
+
+    __slots__ = ('_values',)
+
+    def __init__(self, user: Users, permissions: int = 0) -> None:
+        # Copies every column value of the row, along with the permission mask of the users profile type.
+        values = {attribute.key: getattr(user, attribute.key) for attribute in inspect(Users).column_attrs}
+        values['permissions'] = permissions
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name: str) -> object:
+        # Returns the copied column value.
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f'\'UserSnapshot\' has no attribute \'{name}\'.') from None
+
+    def __setattr__(self, name: str, value: object) -> None:
+        # Raises an exception, snapshots are read-only.
+        raise AttributeError('\'UserSnapshot\' is read-only.')
+
+    def __repr__(self) -> str:
+        return f'<UserSnapshot id={self._values.get("id")}>'
+
+    def verify_password(self, password: str) -> bool:
+        """ Returns a bool based on whether a given clear text password matches the stored hashed version. Snapshots are read-only, so outdated hashes are not replaced.
+         
+        Params:
+            - password (str) - The clear text password you would like to check. """
+        
+        # Returns the value from the `source.hashing.password_hasher`.
+        return password_hasher.verify(self.hashed_password, password)
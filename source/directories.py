@@ -0,0 +1,280 @@
+""" Fast directory operations for installing, upgrading & removing app packages. Trees are listed with `os.scandir`, which reads each entrys type along with its name, & files are then deleted
+or copied by a pool of threads, as these calls spend most of their time waiting on the file system rather than holding the GIL. Installs are staged next to their target & swapped in with a
+rename, so an app directory is never seen half installed.
+
+Should be used through the shared instance:
+
+```python
+from source.directories import directory_operations
+
+directory_operations.replace_directory('/tmp/downloaded_app', '/apps/weather')
+``` """
+
+# Import standard packages
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import uuid
+
+# Variables
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+BATCH_SIZE = 128 # The number of files handed to a worker at a time.
+
+_RENAME_EXCHANGE = 2 # From `<linux/fs.h>`.
+_AT_FDCWD = -100
+
+class OperationReport():
+    """ The result of a directory operation. With a dry run, this describes what the operation would have done.
+
+    Properties:
+        - files (int) - The number of files (including symbolic links) deleted or copied.
+        - directories (int) - The number of directories deleted or created.
+        - bytes (int) - The number of bytes copied. Always 0 for deletions.
+        - dry_run (bool) - Whether the operation was a dry run. """
+
+    def __init__(self, dry_run: bool) -> None:
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.dry_run = dry_run
+
+    def __repr__(self) -> str:
+        return f'<OperationReport files={self.files} directories={self.directories} bytes={self.bytes} dry_run={self.dry_run}>'
+
+class DirectoryOperations():
+    """ Deletes, copies, moves & swaps directory trees using a pool of threads. Every operation accepts a `progress` callback, which is called with the number of files done & the total number of
+    files, & a `dry_run` flag, which lists the tree without changing anything.
+
+    Params:
+        - workers (int) - The number of threads used by each operation. """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS) -> None:
+        self.workers = workers
+
+    def scan(self, path: str, with_sizes: bool = False) -> tuple[list, list, int]:
+        """ Returns a tuple of every file & every directory below a path, & the total size of the files. Directories are listed parents first. Symbolic links are listed as files & are never
+        followed.
+
+        Params:
+            - path (str) - The path of the directory to list.
+            - with_sizes (bool) - If `True`, the size of every file is totalled. This costs a `stat` call per file. """
+
+        files, directories, size = [], [], 0
+        pending = [path]
+
+        # Walks the tree, using the entry types read by `os.scandir` rather than a `stat` call per entry.
+        while pending:
+            directory = pending.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                        pending.append(entry.path)
+                    else:
+                        files.append(entry.path)
+                        if with_sizes:
+                            size += entry.stat(follow_symlinks=False).st_size
+
+        # Parents are always found before their children, but the stack visits siblings out of order, so the directories are sorted by depth.
+        directories.sort(key=lambda directory: directory.count(os.sep))
+        return files, directories, size
+
+    def _run_batches(self, function: callable, items: list, progress: callable) -> None:
+        """ Calls a function on every item, spreading the items over the thread pool in batches. Raises the first exception a batch raised, once every batch has finished.
+
+        Params:
+            - function (callable) - Called with each item.
+            - items (list) - The items to process.
+            - progress (callable) - Called with the number of items done & the total number of items after each batch. """
+
+        def run_batch(batch: list) -> int:
+            for item in batch:
+                function(item)
+            return len(batch)
+
+        # Runs small jobs on this thread, as starting the pool would cost more than it saves.
+        if len(items) <= BATCH_SIZE or self.workers <= 1:
+            run_batch(items)
+            if progress is not None:
+                progress(len(items), len(items))
+            return
+
+        # Submits the batches & reports progress as they finish.
+        done = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(run_batch, items[index:index + BATCH_SIZE]) for index in range(0, len(items), BATCH_SIZE)]
+            for future in concurrent.futures.as_completed(futures):
+                done += future.result()
+                if progress is not None:
+                    progress(done, len(items))
+
+    def delete_tree(self, path: str, keep_root: bool = False, progress: callable = None, dry_run: bool = False) -> OperationReport:
+        """ Deletes a directory & everything inside it. If the path is a symbolic link, only the link is deleted, unless `keep_root` is set.
+
+        Params:
+            - path (str) - The path of the directory to delete.
+            - keep_root (bool) - If `True`, only the content of the directory is deleted. For a symbolic link, the content of the directory it points to.
+            - progress (callable) - Called with the number of files deleted & the total number of files.
+            - dry_run (bool) - If `True`, nothing is deleted. """
+
+        report = OperationReport(dry_run)
+
+        # Deletes a symbolic link itself, rather than the content of the directory it points to.
+        if not keep_root and os.path.islink(path):
+            report.files = 1
+            if not dry_run:
+                os.unlink(path)
+            return report
+
+        files, directories, _ = self.scan(path)
+        if not keep_root:
+            directories.insert(0, path)
+
+        report.files = len(files)
+        report.directories = len(directories)
+        if dry_run:
+            return report
+
+        # Deletes the files in parallel, then the now empty directories children first.
+        self._run_batches(os.unlink, files, progress)
+        for directory in reversed(directories):
+            os.rmdir(directory)
+
+        return report
+
+    def copy_tree(self, source: str, destination: str, progress: callable = None, dry_run: bool = False) -> OperationReport:
+        """ Copies a directory & everything inside it to a new directory, keeping file metadata. Symbolic links are copied as links. The destination must not exist.
+
+        Params:
+            - source (str) - The path of the directory to copy.
+            - destination (str) - The path of the new directory.
+            - progress (callable) - Called with the number of files copied & the total number of files.
+            - dry_run (bool) - If `True`, nothing is copied. """
+
+        report = OperationReport(dry_run)
+        files, directories, report.bytes = self.scan(source, with_sizes=True)
+        report.files = len(files)
+        report.directories = len(directories) + 1
+        if dry_run:
+            return report
+
+        # Creates the directories, parents first.
+        os.mkdir(destination)
+        for directory in directories:
+            os.mkdir(os.path.join(destination, os.path.relpath(directory, source)))
+
+        # Copies the files in parallel. `shutil.copy2` uses the kernels in-place copy where the platform has one, & recreates symbolic links rather than following them.
+        def copy_file(path: str) -> None:
+            shutil.copy2(path, os.path.join(destination, os.path.relpath(path, source)), follow_symlinks=False)
+
+        self._run_batches(copy_file, files, progress)
+
+        # Copies the directories metadata last, as creating their content changes their modification times.
+        for directory in [source, *directories]:
+            shutil.copystat(directory, os.path.join(destination, os.path.relpath(directory, source)))
+
+        return report
+
+    def move_tree(self, source: str, destination: str, progress: callable = None, dry_run: bool = False) -> OperationReport:
+        """ Moves a directory to a new path. Within one file system this is a single rename. Across file systems the tree is copied & then deleted. The destination must not exist.
+
+        Params:
+            - source (str) - The path of the directory to move.
+            - destination (str) - The new path of the directory.
+            - progress (callable) - Called with the number of files done & the total number of files.
+            - dry_run (bool) - If `True`, nothing is moved. """
+
+        # Renames the directory if both paths are on the same file system.
+        if os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(destination))).st_dev:
+            report = OperationReport(dry_run)
+            report.directories = 1
+            if not dry_run:
+                os.rename(source, destination)
+            return report
+
+        # Copies the tree, then deletes the original.
+        report = self.copy_tree(source, destination, progress, dry_run)
+        if not dry_run:
+            self.delete_tree(source)
+        return report
+
+    def swap_directory(self, staged: str, target: str) -> str:
+        """ Atomically replaces a directory with a staged one, which must be on the same file system. On Linux both are exchanged with a single `renameat2` call, so the target path always
+        points at a complete directory. Elsewhere the old directory is renamed away first, leaving the target missing for an instant. Returns the path the old directory was moved to (the staged
+        path, or a sibling of the target), or `None` if the target did not exist. The old directory is not deleted.
+
+        Params:
+            - staged (str) - The path of the new directory.
+            - target (str) - The path of the directory to replace. """
+
+        # Renames the staged directory into place if there is nothing to replace.
+        if not os.path.exists(target):
+            os.rename(staged, target)
+            return None
+
+        # Exchanges the two directories in one call where the platform supports it.
+        if _rename_exchange(staged, target):
+            return staged
+
+        # Falls back to two renames.
+        old = f'{target}.old-{uuid.uuid4().hex[:8]}'
+        os.rename(target, old)
+        os.rename(staged, target)
+        return old
+
+    def replace_directory(self, source: str, target: str, progress: callable = None, dry_run: bool = False) -> OperationReport:
+        """ Installs a copy of a directory at a target path, replacing whatever is there. The copy is staged next to the target & swapped in atomically, then the old directory is deleted. This is
+        how app packages should be installed & upgraded.
+
+        Params:
+            - source (str) - The path of the directory to install. It is not modified.
+            - target (str) - The path to install the directory at.
+            - progress (callable) - Called with the number of files copied & the total number of files.
+            - dry_run (bool) - If `True`, nothing is changed. """
+
+        # Stages the copy next to the target, so the swap is a rename within one file system.
+        staged = os.path.join(os.path.dirname(os.path.abspath(target)), f'.{os.path.basename(target)}.staging-{uuid.uuid4().hex[:8]}')
+        report = self.copy_tree(source, staged, progress, dry_run)
+        if dry_run:
+            return report
+
+        # Swaps the copy in & deletes the old directory.
+        try:
+            old = self.swap_directory(staged, target)
+        except BaseException:
+            self.delete_tree(staged)
+            raise
+
+        if old is not None:
+            self.delete_tree(old)
+
+        return report
+
+def _rename_exchange(first: str, second: str) -> bool:
+    """ Exchanges two paths with the Linux `renameat2` call. Returns `False` if the call is not available, in which case nothing is changed.
+
+    Params:
+        - first (str) - The first path.
+        - second (str) - The second path. """
+
+    # Loads `renameat2` from the C library, which only exists on Linux.
+    try:
+        renameat2 = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).renameat2
+    except (OSError, AttributeError, TypeError):
+        return False
+
+    # Exchanges the paths. The file systems which do not support the exchange report `EINVAL`.
+    if renameat2(_AT_FDCWD, os.fsencode(first), _AT_FDCWD, os.fsencode(second), _RENAME_EXCHANGE) == 0:
+        return True
+
+    error = ctypes.get_errno()
+    if error in (errno.EINVAL, errno.ENOSYS):
+        return False
+
+    raise OSError(error, os.strerror(error), first, None, second)
+
+# The directory operations shared by the whole program.
+directory_operations = DirectoryOperations()
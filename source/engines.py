@@ -0,0 +1,287 @@
+""" The database engines of the installed apps. Each app keeps its databases in its own directory (`/apps/<app id>/<name>.db`), & gets its engines from the `EngineRegistry` rather than creating
+its own. Engines are created on first use with the same sqlite pragmas as the system database & a small connection pool. The number of databases with open connections is capped: when another one
+is opened, the connections of the least recently used idle databases are closed, & databases which have not been used for the `database_idle_timeout` are closed too. A closed engine opens its
+connections again the next time it is used, so apps may keep a reference to their engines. This bounds the open file handles & page cache memory however many apps are installed. The limits are
+set in the `APPS` section of `/instance/system.ini`. Idle engines are closed by a scheduler job every `SWEEP_INTERVAL`, as well as whenever another engine is used.
+
+Every engine is instrumented as `app:<app id>` or `app:<app id>/<name>` in the metrics, which report its statement count & time. Example:
+```python
+from sqlalchemy.orm import Session
+from source.server import get_services
+
+engine = get_services().engine_registry.engine('weather')
+with Session(engine) as session:
+    ...
+``` """
+
+# Import internal packages
+from source.metrics import metrics
+from source.paths import Paths
+from source.scheduler import scheduler, IntervalTrigger
+
+# Import external packages
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Import standard packages
+import collections
+import logging
+import os
+import threading
+import time
+
+# Variables
+DEFAULT_DATABASE_NAME = 'app'
+SWEEP_INTERVAL = 30.0 # Seconds between checks for idle engines.
+SWEEP_JOB_ID = 'app-engines-idle-sweep'
+
+logger = logging.getLogger(__name__)
+
+def apply_pragmas(dbapi_connection: object, settings: object) -> None:
+    """ Applies the sqlite pragmas of the `DATABASE` section to a newly opened connection.
+
+    Params:
+        - dbapi_connection (object) - The newly opened `sqlite3` connection.
+        - settings (Settings) - The settings snapshot, or a `SettingsManager`. """
+
+    # Sets the journal mode, lock timeout, durability, page cache & memory map size.
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute(f'PRAGMA busy_timeout={int(settings.database_busy_timeout)}')
+    cursor.execute(f'PRAGMA synchronous={settings.database_synchronous}')
+    cursor.execute(f'PRAGMA cache_size={int(settings.database_cache_size)}')
+    cursor.execute(f'PRAGMA mmap_size={int(settings.database_mmap_size)}')
+    cursor.close()
+
+def create_sqlite_engine(url: str, settings_manager: object, name: str, pool_size: int, max_overflow: int, poolclass: type = QueuePool) -> object:
+    """ Returns a new sqlite engine which applies the sqlite pragmas to every new connection & records its statements in the metrics.
+
+    Params:
+        - url (str) - The database url.
+        - settings_manager (SettingsManager) - The settings manager which holds the pool timeout & sqlite pragmas. The pragmas are read whenever a connection is opened.
+        - name (str) - The name of the engine in the metrics.
+        - pool_size (int) - The number of connections kept open in the pool.
+        - max_overflow (int) - The number of connections which can be opened on top of `pool_size` when the pool is exhausted.
+        - poolclass (type) - The class of the connection pool. Defaults to `QueuePool`. """
+
+    # Creates the engine. Connections are shared between threads through the pool, so the thread check is disabled.
+    engine = create_engine(
+        url,
+        echo=False,
+        poolclass=poolclass,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings_manager.database_pool_timeout,
+        connect_args={'check_same_thread': False, 'timeout': settings_manager.database_busy_timeout / 1000}
+    )
+
+    # Applies the pragmas whenever the pool opens a new connection.
+    event.listen(engine, 'connect', lambda dbapi_connection, connection_record: apply_pragmas(dbapi_connection, settings_manager))
+
+    # Times every statement & reports the pool in the metrics.
+    metrics.instrument_engine(engine, name)
+
+    # Returns the engine.
+    return engine
+
+class RegistryPool(QueuePool):
+    """ The connection pool of the app engines. Every checkout is counted in `pending` under the `EngineRegistry` lock before it starts, so the registry, which checks & closes a pool under the
+    same lock, never closes a pool while a connection is being checked out of it. The lock is only held to update the count, not while waiting for a connection. """
+
+    def __init__(self, *args: object, **kwargs: object) -> None:
+        super().__init__(*args, **kwargs)
+        self.lock = None
+        self.pending = 0
+
+    def connect(self) -> object:
+        # Pools which are not tracked by a registry check out connections as usual.
+        lock = self.lock
+        if lock is None:
+            return super().connect()
+
+        with lock:
+            self.pending += 1
+        try:
+            return super().connect()
+        finally:
+            with lock:
+                self.pending -= 1
+
+    def recreate(self) -> 'RegistryPool':
+        # Keeps the new pool tracked when the engine is disposed, for example after a fork.
+        pool = super().recreate()
+        pool.lock = self.lock
+        return pool
+
+class EngineRegistry():
+    """ Creates the engines of the installed apps & closes the least recently used ones. See the module for details. Stored on the app services as `engine_registry`.
+
+    Params:
+        - settings_manager (SettingsManager) - The settings manager which holds the pragmas & the `APPS` limits.
+        - apps_path (str) - The directory the apps are installed in. Defaults to the `/apps` directory. """
+
+    def __init__(self, settings_manager: object, apps_path: str = Paths.APPS_ABS_PATH) -> None:
+        self.settings_manager = settings_manager
+        self.apps_path = apps_path
+
+        # The engines by `(app id, database name)`, & the keys of the engines with open connections, least recently used first, with the time they were last used.
+        self._engines = {}
+        self._open = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._last_sweep = time.monotonic()
+        self._engine_settings = self._get_engine_settings(settings_manager.settings)
+
+        self.opened = 0
+        self.evictions = 0
+
+        # Closes the idle engines even when no other engine is being used.
+        self._schedule_sweep()
+
+    @staticmethod
+    def _get_engine_settings(settings: object) -> tuple:
+        """ Returns a tuple of the settings which the engines are created with. If any of them change, the engines must be replaced. """
+
+        return (settings.apps_database_pool_size, settings.database_pool_timeout, settings.database_busy_timeout)
+
+    def engine(self, app_id: str, name: str = DEFAULT_DATABASE_NAME) -> object:
+        """ Returns the engine of an apps database, creating it if this is its first use. The database file is created by sqlite when the first connection is opened.
+
+        Params:
+            - app_id (str) - The id of the app.
+            - name (str) - The name of the database, which is stored as `<name>.db` in the apps directory. Defaults to `app`. """
+
+        key = (app_id, name)
+        engine = self._engines.get(key)
+        if engine is not None:
+            return engine
+
+        if not app_id.isidentifier() or not name.isidentifier():
+            raise ValueError(f'Invalid app database \'{app_id}/{name}\': app ids & database names must be identifiers.')
+
+        with self._lock:
+            if key not in self._engines:
+                path = os.path.join(self.apps_path, app_id, f'{name}.db')
+                metrics_name = f'app:{app_id}' if name == DEFAULT_DATABASE_NAME else f'app:{app_id}/{name}'
+                engine = create_sqlite_engine(Paths._DB_URL + path, self.settings_manager, metrics_name, self.settings_manager.apps_database_pool_size, 0, RegistryPool)
+                engine.pool.lock = self._lock
+
+                # Tracks when the engine is used, so idle engines can be closed.
+                event.listen(engine, 'checkout', lambda dbapi_connection, connection_record, connection_proxy: self._touch(key))
+                self._engines[key] = engine
+
+            return self._engines[key]
+
+    def _touch(self, key: tuple) -> None:
+        """ Marks an engine as used & closes the least recently used engines if too many are open. Called whenever a connection is checked out. """
+
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._open:
+                self.opened += 1
+            self._open[key] = now
+            self._open.move_to_end(key)
+
+            # Closes the least recently used idle engines over the limit. Engines with checked out connections are skipped, so the limit can be exceeded while they are in use.
+            excess = len(self._open) - max(1, self.settings_manager.apps_max_open_databases)
+            if excess > 0:
+                for other_key in list(self._open):
+                    if excess <= 0:
+                        break
+                    if other_key != key and self._close(other_key):
+                        excess -= 1
+
+            # Closes the engines which have been idle for too long, if they were not checked recently.
+            idle_timeout = self.settings_manager.apps_database_idle_timeout
+            if idle_timeout and now - self._last_sweep >= min(SWEEP_INTERVAL, idle_timeout):
+                self.close_idle(exclude=key)
+
+    def _schedule_sweep(self) -> None:
+        """ Schedules `close_idle()` to run every `SWEEP_INTERVAL` in this process. """
+
+        scheduler.schedule(IntervalTrigger(SWEEP_INTERVAL), self.close_idle, job_id=SWEEP_JOB_ID)
+
+    def close_idle(self, exclude: tuple = None) -> None:
+        """ Closes the engines which have not been used for longer than the `database_idle_timeout`. Run by the scheduler every `SWEEP_INTERVAL` & whenever an engine is used.
+
+        Params:
+            - exclude (tuple) - The key of an engine which is being used, so is never closed. """
+
+        idle_timeout = self.settings_manager.apps_database_idle_timeout
+        if not idle_timeout:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._last_sweep = now
+            for key, last_used in list(self._open.items()):
+                if key != exclude and now - last_used > idle_timeout:
+                    self._close(key)
+
+    def _close(self, key: tuple) -> bool:
+        """ Closes the pooled connections of an engine, if none are checked out or being checked out. Returns whether the engine was closed. The check & the close are made under the registry
+        lock, which every checkout takes before it starts, see `RegistryPool`. The pool itself is kept, so it opens new connections on its next checkout. """
+
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None and (engine.pool.checkedout() > 0 or getattr(engine.pool, 'pending', 0) > 0):
+                return False
+
+            self._open.pop(key, None)
+            if engine is None:
+                return True
+
+            engine.pool.dispose()
+            self.evictions += 1
+            return True
+
+    def close(self, app_id: str) -> None:
+        """ Closes & forgets every engine of an app, for example when it is unloaded or uninstalled. Connections which are checked out are closed when they are returned.
+
+        Params:
+            - app_id (str) - The id of the app. """
+
+        with self._lock:
+            for key in [key for key in self._engines if key[0] == app_id]:
+                self._open.pop(key, None)
+                self._engines.pop(key).dispose()
+
+    def close_all(self) -> None:
+        """ Closes & forgets every engine. """
+
+        with self._lock:
+            for app_id in {key[0] for key in self._engines}:
+                self.close(app_id)
+
+    def apply_settings(self, settings: object) -> None:
+        """ Applies a new settings snapshot. If the engine settings changed, every engine is closed & forgotten, so they are created again with the new settings on their next use.
+
+        Params:
+            - settings (Settings) - The new settings snapshot. """
+
+        engine_settings = self._get_engine_settings(settings)
+        if engine_settings != self._engine_settings:
+            self._engine_settings = engine_settings
+            self.close_all()
+
+    def reset_after_fork(self) -> None:
+        """ Drops the connections inherited from the parent process without closing them. Must be called in a forked child before the engines are used. """
+
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose(close=False)
+            self._open.clear()
+
+        # The scheduler drops the jobs inherited from the parent process.
+        self._schedule_sweep()
+
+    def stats(self) -> dict:
+        """ Returns the registrys statistics, reported in the metrics as the `app_engines` cache. """
+
+        return {
+            'size': len(self._open),
+            'max_size': self.settings_manager.apps_max_open_databases,
+            'engines': len(self._engines),
+            'opened': self.opened,
+            'evictions': self.evictions
+        }
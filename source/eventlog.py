@@ -0,0 +1,563 @@
+""" An append-only event log for high rate device & sensor readings. Each log is a directory of segment files under `/instance/events/<name>`. Records are appended to the newest segment &
+flushed to disk in batches, & a new segment is started once the current one is too large or too old. Reads are range scans by time over memory mapped segments. A background thread drops
+segments older than the retention period & merges small segments together. Each segment which is no longer appended to keeps its sparse index in a `.idx` file next to it, so opening a
+log does not read every segment.
+
+Each record is stored as a fixed size header followed by its JSON payload:
+    - timestamp (int64) - Nanoseconds since the epoch. Timestamps never decrease within a log.
+    - length (uint32) - The length of the payload in bytes.
+    - checksum (uint32) - The CRC32 of the payload, used to find a torn record after a crash.
+"""
+
+# Import internal packages
+from source.paths import Paths, write_file_atomic
+
+# Import standard packages
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator
+
+# Variables
+DEFAULT_SEGMENT_BYTES = 67108864 # 64 MiB.
+DEFAULT_SEGMENT_SECONDS = 3600
+DEFAULT_FSYNC_INTERVAL = 1.0 # Seconds.
+DEFAULT_FSYNC_RECORDS = 10000
+DEFAULT_MAINTENANCE_INTERVAL = 60.0 # Seconds.
+
+SEGMENT_EXTENSION = '.seg'
+INDEX_EXTENSION = '.idx'
+COMPACT_EXTENSION = '.compact'
+COMPACTION_MANIFEST = 'compaction.json'
+SEQUENCE_SEPARATOR = '-'
+HEADER = struct.Struct('<qII')
+INDEX_HEADER = struct.Struct('<QqII') # The segment size, last timestamp, number of entries & CRC32 of the entries.
+INDEX_INTERVAL = 4096 # Bytes between the sparse index entries of a segment.
+
+logger = logging.getLogger(__name__)
+
+class Segment():
+    """ One file of an event log. Keeps a sparse index of `(timestamp, offset)` pairs, one every `INDEX_INTERVAL` bytes, so range scans can skip straight to the right part of the file.
+
+    Params:
+        - path (str) - The path of the segment file. Its name is the timestamp of its first record & a sequence number, which tells apart segments started at the same timestamp, as
+        `<timestamp>-<sequence>.seg`. Segments named by older versions have no sequence number, which is read as `0`. """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        first_timestamp, _, sequence = os.path.basename(path)[:-len(SEGMENT_EXTENSION)].partition(SEQUENCE_SEPARATOR)
+        self.first_timestamp = int(first_timestamp)
+        self.sequence = int(sequence or 0)
+        self.size = 0
+        self.last_timestamp = None
+        self.index_timestamps = []
+        self.index_offsets = []
+
+    def add_to_index(self, timestamp: int, offset: int) -> None:
+        """ Adds a record to the sparse index if it is far enough from the previous index entry.
+
+        Params:
+            - timestamp (int) - The timestamp of the record.
+            - offset (int) - The offset of the record in the file. """
+
+        if not self.index_offsets or offset - self.index_offsets[-1] >= INDEX_INTERVAL:
+            self.index_timestamps.append(timestamp)
+            self.index_offsets.append(offset)
+
+    @property
+    def index_path(self) -> str:
+        return self.path[:-len(SEGMENT_EXTENSION)] + INDEX_EXTENSION
+
+    def load(self, path: str = None) -> int:
+        """ Reads the segment file through a memory map, building the sparse index & finding the end of the last complete record. Returns the offset where valid records end, which is smaller
+        than the file size if the last record was torn.
+
+        Params:
+            - path (str) - The file to read the records from. Defaults to the segments own file. """
+
+        self.index_timestamps, self.index_offsets = [], []
+        with open(path or self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                self.size = 0
+                return 0
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        # Walks the records, stopping at the first one which is incomplete or fails its checksum.
+        offset = 0
+        try:
+            with memoryview(mapped) as data:
+                while offset + HEADER.size <= size:
+                    timestamp, length, checksum = HEADER.unpack_from(data, offset)
+                    end = offset + HEADER.size + length
+                    if end > size or zlib.crc32(data[offset + HEADER.size:end]) != checksum:
+                        break
+
+                    self.add_to_index(timestamp, offset)
+                    self.last_timestamp = timestamp
+                    offset = end
+        finally:
+            mapped.close()
+
+        self.size = offset
+        return offset
+
+    def save_index(self) -> None:
+        """ Writes the sparse index to the `.idx` file next to the segment. Must only be called once the segment is no longer appended to. """
+
+        count = len(self.index_offsets)
+        entries = struct.pack(f'<{count}q{count}Q', *self.index_timestamps, *self.index_offsets)
+        last_timestamp = self.last_timestamp if self.last_timestamp is not None else -1
+        write_file_atomic(self.index_path, INDEX_HEADER.pack(self.size, last_timestamp, count, zlib.crc32(entries)) + entries)
+
+    def load_index(self) -> bool:
+        """ Reads the sparse index from the `.idx` file next to the segment. Returns `False` if there is no index file or it does not match the segment, in which case `load()` must be used. """
+
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            file_size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return False
+
+        # Checks that the index is complete & was written for the segment as it is now.
+        if len(data) < INDEX_HEADER.size:
+            return False
+        size, last_timestamp, count, checksum = INDEX_HEADER.unpack_from(data)
+        entries = data[INDEX_HEADER.size:]
+        if size != file_size or len(entries) != count * 16 or zlib.crc32(entries) != checksum:
+            return False
+
+        values = struct.unpack(f'<{count}q{count}Q', entries)
+        self.index_timestamps, self.index_offsets = list(values[:count]), list(values[count:])
+        self.last_timestamp = last_timestamp if last_timestamp >= 0 else None
+        self.size = size
+        return True
+
+    def remove(self) -> None:
+        """ Deletes the segment file & its index file. """
+
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def scan(self, start: int, end: int, size: int) -> Iterator[tuple[int, object]]:
+        """ Yields the `(timestamp, data)` of each record whose timestamp is within a range, reading the file through a memory map.
+
+        Params:
+            - start (int) - The earliest timestamp, inclusive.
+            - end (int) - The latest timestamp, inclusive.
+            - size (int) - The number of bytes of the file which hold complete records. """
+
+        if size == 0:
+            return
+
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        try:
+            # Starts from the last index entry before the range.
+            position = bisect.bisect_left(self.index_timestamps, start) - 1
+            offset = self.index_offsets[position] if position >= 0 else 0
+
+            # Walks the records until the end of the range.
+            while offset + HEADER.size <= size:
+                timestamp, length, _ = HEADER.unpack_from(mapped, offset)
+                payload_start = offset + HEADER.size
+                offset = payload_start + length
+                if offset > size or timestamp > end:
+                    break
+
+                if timestamp >= start:
+                    yield timestamp, json.loads(mapped[payload_start:offset])
+        finally:
+            mapped.close()
+
+class EventLog():
+    """ An append-only, segmented log of events. Records are JSON serializable objects stamped with the time they were appended. Example:
+    ```python
+    from source.eventlog import EventLog
+
+    temperatures = EventLog('temperature', retention_seconds=30 * 86400)
+    temperatures.append({'sensor': 'kitchen', 'celsius': 21.5})
+
+    for timestamp, reading in temperatures.range(start, end):
+        ...
+
+    temperatures.close()
+    ```
+
+    Records are written to the operating system straight away & flushed to disk every `fsync_interval` seconds or every `fsync_records` records, whichever comes first. Records written since the
+    last flush may be lost in a power cut, but a crash never leaves a log which cannot be read.
+
+    Params:
+        - name (str) - The name of the log. Its segments are stored in `/instance/events/<name>`.
+        - segment_bytes (int) - The size at which a new segment is started.
+        - segment_seconds (float) - The age at which a new segment is started.
+        - fsync_interval (float) - The maximum number of seconds between flushes to disk.
+        - fsync_records (int) - The maximum number of records between flushes to disk.
+        - retention_seconds (float) - Records older than this are deleted, a segment at a time. If `None`, records are kept forever.
+        - maintenance_interval (float) - The number of seconds between retention & compaction runs.
+        - directory (str) - The directory the logs are stored in. Defaults to `/instance/events`. """
+
+    def __init__(self, name: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES, segment_seconds: float = DEFAULT_SEGMENT_SECONDS, fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+                 fsync_records: int = DEFAULT_FSYNC_RECORDS, retention_seconds: float = None, maintenance_interval: float = DEFAULT_MAINTENANCE_INTERVAL,
+                 directory: str = Paths.EVENTS_ABS_PATH) -> None:
+        self.path = os.path.join(directory, name)
+        self.segment_bytes = segment_bytes
+        self.segment_nanoseconds = int(segment_seconds * 1e9)
+        self.fsync_interval = fsync_interval
+        self.fsync_records = fsync_records
+        self.retention_seconds = retention_seconds
+        self.maintenance_interval = maintenance_interval
+
+        # The lock guards the segments, the open file & the counters. Readers are counted so compaction never removes a segment which is being read. The maintenance lock keeps retention &
+        # compaction from running at the same time, as compaction reads segments outside of the lock.
+        self._lock = threading.Lock()
+        self._maintenance_lock = threading.Lock()
+        self._readers = 0
+        self._unsynced = 0
+        self._file = None
+        self._closed = threading.Event()
+
+        # Finishes or discards a compaction cut short by a crash, then loads the existing segments from their index files where they have one & opens the newest one for appending.
+        os.makedirs(self.path, exist_ok=True)
+        self._recover_compaction()
+        self._segments = sorted((Segment(os.path.join(self.path, name)) for name in os.listdir(self.path) if name.endswith(SEGMENT_EXTENSION)),
+                                key=lambda segment: (segment.first_timestamp, segment.sequence))
+        for segment in self._segments[:-1]:
+            if not segment.load_index():
+                segment.load()
+                segment.save_index()
+        if self._segments:
+            self._open_active(self._segments[-1])
+
+        # Starts the thread which flushes records to disk & runs retention & compaction.
+        self._thread = threading.Thread(target=self._run, name=f'eventlog-{name}', daemon=True)
+        self._thread.start()
+
+    def _open_active(self, segment: Segment) -> None:
+        """ Opens a segment for appending, cutting off a torn record left by a crash.
+
+        Params:
+            - segment (Segment) - The segment to append to. """
+
+        valid_size = segment.load()
+        self._file = open(segment.path, 'r+b')
+        if valid_size != os.fstat(self._file.fileno()).st_size:
+            logger.warning('Truncating a torn record at offset %d of %s.', valid_size, segment.path)
+            self._file.truncate(valid_size)
+        self._file.seek(valid_size)
+
+    def _recover_compaction(self) -> None:
+        """ Brings the segment files back to a consistent state after a crash during compaction. If the manifest of a compaction was written, the compaction is finished from it, as its merged
+        files are complete. Otherwise the merged files it left behind are deleted & the original segments are kept. """
+
+        manifest_path = os.path.join(self.path, COMPACTION_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+
+            # Swaps in the merged files which were not swapped in yet & deletes the rest of each run. Their index files are deleted, as they may be out of date.
+            for entry in manifest:
+                target = Segment(os.path.join(self.path, entry['target']))
+                merged_path = target.path + COMPACT_EXTENSION
+                if os.path.exists(merged_path):
+                    if os.path.exists(target.index_path):
+                        os.remove(target.index_path)
+                    os.replace(merged_path, target.path)
+                for name in entry['retired']:
+                    Segment(os.path.join(self.path, name)).remove()
+
+            os.remove(manifest_path)
+
+        for name in os.listdir(self.path):
+            if name.endswith(COMPACT_EXTENSION):
+                os.remove(os.path.join(self.path, name))
+
+    @property
+    def _active(self) -> Segment:
+        return self._segments[-1] if self._segments else None
+
+    @property
+    def _last_timestamp(self) -> int:
+        active = self._active
+        return active.last_timestamp if active is not None and active.last_timestamp is not None else 0
+
+    def _roll(self, timestamp: int) -> None:
+        """ Closes the current segment & starts a new one. Must be called with the lock held. Several segments can start at the same timestamp, for example when one batch is larger than
+        `segment_bytes`, so the new segment is numbered after the current one if they share it.
+
+        Params:
+            - timestamp (int) - The timestamp of the first record of the new segment. """
+
+        # Closes the current segment & saves its index, as it is never appended to again.
+        active = self._active
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            active.save_index()
+
+        sequence = active.sequence + 1 if active is not None and active.first_timestamp == timestamp else 0
+        segment = Segment(os.path.join(self.path, f'{timestamp:020d}{SEQUENCE_SEPARATOR}{sequence:06d}{SEGMENT_EXTENSION}'))
+        self._file = open(segment.path, 'xb')
+        self._segments.append(segment)
+
+    def _write(self, buffer: bytearray, count: int) -> None:
+        """ Writes buffered records to the open segment. Must be called with the lock held.
+
+        Params:
+            - buffer (bytearray) - The encoded records.
+            - count (int) - The number of records in the buffer. """
+
+        if buffer:
+            self._file.write(buffer)
+            self._active.size += len(buffer)
+            self._unsynced += count
+
+    def _sync(self) -> None:
+        """ Flushes the open segment to disk. Must be called with the lock held. """
+
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def append(self, data: object, timestamp: int = None) -> int:
+        """ Appends a record to the log & returns its timestamp. Timestamps never decrease, so a timestamp older than the last record is moved forward to it.
+
+        Params:
+            - data (object) - The JSON serializable content of the record.
+            - timestamp (int) - The nanoseconds since the epoch of the record. Defaults to now. """
+
+        return self.append_many([data], timestamp)[0]
+
+    def append_many(self, records: list, timestamp: int = None) -> list[int]:
+        """ Appends many records to the log in one write & returns their timestamps.
+
+        Params:
+            - records (list) - The JSON serializable content of each record.
+            - timestamp (int) - The nanoseconds since the epoch of the records. Defaults to now. """
+
+        payloads = [json.dumps(data, separators=(',', ':')).encode() for data in records]
+
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError('The event log is closed.')
+
+            timestamp = max(timestamp if timestamp is not None else time.time_ns(), self._last_timestamp)
+            timestamps = []
+            buffer = bytearray()
+            count = 0
+
+            for payload in payloads:
+                # Starts a new segment if the current one is full or too old, writing what has been buffered first.
+                active = self._active
+                if active is None or active.size + len(buffer) >= self.segment_bytes or timestamp - active.first_timestamp >= self.segment_nanoseconds:
+                    if active is not None:
+                        self._write(buffer, count)
+                    buffer, count = bytearray(), 0
+                    self._roll(timestamp)
+                    active = self._active
+
+                # Buffers the record & indexes it.
+                active.add_to_index(timestamp, active.size + len(buffer))
+                buffer += HEADER.pack(timestamp, len(payload), zlib.crc32(payload))
+                buffer += payload
+                active.last_timestamp = timestamp
+                timestamps.append(timestamp)
+                count += 1
+
+            # Writes the records & flushes them to disk if enough have built up.
+            self._write(buffer, count)
+            if self._unsynced >= self.fsync_records:
+                self._sync()
+
+        return timestamps
+
+    def range(self, start: int = 0, end: int = None) -> Iterator[tuple[int, object]]:
+        """ Yields the `(timestamp, data)` of each record with a timestamp within a range, oldest first. Records appended while the range is being read may not be included.
+
+        Params:
+            - start (int) - The earliest timestamp in nanoseconds since the epoch, inclusive.
+            - end (int) - The latest timestamp in nanoseconds since the epoch, inclusive. Defaults to the newest record. """
+
+        end = end if end is not None else 2 ** 63 - 1
+
+        # Finds the segments which overlap the range & how much of each has been written. Segments are sorted by their first timestamp, so each one ends where the next begins.
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+            segments = []
+            for index, segment in enumerate(self._segments):
+                next_first_timestamp = self._segments[index + 1].first_timestamp if index + 1 < len(self._segments) else None
+                if segment.first_timestamp <= end and (next_first_timestamp is None or next_first_timestamp >= start):
+                    segments.append((segment, segment.size))
+
+            self._readers += 1
+
+        # Scans each segment. A segment deleted by retention after it was listed only held expired records, so it is skipped.
+        try:
+            for segment, size in segments:
+                try:
+                    yield from segment.scan(start, end, size)
+                except FileNotFoundError:
+                    continue
+        finally:
+            with self._lock:
+                self._readers -= 1
+
+    def __iter__(self) -> Iterator[tuple[int, object]]:
+        return self.range()
+
+    def flush(self) -> None:
+        """ Flushes all the appended records to disk straight away. """
+
+        with self._lock:
+            self._sync()
+
+    def _run(self) -> None:
+        last_maintenance = time.monotonic()
+
+        while not self._closed.wait(self.fsync_interval):
+            # Flushes the records appended since the last flush.
+            with self._lock:
+                self._sync()
+
+            # Runs retention & compaction.
+            if time.monotonic() - last_maintenance >= self.maintenance_interval:
+                last_maintenance = time.monotonic()
+                try:
+                    self.apply_retention()
+                    self.compact()
+                except Exception:
+                    logger.exception('Event log maintenance failed for %s.', self.path)
+
+    def apply_retention(self) -> int:
+        """ Deletes the segments whose records are all older than the retention period. The newest segment is never deleted. Returns the number of segments deleted. """
+
+        if self.retention_seconds is None:
+            return 0
+
+        cutoff = time.time_ns() - int(self.retention_seconds * 1e9)
+
+        # A segment only holds records older than the first record of the next segment.
+        with self._maintenance_lock:
+            with self._lock:
+                expired = []
+                while len(self._segments) > 1 and self._segments[1].first_timestamp <= cutoff:
+                    expired.append(self._segments.pop(0))
+
+            # Readers which already mapped a deleted segment keep reading it until they finish.
+            for segment in expired:
+                segment.remove()
+
+        return len(expired)
+
+    def compact(self) -> int:
+        """ Merges runs of neighbouring small segments (each under a quarter of `segment_bytes`) into single segments, so long lived logs do not build up many small files. The newest segment is
+        never compacted, & nothing is compacted while the log is being read. The merged files are written outside of the lock, as only the newest segment is ever appended to, & the lock is only
+        taken again to swap them in, so appends are not held up by the copy. Returns the number of segments removed.
+
+        Each merged file is written next to the first segment of its run under a `.compact` name. Before anything is swapped in or deleted, a manifest listing the runs is written atomically, so
+        a crash before the manifest keeps the original segments & a crash after it is finished from the manifest when the log is opened again, never leaving overlapping segments. """
+
+        with self._maintenance_lock:
+            with self._lock:
+                if self._readers:
+                    return 0
+
+                # Finds the runs of neighbouring small segments which fit in one segment together.
+                small_size = self.segment_bytes // 4
+                runs, run, run_size = [], [], 0
+                for segment in self._segments[:-1]:
+                    if segment.size < small_size and run_size + segment.size <= self.segment_bytes:
+                        run.append(segment)
+                        run_size += segment.size
+                        continue
+
+                    if len(run) > 1:
+                        runs.append(run)
+                    run, run_size = ([segment], segment.size) if segment.size < small_size else ([], 0)
+
+                if len(run) > 1:
+                    runs.append(run)
+
+            if not runs:
+                return 0
+
+            # Writes the merged file of each run next to its first segment & indexes it.
+            manifest_path = os.path.join(self.path, COMPACTION_MANIFEST)
+            committed = False
+            merged = []
+            try:
+                for run in runs:
+                    merged_path = run[0].path + COMPACT_EXTENSION
+                    with open(merged_path, 'wb') as f:
+                        for segment in run:
+                            with open(segment.path, 'rb') as source:
+                                f.write(source.read(segment.size))
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    segment = Segment(run[0].path)
+                    segment.load(merged_path)
+                    merged.append((run, segment, merged_path))
+
+                # Commits the compaction by writing its manifest. From here on, a crash is finished from the manifest when the log is opened again.
+                manifest = [{'target': os.path.basename(run[0].path), 'retired': [os.path.basename(member.path) for member in run[1:]]} for run, _, _ in merged]
+                write_file_atomic(manifest_path, json.dumps(manifest))
+                committed = True
+
+                # Swaps the merged files in, unless a read started in the meantime. Each merged file replaces the first segment of its run atomically, so a reader never maps a file smaller
+                # than the size it was given.
+                with self._lock:
+                    if self._readers:
+                        os.remove(manifest_path)
+                        committed = False
+                        return 0
+
+                    replaced, dropped = {}, set()
+                    for run, segment, merged_path in merged:
+                        if os.path.exists(run[0].index_path):
+                            os.remove(run[0].index_path)
+                        os.replace(merged_path, run[0].path)
+                        replaced[id(run[0])] = segment
+                        dropped.update(id(member) for member in run[1:])
+                    self._segments = [replaced.get(id(segment), segment) for segment in self._segments if id(segment) not in dropped]
+
+                # Removes the rest of each run, which no reader can have open, & indexes the merged segments outside of the lock, then drops the manifest as the compaction is finished.
+                removed = 0
+                for run, segment, _ in merged:
+                    for member in run[1:]:
+                        member.remove()
+                        removed += 1
+                    segment.save_index()
+                os.remove(manifest_path)
+
+                return removed
+            finally:
+                # Removes the merged files which were not committed. Committed ones are left for the manifest to finish.
+                if not committed:
+                    for run in runs:
+                        if os.path.exists(run[0].path + COMPACT_EXTENSION):
+                            os.remove(run[0].path + COMPACT_EXTENSION)
+
+    def close(self) -> None:
+        """ Flushes all the appended records to disk, stops the background thread & closes the log. """
+
+        self._closed.set()
+        self._thread.join()
+
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,528 @@
+""" The in-process event bus, over which apps, devices & automations publish events to each other. The bus runs an asyncio event loop in a background thread next to the flask server, so async
+code publishes & subscribes on the loop directly, while synchronous flask handlers use the thread safe methods. The `event_bus` instance is shared by the whole program; in production mode each
+worker process has its own bus.
+
+Topics are `/` separated levels, such as `devices/kitchen/lamp/state`. Subscriptions match topics with patterns in which `+` matches exactly one level & a trailing `#` matches any number of levels,
+including none: `devices/+/lamp/#` matches both `devices/kitchen/lamp` & `devices/hall/lamp/state`. Patterns are kept in a trie, & the subscriptions matching each published topic are cached.
+
+Every subscription has its own bounded queue. When a queue is full, the subscriptions `overflow` policy either drops the oldest waiting event (`drop_oldest`), drops the new event (`drop_newest`), or
+makes the publisher wait until there is space (`block`). A subscription with a handler has the handler called for each event, or with a list of events when `batch_size` is above 1, which suits high
+rate sensors. A subscription without a handler is read by iterating over it. The queue size & default policy are set in the `EVENTS` section of `/instance/system.ini`. Example:
+```python
+from source.events import event_bus
+
+# From a flask route, or any other thread.
+event_bus.publish_threadsafe('devices/kitchen/lamp/state', {'on': True})
+
+# A handler, which may be a coroutine function. Synchronous handlers run on the bus thread, unless `threaded` is set.
+event_bus.subscribe('devices/+/lamp/state', lambda event: print(event.topic, event.payload))
+
+# From a coroutine on the bus loop.
+async def log_temperatures():
+    async with event_bus.subscribe('sensors/+/temperature') as subscription:
+        async for event in subscription:
+            ...
+``` """
+
+# Import internal packages
+from source.exceptions import InvalidTopic
+
+# Import standard packages
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import NamedTuple
+
+# Variables
+DEFAULT_QUEUE_SIZE = 1024 # Events waiting per subscription.
+DEFAULT_OVERFLOW = 'drop_oldest'
+DEFAULT_PUBLISH_TIMEOUT = 5.0 # Seconds `publish()` & `publish_threadsafe()` wait for the subscriptions with the `block` policy.
+PUBLISH_TIMEOUT_MARGIN = 1.0 # Extra seconds `publish_threadsafe()` waits, so `publish()` times out first on the loop.
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+MAX_CACHED_TOPICS = 4096
+
+logger = logging.getLogger(__name__)
+
+class Event(NamedTuple):
+    """ An event published on the bus.
+
+    Properties:
+        - topic (str) - The topic the event was published to.
+        - payload (object) - The payload given by the publisher. It is shared by every subscriber, so it must not be modified.
+        - timestamp (float) - The `time.time()` the event was published at. """
+
+    topic: str
+    payload: object
+    timestamp: float
+
+def split_topic(topic: str, pattern: bool = False) -> list:
+    """ Returns the levels of a topic or pattern. Raises `InvalidTopic` if it is empty, has an empty level, or uses wildcards where they are not allowed.
+
+    Params:
+        - topic (str) - The topic or pattern.
+        - pattern (bool) - Whether wildcards are allowed. """
+
+    levels = topic.split('/')
+    for index, level in enumerate(levels):
+        if not level:
+            raise InvalidTopic(f'\'{topic}\' has an empty level.')
+        if level in (SINGLE_LEVEL, MULTI_LEVEL) and not pattern:
+            raise InvalidTopic(f'\'{topic}\' is a pattern. Events must be published to a topic without wildcards.')
+        if level == MULTI_LEVEL and index != len(levels) - 1:
+            raise InvalidTopic(f'\'{topic}\' has a \'#\' which is not its last level.')
+        if (SINGLE_LEVEL in level or MULTI_LEVEL in level) and len(level) > 1:
+            raise InvalidTopic(f'\'{topic}\' has a wildcard which is not a whole level.')
+
+    return levels
+
+class _TopicNode():
+    """ A level of the subscription trie. """
+
+    __slots__ = ('children', 'subscriptions')
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.subscriptions = []
+
+class Subscription():
+    """ A subscription to the topics matching a pattern. Created by `EventBus.subscribe()`. Can be used as an async iterator & context manager when it has no handler.
+
+    Properties:
+        - pattern (str) - The topic pattern.
+        - overflow (str) - The policy applied when the queue is full, `drop_oldest`, `drop_newest` or `block`.
+        - owner (str) - The owner given when subscribing, such as an app id. `EventBus.unsubscribe_owner()` removes every subscription of an owner.
+        - delivered (int) - The number of events added to the queue.
+        - dropped (int) - The number of events dropped because the queue was full. """
+
+    def __init__(self, bus: 'EventBus', pattern: str, handler: callable, queue_size: int, overflow: str, batch_size: int, batch_interval: float, threaded: bool, owner: str) -> None:
+        self.bus = bus
+        self.pattern = pattern
+        self.handler = handler
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.threaded = threaded
+        self.owner = owner
+        self.delivered = 0
+        self.dropped = 0
+
+        # The queue & the handler task are created on the bus loop, see `_start()`.
+        self.queue = None
+        self._task = None
+        self._closed = False
+
+    def _start(self) -> None:
+        """ Creates the queue & starts the handler task. Must run on the bus loop. """
+
+        self.queue = asyncio.Queue(self.queue_size)
+        if self.handler is not None and not self._closed:
+            self._task = asyncio.get_running_loop().create_task(self._run_handler())
+
+    def _offer(self, event: Event) -> bool:
+        """ Adds an event to the queue without waiting, applying the overflow policy if it is full. Returns `False` if the publisher must wait for space, which only happens with the `block`
+        policy. Must run on the bus loop. """
+
+        queue = self.queue
+        if queue is None:
+            return True
+
+        if queue.full():
+            if self.overflow == 'block':
+                return False
+            self.dropped += 1
+            self.bus.dropped += 1
+            if self.overflow == 'drop_newest':
+                return True
+            queue.get_nowait()
+
+        queue.put_nowait(event)
+        self.delivered += 1
+        self.bus.delivered += 1
+        return True
+
+    async def _put(self, event: Event) -> None:
+        """ Waits for space in the queue & adds an event to it. Used for the `block` policy. """
+
+        await self.queue.put(event)
+        self.delivered += 1
+        self.bus.delivered += 1
+
+    async def get(self) -> Event:
+        """ Waits for & returns the next event. Must be awaited on the bus loop. """
+
+        return await self.queue.get()
+
+    async def get_batch(self) -> list:
+        """ Waits for the next event & returns it along with the events which arrive within `batch_interval`, up to `batch_size` events. Must be awaited on the bus loop. """
+
+        queue = self.queue
+        batch = [await queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            # Takes the events which are already waiting, then waits for more until the deadline.
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run_handler(self) -> None:
+        """ Calls the handler with every event, or every batch of events, until the subscription is closed. """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            argument = await (self.get() if self.batch_size == 1 else self.get_batch())
+            try:
+                if self.threaded:
+                    result = await loop.run_in_executor(None, self.handler, argument)
+                else:
+                    result = self.handler(argument)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                self.bus.errors += 1
+                logger.exception('Event handler for \'%s\' failed.', self.pattern)
+
+    def close(self) -> None:
+        """ Unsubscribes & stops the handler. Events still in the queue are discarded. Thread safe. """
+
+        self.bus.unsubscribe(self)
+
+    def __aiter__(self) -> 'Subscription':
+        return self
+
+    async def __anext__(self) -> Event:
+        return await self.get()
+
+    async def __aenter__(self) -> 'Subscription':
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        self.close()
+
+class EventBus():
+    """ A publish & subscribe bus running on an asyncio loop in a background thread. See the module for details. The loop is started by the first subscription or thread safe publish, & again in
+    a forked worker process, which drops the subscriptions inherited from its parent.
+
+    Params:
+        - queue_size (int) - The default number of events waiting per subscription.
+        - overflow (str) - The default policy applied when a subscriptions queue is full, `drop_oldest`, `drop_newest` or `block`.
+        - publish_timeout (float) - The number of seconds `publish()` & `publish_threadsafe()` wait for subscriptions with the `block` policy. """
+
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE, overflow: str = DEFAULT_OVERFLOW, publish_timeout: float = DEFAULT_PUBLISH_TIMEOUT) -> None:
+        self.configure(queue_size, overflow, publish_timeout)
+
+        # The subscription trie & the subscriptions matching each recently published topic. The cache is replaced whenever the subscriptions change.
+        self._root = _TopicNode()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        self.loop = None
+        self._thread = None
+        self._pid = None
+
+        self.subscriptions = 0
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def configure(self, queue_size: int, overflow: str, publish_timeout: float) -> None:
+        """ Applies new settings. Existing subscriptions keep their queue size & policy. Called by `/source/server.py` whenever the settings are loaded.
+
+        Params:
+            - queue_size (int) - The default number of events waiting per subscription.
+            - overflow (str) - The default policy applied when a subscriptions queue is full.
+            - publish_timeout (float) - The number of seconds `publish()` & `publish_threadsafe()` wait for subscriptions with the `block` policy. """
+
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.publish_timeout = publish_timeout
+
+    # Loop
+
+    def start(self) -> None:
+        """ Starts the loop thread if it is not running in this process. """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # Drops the subscriptions inherited from the parent process, as their queues & tasks belong to its loop.
+            if self._pid is not None:
+                self._root = _TopicNode()
+                self._cache = {}
+                self.subscriptions = 0
+
+            ready = threading.Event()
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run_loop, args=(self.loop, ready), name='event-bus', daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop, ready: threading.Event) -> None:
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+        loop.close()
+
+    def stop(self, timeout: float = None) -> None:
+        """ Stops the loop thread, cancelling the handlers. The next subscription or thread safe publish starts it again.
+
+        Params:
+            - timeout (float) - The number of seconds to wait for the thread. If `None`, waits until it stops. """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+
+            loop, thread = self.loop, self._thread
+            self._root = _TopicNode()
+            self._cache = {}
+            self.subscriptions = 0
+            self._pid = self.loop = self._thread = None
+
+        # Cancels the handlers & waits for them to finish before stopping the loop.
+        async def shutdown() -> None:
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop)
+        thread.join(timeout)
+
+    def _on_loop(self) -> bool:
+        """ Returns whether the caller is running on the bus loop. """
+
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    # Subscriptions
+
+    def subscribe(self, pattern: str, handler: callable = None, queue_size: int = None, overflow: str = None, batch_size: int = 1, batch_interval: float = 0.0, threaded: bool = False,
+                  owner: str = None) -> Subscription:
+        """ Subscribes to the topics matching a pattern & returns the subscription. Thread safe.
+
+        Params:
+            - pattern (str) - The topic pattern, see the module for the wildcards.
+            - handler (callable) - Called with each event, or with a list of events if `batch_size` is above 1. May be a coroutine function. If `None`, the events are read by iterating over the
+            subscription on the bus loop.
+            - queue_size (int) - The number of events which can wait for the handler. Defaults to the `queue_size` setting.
+            - overflow (str) - The policy applied when the queue is full, `drop_oldest`, `drop_newest` or `block`. Defaults to the `overflow` setting.
+            - batch_size (int) - The largest number of events given to the handler at once.
+            - batch_interval (float) - The number of seconds a batch waits for more events after its first one.
+            - threaded (bool) - Whether a synchronous handler is run in a thread pool rather than on the bus thread. Set it for handlers which block, such as ones using the databases.
+            - owner (str) - The owner of the subscription, such as an app id, so `unsubscribe_owner()` can remove it. """
+
+        levels = split_topic(pattern, pattern=True)
+        overflow = overflow or self.overflow
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Overflow policy must be one of {", ".join(OVERFLOW_POLICIES)}.')
+
+        self.start()
+        subscription = Subscription(self, pattern, handler, queue_size or self.queue_size, overflow, max(1, batch_size), batch_interval, threaded, owner)
+
+        # Creates the queue on the loop before the subscription can receive events.
+        if self._on_loop():
+            subscription._start()
+        else:
+            done = threading.Event()
+            self.loop.call_soon_threadsafe(lambda: (subscription._start(), done.set()))
+            done.wait()
+
+        # Adds the subscription to the trie.
+        with self._lock:
+            node = self._root
+            for level in levels:
+                node = node.children.setdefault(level, _TopicNode())
+            node.subscriptions.append(subscription)
+            self._cache = {}
+            self.subscriptions += 1
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """ Removes a subscription & stops its handler. Thread safe.
+
+        Params:
+            - subscription (Subscription) - The subscription returned by `subscribe()`. """
+
+        with self._lock:
+            if subscription._closed:
+                return
+            subscription._closed = True
+
+            # Removes the subscription from the trie, pruning the levels which are left empty.
+            path = [self._root]
+            for level in subscription.pattern.split('/'):
+                node = path[-1].children.get(level)
+                if node is None:
+                    return
+                path.append(node)
+
+            if subscription in path[-1].subscriptions:
+                path[-1].subscriptions.remove(subscription)
+                self.subscriptions -= 1
+            for level, parent, node in zip(reversed(subscription.pattern.split('/')), reversed(path[:-1]), reversed(path[1:])):
+                if node.children or node.subscriptions:
+                    break
+                del parent.children[level]
+            self._cache = {}
+
+        # Stops the handler.
+        if subscription._task is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(subscription._task.cancel)
+
+    def unsubscribe_owner(self, owner: str) -> None:
+        """ Removes every subscription of an owner, for example when an app is unloaded. Thread safe.
+
+        Params:
+            - owner (str) - The owner given when subscribing. """
+
+        pending = [self._root]
+        owned = []
+        with self._lock:
+            while pending:
+                node = pending.pop()
+                owned += [subscription for subscription in node.subscriptions if subscription.owner == owner]
+                pending += node.children.values()
+
+        for subscription in owned:
+            self.unsubscribe(subscription)
+
+    def match(self, topic: str) -> tuple:
+        """ Returns the subscriptions whose pattern matches a topic.
+
+        Params:
+            - topic (str) - The topic, without wildcards. """
+
+        cache = self._cache
+        subscriptions = cache.get(topic)
+        if subscriptions is not None:
+            return subscriptions
+
+        levels = split_topic(topic)
+        found = []
+        with self._lock:
+            # Walks every branch of the trie which matches the topic. A `#` matches the rest of the topic, including no levels.
+            pending = [(self._root, 0)]
+            while pending:
+                node, index = pending.pop()
+                multi = node.children.get(MULTI_LEVEL)
+                if multi is not None:
+                    found += multi.subscriptions
+                if index == len(levels):
+                    found += node.subscriptions
+                    continue
+                for key in (levels[index], SINGLE_LEVEL):
+                    child = node.children.get(key)
+                    if child is not None:
+                        pending.append((child, index + 1))
+
+            # Caches the result, unless the subscriptions changed since the cache was read.
+            subscriptions = tuple(found)
+            if cache is self._cache:
+                if len(cache) >= MAX_CACHED_TOPICS:
+                    cache.clear()
+                cache[topic] = subscriptions
+
+        return subscriptions
+
+    # Publishing
+
+    async def publish(self, topic: str, payload: object = None) -> int:
+        """ Publishes an event to every matching subscription, waiting for space in the queues of the subscriptions with the `block` policy. The blocked subscriptions are waited for together, so
+        one slow subscriber does not delay the others, for up to `publish_timeout` seconds, after which the event is not added to the ones still blocked & `TimeoutError` is raised. Must be
+        awaited on the bus loop. Returns the number of matching subscriptions.
+
+        Params:
+            - topic (str) - The topic, without wildcards.
+            - payload (object) - The payload, shared by every subscriber. """
+
+        event = Event(topic, payload, time.time())
+        subscriptions = self.match(topic)
+        self.published += 1
+
+        # Adds the event to every queue with space, then waits for the blocked queues concurrently.
+        blocked = [subscription._put(event) for subscription in subscriptions if not subscription._offer(event)]
+        if blocked:
+            await asyncio.wait_for(asyncio.gather(*blocked), self.publish_timeout)
+
+        return len(subscriptions)
+
+    def publish_nowait(self, topic: str, payload: object = None) -> int:
+        """ Publishes an event without waiting. Subscriptions with the `block` policy & a full queue have the event added once they have space. Must be called on the bus loop. Returns the number of
+        matching subscriptions.
+
+        Params:
+            - topic (str) - The topic, without wildcards.
+            - payload (object) - The payload, shared by every subscriber. """
+
+        event = Event(topic, payload, time.time())
+        subscriptions = self.match(topic)
+        self.published += 1
+
+        for subscription in subscriptions:
+            if not subscription._offer(event):
+                self.loop.create_task(subscription._put(event))
+
+        return len(subscriptions)
+
+    def publish_threadsafe(self, topic: str, payload: object = None, wait: bool = True) -> int:
+        """ Publishes an event from another thread, such as a flask request handler. Raises `InvalidTopic` straight away if the topic is invalid, & `TimeoutError` if the event could not be
+        added to every subscription within `publish_timeout`. Called on the bus loop, it does the same as `publish_nowait()`. Returns the number of matching subscriptions.
+
+        Params:
+            - topic (str) - The topic, without wildcards.
+            - payload (object) - The payload, shared by every subscriber.
+            - wait (bool) - Whether to wait, for up to `publish_timeout` seconds, until every subscription has the event. This applies backpressure from subscriptions with the `block` policy
+            to the caller. If `False`, returns straight away with the number of subscriptions matched when it was called. """
+
+        self.start()
+        if self._on_loop():
+            return self.publish_nowait(topic, payload)
+
+        count = len(self.match(topic))
+        if not wait:
+            self.loop.call_soon_threadsafe(self.publish_nowait, topic, payload)
+            return count
+
+        # Waits for the event to be added to every subscription, giving up on the ones still blocked after the timeout. `publish()` applies the timeout itself, so the wait here has a margin
+        # on top & only expires if the loop is stuck.
+        future = asyncio.run_coroutine_threadsafe(self.publish(topic, payload), self.loop)
+        try:
+            return future.result(self.publish_timeout + PUBLISH_TIMEOUT_MARGIN)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stats(self) -> dict:
+        """ Returns the buses statistics, reported in the metrics as the `events` cache. """
+
+        return {'subscriptions': self.subscriptions, 'published': self.published, 'delivered': self.delivered, 'dropped': self.dropped, 'errors': self.errors}
+
+# The event bus shared by the whole program.
+event_bus = EventBus()
@@ -1,5 +1,19 @@
 """ These are custom exceptions which could rise in the program. Each will have different cases in what the system does. """
 
+# Config
+class InvalidSettingValue(Exception):
+    """ Raised when a value in the `/instance/system.ini` file is not one of the values the system accepts. """
+    pass
+
+# Hashing
+class HashingQueueFull(Exception):
+    """ Raised when the password hasher already has the maximum number of passwords waiting to be hashed or verified & no space became free in time. """
+    pass
+
+class InvalidHashMethod(Exception):
+    """ Raised when the password hasher is configured with a method which is not a valid `pbkdf2` or `scrypt` werkzeug method. """
+    pass
+
 # Paths
 class InvalidFileExtension(Exception):
     """ Raised when the `source.paths.Files.create_file()` is given an invalid file extension. This is usually due to the extension not starting with a `.`. """
@@ -7,4 +21,28 @@ class InvalidFileExtension(Exception):
 
 class ProfileTypeStillActive(Exception):
     """ Raised when a consumer attempts to delete a profile type from the database, however the database manager has found at least one user that is still using that profile type. """
-    pass
\ No newline at end of file
+    pass
+
+# Permissions
+class UnknownPermission(Exception):
+    """ Raised when a permission is checked which is not a `Boolean` column of the `ProfileTypes` table. """
+    pass
+
+# Events
+class InvalidTopic(Exception):
+    """ Raised when an event is published to, or a subscription is made to, a topic which is not valid for the event bus. See `/source/events.py` for the topic format. """
+    pass
+
+# Scheduler
+class InvalidSchedule(Exception):
+    """ Raised when a schedule is given a trigger which cannot be parsed or never fires, or a persisted schedule is given a function which cannot be imported by name. """
+    pass
+
+# Backups
+class SnapshotNotFound(Exception):
+    """ Raised when a snapshot is restored which does not exist in the backups directory. """
+    pass
+
+class SnapshotCorrupt(Exception):
+    """ Raised when a snapshot being restored references a chunk which is missing or whose content does not match its hash. Nothing is restored. """
+    pass
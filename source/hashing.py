@@ -0,0 +1,221 @@
+""" Password hashing for Xenon. Hashing & verifying passwords is deliberately slow, so it is run in a pool of worker processes rather than on the request threads. This keeps the work outside of the
+GIL, so a few simultaneous logins do not stall the rest of the server. The `password_hasher` instance is shared by the whole program & is configured by `/source/server.py` from the `HASHING` section
+of the `/instance/system.ini` file. """
+
+# Import internal packages
+from source.exceptions import HashingQueueFull, InvalidHashMethod
+
+# Import external packages
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Import standard packages
+import asyncio
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+
+# Variables
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 64
+DEFAULT_QUEUE_TIMEOUT = 5.0 # Seconds.
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+DEFAULT_SALT_LENGTH = 16
+
+# The parameters werkzeug fills in for the `scrypt` method when none are given.
+SCRYPT_DEFAULTS = (2 ** 15, 8, 1)
+
+# The pool workers are started from a clean process rather than forked from the server, as forking while request threads hold locks can deadlock the child.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def canonical_method(method: str) -> str:
+    """ Returns a werkzeug hashing method with the parameters werkzeug would fill in, which is the prefix of the hashes it makes. For example, `pbkdf2` becomes `pbkdf2:sha256:600000` & `scrypt`
+    becomes `scrypt:32768:8:1`. Nothing is hashed, so this is cheap. Raises `InvalidHashMethod` if the method is not a valid `pbkdf2` or `scrypt` method.
+
+    Params:
+        - method (str) - The method, as written in the `HASHING` section of the `/instance/system.ini` file. """
+
+    name, *args = method.split(':')
+
+    try:
+        # `scrypt` takes either no parameters or all three of `n`, `r` & `p`.
+        if name == 'scrypt' and len(args) in (0, 3):
+            n, r, p = map(int, args) if args else SCRYPT_DEFAULTS
+            if n > 1 and n & (n - 1) == 0 and r > 0 and p > 0:
+                return f'scrypt:{n}:{r}:{p}'
+
+        # `pbkdf2` takes an optional hash name & an optional number of iterations.
+        elif name == 'pbkdf2' and len(args) <= 2:
+            hash_name = args[0] if args else 'sha256'
+            iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+            hashlib.new(hash_name)
+            if iterations > 0:
+                return f'pbkdf2:{hash_name}:{iterations}'
+    except ValueError:
+        pass
+
+    raise InvalidHashMethod(f'\'{method}\' is not a valid pbkdf2 or scrypt hashing method.')
+
+class PasswordHasher():
+    """ Hashes & verifies passwords in a bounded pool of worker processes. Both blocking & awaitable versions of each call are available. Example:
+    ```python
+    from source.hashing import password_hasher
+
+    hashed_password = password_hasher.hash('hunter2')
+    password_hasher.verify(hashed_password, 'hunter2') # Returns `True`.
+
+    verified = await password_hasher.verify_async(hashed_password, 'hunter2')
+    ```
+
+    At most `max_pending` passwords can be waiting on the pool at once. Once the limit is reached, callers wait up to `queue_timeout` seconds for space (awaitable calls do not wait) before
+    `HashingQueueFull` is raised.
+
+    Params:
+        - workers (int) - The number of worker processes. If 0, passwords are hashed on the calling thread.
+        - max_pending (int) - The maximum number of passwords waiting to be hashed or verified.
+        - queue_timeout (float) - The number of seconds a blocking call waits for space when the pool is full.
+        - method (str) - The werkzeug hashing method new hashes are made with. Hashes made with a different method are rehashed on the next successful login. Shorthand methods such as
+        `pbkdf2` are expanded by `canonical_method()`.
+        - salt_length (int) - The length of the salt of new hashes. """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, max_pending: int = DEFAULT_MAX_PENDING, queue_timeout: float = DEFAULT_QUEUE_TIMEOUT, method: str = DEFAULT_METHOD,
+                 salt_length: int = DEFAULT_SALT_LENGTH) -> None:
+        self._lock = threading.Lock()
+        self._executor = None
+
+        # The number of passwords waiting on the pool, guarded by a condition which callers wait on for space. A counter is used rather than a semaphore, so `max_pending` can change while
+        # calls are in flight.
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+        self.configure(workers, max_pending, queue_timeout, method, salt_length)
+
+    def configure(self, workers: int, max_pending: int, queue_timeout: float, method: str, salt_length: int = DEFAULT_SALT_LENGTH) -> None:
+        """ Changes the hashers settings. If the number of workers changed, the current pool is shut down once its pending work is done & a new one is started on the next call. See the class
+        for the parameters. Raises `InvalidHashMethod` if the method is not valid, in which case nothing is changed. """
+
+        method = canonical_method(method)
+
+        with self._lock:
+            # Shuts down the current pool if it is the wrong size.
+            if self._executor is not None and workers != self.workers:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+            self.workers = workers
+            self.queue_timeout = queue_timeout
+            self.method = method
+            self.salt_length = salt_length
+
+        # Wakes the callers waiting for space, as the limit may have grown.
+        with self._pending_condition:
+            self.max_pending = max_pending
+            self._pending_condition.notify_all()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """ Returns the process pool, starting it on first use. """
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD))
+            return self._executor
+
+    def _reset_after_fork(self) -> None:
+        """ Forgets the parents process pool in a forked child, as its workers belong to the parent. The child starts its own pool on first use. """
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+
+    def _submit(self, function: callable, *args: object, timeout: float) -> concurrent.futures.Future:
+        """ Submits a call to the pool & returns its future. Raises `HashingQueueFull` if no space becomes free within `timeout` seconds.
+
+        Params:
+            - function (callable) - The werkzeug function to call.
+            - args (object) - The arguments of the call.
+            - timeout (float) - The number of seconds to wait for space. """
+
+        # Runs the call on this thread if there is no pool.
+        if self.workers == 0:
+            future = concurrent.futures.Future()
+            future.set_result(function(*args))
+            return future
+
+        # Waits for space in the queue, then submits the call & frees the space once it completes.
+        with self._pending_condition:
+            if not self._pending_condition.wait_for(lambda: self._pending < self.max_pending, timeout):
+                raise HashingQueueFull(f'{self.max_pending} passwords are already waiting to be hashed.')
+            self._pending += 1
+
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._release_pending()
+            raise
+
+        future.add_done_callback(lambda _: self._release_pending())
+        return future
+
+    def _release_pending(self) -> None:
+        """ Frees the space of a completed call & wakes a caller waiting for it. """
+
+        with self._pending_condition:
+            self._pending -= 1
+            self._pending_condition.notify()
+
+    def hash(self, password: str) -> str:
+        """ Returns a hashed version of a clear text password. Blocks until the hash is ready.
+
+        Params:
+            - password (str) - The clear text password to hash. """
+
+        return self._submit(generate_password_hash, password, self.method, self.salt_length, timeout=self.queue_timeout).result()
+
+    def verify(self, hashed_password: str, password: str) -> bool:
+        """ Returns a bool based on whether a clear text password matches a hashed version. Blocks until the check is done.
+
+        Params:
+            - hashed_password (str) - The stored hashed password.
+            - password (str) - The clear text password to check. """
+
+        return self._submit(check_password_hash, hashed_password, password, timeout=self.queue_timeout).result()
+
+    async def hash_async(self, password: str) -> str:
+        """ The awaitable version of `hash()`. Raises `HashingQueueFull` straight away if the pool is full. """
+
+        return await asyncio.wrap_future(self._submit(generate_password_hash, password, self.method, self.salt_length, timeout=0))
+
+    async def verify_async(self, hashed_password: str, password: str) -> bool:
+        """ The awaitable version of `verify()`. Raises `HashingQueueFull` straight away if the pool is full. """
+
+        return await asyncio.wrap_future(self._submit(check_password_hash, hashed_password, password, timeout=0))
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """ Returns a bool based on whether a hashed password was made with different parameters from the current method & salt length, so it should be replaced.
+
+        Params:
+            - hashed_password (str) - The stored hashed password. """
+
+        # Werkzeug hashes are formatted as `<method>$<salt>$<hash>`.
+        try:
+            method, salt, _ = hashed_password.split('$', 2)
+        except ValueError:
+            return True
+
+        return method != self.method or len(salt) < self.salt_length
+
+    def shutdown(self) -> None:
+        """ Shuts down the process pool once its pending work is done. """
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+# The hasher shared by the whole program.
+password_hasher = PasswordHasher()
+
+# Forked processes must not use the parents pool.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=password_hasher._reset_after_fork)
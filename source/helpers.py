@@ -7,10 +7,40 @@ import source.helpers as helpers
 
 # Import standard packages
 import datetime
+import functools
+import os
+import zoneinfo
 
-def get_current_datetime() -> datetime.datetime:
-    """ Returns a `datetime.datetime` object of the current datetime. """
-    return datetime.datetime.now()
+@functools.lru_cache(maxsize=64)
+def get_timezone(name: str = None) -> datetime.tzinfo:
+    """ Returns a `zoneinfo.ZoneInfo` timezone, which follows daylight saving time changes. Raises `zoneinfo.ZoneInfoNotFoundError` if the timezone does not exist.
+
+    Params:
+        - name (str) - The IANA name of the timezone, such as `Europe/London`. If `None` or empty, the systems local timezone, read from the `TZ` environment variable or `/etc/localtime`. """
+
+    if name:
+        return zoneinfo.ZoneInfo(name)
+
+    # Finds the name of the local timezone. A fixed offset from `astimezone()` would be wrong on the other side of a daylight saving time change.
+    name = os.environ.get('TZ', '').lstrip(':')
+    if not name and os.path.islink('/etc/localtime'):
+        name = os.path.realpath('/etc/localtime').partition('zoneinfo/')[2]
+
+    try:
+        return zoneinfo.ZoneInfo(name) if name else datetime.timezone.utc
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc
+
+def get_current_datetime(timezone: datetime.tzinfo = None) -> datetime.datetime:
+    """ Returns a timezone aware `datetime.datetime` object of the current datetime.
+
+    Params:
+        - timezone (datetime.tzinfo) - The timezone of the returned datetime. Defaults to the systems local timezone. """
+    return datetime.datetime.now(timezone or get_timezone())
+
+def get_current_utc_datetime() -> datetime.datetime:
+    """ Returns a timezone aware `datetime.datetime` object of the current datetime in UTC. Used as the default of datetime columns, which are stored in UTC. """
+    return datetime.datetime.now(datetime.timezone.utc)
 
 def convert_to_iso(datetime_: datetime.datetime) -> str:
     """ Converts a `datetime.datetime` object to ISO 8601 format.
@@ -0,0 +1,372 @@
+""" Request & SQL instrumentation for Xenon. The shared `metrics` instance records a latency histogram for every endpoint through flask request hooks, & the count & total duration of every SQL statement
+through SQLAlchemy engine events. Statements repeated many times within one request are counted as N+1 query patterns & logged. Cache & connection pool gauges are read when the metrics are rendered.
+Everything is exposed in the Prometheus text format by the `/metrics` route in `/routes/metrics.py`.
+
+Recording costs a couple of timer reads & a short locked update per request or statement, so it is meant to stay on in production. It is configured from the `METRICS` section of the
+`/instance/system.ini` file. In production mode each worker process keeps its own metrics. The metrics include raw SQL, so `/metrics` is only served to the addresses listed in
+`allowed_addresses`, which defaults to the local machine. Behind a reverse proxy every request comes from the proxies address, so the proxy must not forward `/metrics`. Example:
+```python
+from source.metrics import metrics
+
+metrics.init_app(server)
+metrics.instrument_engine(engine, 'read')
+metrics.register_cache('users', users_cache.stats)
+
+print(metrics.render())
+``` """
+
+# Import external packages
+from flask import request
+from sqlalchemy import event
+
+# Import standard packages
+import bisect
+import collections
+import ipaddress
+import logging
+import re
+import threading
+import time
+import weakref
+
+# Variables
+DEFAULT_ENABLED = True
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10 # Times one statement must run in a request to be counted as an N+1 pattern.
+DEFAULT_MAX_STATEMENTS = 256 # Distinct statements tracked before new ones are counted together as `other`.
+DEFAULT_ALLOWED_ADDRESSES = '127.0.0.1, ::1' # Addresses & networks which may read `/metrics`, separated by commas.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds.
+STATEMENTS_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250) # Statements per request.
+
+MAX_STATEMENT_LENGTH = 200 # Characters of a statement kept in its label.
+OTHER_STATEMENT = 'other'
+UNMATCHED_ENDPOINT = '<unmatched>'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Cache statistics which only ever increase, rendered as counters. Every other statistic is rendered as a gauge.
+CACHE_COUNTERS = ('hits', 'misses', 'evictions', 'invalidations', 'coalesced_writes', 'flushed_writes', 'opened', 'published', 'delivered', 'dropped', 'errors', 'runs', 'skipped', 'uncacheable')
+
+_WHITESPACE = re.compile(r'\s+')
+
+logger = logging.getLogger(__name__)
+
+def _escape(value: object) -> str:
+    """ Returns a value escaped for use as a Prometheus label value. """
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """ Returns the `{name="value",...}` part of a sample line. """
+
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram():
+    """ A thread safe histogram with a fixed set of buckets, kept separately for each combination of label values.
+
+    Params:
+        - name (str) - The metric name.
+        - description (str) - The help text of the metric.
+        - label_names (tuple) - The names of the labels each observation is given.
+        - buckets (tuple) - The upper bounds of the buckets, in ascending order. """
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+
+        # The series are stored as `label values: [bucket counts, count, sum]`. The bucket counts are not cumulative, they are summed when rendered.
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, value: float) -> None:
+        """ Records an observation.
+
+        Params:
+            - label_values (tuple) - The label values, in the order of `label_names`.
+            - value (float) - The observed value. """
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def clear(self) -> None:
+        """ Removes every recorded observation. """
+
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list:
+        """ Returns the lines of the histogram in the Prometheus text format. """
+
+        with self._lock:
+            series = [(label_values, list(counts), count, total) for label_values, (counts, count, total) in self._series.items()]
+
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for label_values, counts, count, total in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                bucket_label = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, label_values, bucket_label)} {cumulative}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total}')
+
+        return lines
+
+def parse_networks(addresses: str) -> tuple:
+    """ Returns the networks of a comma separated list of addresses & networks, such as `127.0.0.1, ::1, 10.0.0.0/8`. Raises `ValueError` if any of them is not valid.
+
+    Params:
+        - addresses (str) - The addresses & networks, separated by commas. """
+
+    return tuple(ipaddress.ip_network(address.strip(), strict=False) for address in addresses.split(',') if address.strip())
+
+class Metrics():
+    """ Records request & SQL metrics & renders them, along with the registered cache & pool gauges, in the Prometheus text format. See the module for details.
+
+    Params:
+        - enabled (bool) - Whether requests & statements are recorded.
+        - n_plus_one_threshold (int) - The number of times a statement must run within one request to be counted as an N+1 pattern.
+        - max_statements (int) - The number of distinct statements tracked. Further statements are counted together as `other`.
+        - allowed_addresses (str) - The addresses & networks which may read the metrics, separated by commas. """
+
+    def __init__(self, enabled: bool = DEFAULT_ENABLED, n_plus_one_threshold: int = DEFAULT_N_PLUS_ONE_THRESHOLD, max_statements: int = DEFAULT_MAX_STATEMENTS,
+                 allowed_addresses: str = DEFAULT_ALLOWED_ADDRESSES) -> None:
+        self.enabled = enabled
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.max_statements = max_statements
+        self.allowed_networks = parse_networks(allowed_addresses)
+
+        self.request_latency = Histogram('xenon_request_duration_seconds', 'Time taken to handle a request.', ('method', 'endpoint', 'status'), LATENCY_BUCKETS)
+        self.request_statements = Histogram('xenon_request_sql_statements', 'SQL statements executed by a request.', ('endpoint',), STATEMENTS_BUCKETS)
+
+        # The statement counters are stored as `statement: [count, seconds]` & `engine name: [count, seconds]`, & the N+1 counters as `(endpoint, statement): count`.
+        self._statements = {}
+        self._engine_statements = {}
+        self._n_plus_one = collections.Counter()
+        self._lock = threading.Lock()
+
+        # The state of the request handled by the current thread.
+        self._local = threading.local()
+
+        # The instrumented engines & the registered caches, by name, & the names of the instrumented engines.
+        self._engines = weakref.WeakValueDictionary()
+        self._engine_names = weakref.WeakKeyDictionary()
+        self._caches = {}
+        self._histograms = {}
+
+    def configure(self, enabled: bool, n_plus_one_threshold: int, allowed_addresses: str = DEFAULT_ALLOWED_ADDRESSES) -> None:
+        """ Applies new settings. Called by `/source/server.py` whenever the settings are loaded.
+
+        Params:
+            - enabled (bool) - Whether requests & statements are recorded.
+            - n_plus_one_threshold (int) - The number of times a statement must run within one request to be counted as an N+1 pattern.
+            - allowed_addresses (str) - The addresses & networks which may read the metrics, separated by commas. """
+
+        self.enabled = enabled
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.allowed_networks = parse_networks(allowed_addresses)
+
+    def allows(self, address: str) -> bool:
+        """ Returns whether a client address may read the metrics.
+
+        Params:
+            - address (str) - The address of the client, such as `request.remote_addr`. """
+
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+
+        return any(address in network for network in self.allowed_networks)
+
+    def init_app(self, app: object) -> None:
+        """ Registers the request hooks which time every request of an app.
+
+        Params:
+            - app (Flask) - The app to instrument. """
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def instrument_engine(self, engine: object, name: str) -> None:
+        """ Registers the events which time every statement executed by an engine, counted both by statement & by engine name, & reports the engines pool in the gauges. An engine replacing
+        one of the same name takes over its gauges & totals.
+
+        Params:
+            - engine (Engine) - The SQLAlchemy engine.
+            - name (str) - The name the pool gauges are labelled with. """
+
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._engines[name] = engine
+        self._engine_names[engine] = name
+
+    def register_cache(self, name: str, stats: object) -> None:
+        """ Reports a cache in the gauges.
+
+        Params:
+            - name (str) - The name the cache gauges are labelled with.
+            - stats (callable) - Returns a dictionary of the caches statistics, such as `LRUCache.stats`. """
+
+        self._caches[name] = stats
+
+    def register_histogram(self, histogram: Histogram) -> None:
+        """ Renders a histogram recorded by another part of the program along with the request histograms.
+
+        Params:
+            - histogram (Histogram) - The histogram. One registered under the same name replaces it. """
+
+        self._histograms[histogram.name] = histogram
+
+    def reset(self) -> None:
+        """ Removes every recorded request & statement. """
+
+        self.request_latency.clear()
+        self.request_statements.clear()
+        with self._lock:
+            self._statements.clear()
+            self._engine_statements.clear()
+            self._n_plus_one.clear()
+
+    # Flask hooks
+
+    def _before_request(self) -> None:
+        if not self.enabled:
+            return
+
+        self._local.started = time.perf_counter()
+        self._local.statements = collections.Counter()
+        self._local.status = None
+
+    def _after_request(self, response: object) -> object:
+        self._local.status = response.status_code
+        return response
+
+    def _teardown_request(self, exception: BaseException = None) -> None:
+        started = getattr(self._local, 'started', None)
+        if started is None:
+            return
+
+        elapsed = time.perf_counter() - started
+        statements = self._local.statements
+        status = self._local.status if exception is None and self._local.status is not None else 500
+        self._local.started = self._local.statements = None
+
+        # Records the requests latency & statement count under its route, so the number of series stays bounded.
+        endpoint = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ENDPOINT
+        self.request_latency.observe((request.method, endpoint, str(status)), elapsed)
+        self.request_statements.observe((endpoint,), sum(statements.values()))
+
+        # Counts & logs the statements which were repeated enough times to be an N+1 pattern.
+        for statement, count in statements.items():
+            if count >= self.n_plus_one_threshold:
+                with self._lock:
+                    self._n_plus_one[(endpoint, statement)] += 1
+                logger.warning('Possible N+1 query in %s %s: statement executed %d times: %s', request.method, endpoint, count, statement)
+
+    # SQLAlchemy events
+
+    # The start time is stored on the statements execution context rather than the connection, so a statement which fails, & never reaches `after_cursor_execute`, leaves nothing behind.
+    def _before_cursor_execute(self, connection: object, cursor: object, statement: str, parameters: object, context: object, executemany: bool) -> None:
+        if self.enabled and context is not None:
+            context.xenon_started = time.perf_counter()
+
+    def _after_cursor_execute(self, connection: object, cursor: object, statement: str, parameters: object, context: object, executemany: bool) -> None:
+        started = getattr(context, 'xenon_started', None)
+        if started is None:
+            return
+
+        elapsed = time.perf_counter() - started
+        statement = _WHITESPACE.sub(' ', statement).strip()[:MAX_STATEMENT_LENGTH]
+
+        # Adds the statement to the counters, counting it as `other` once the number of distinct statements is reached.
+        with self._lock:
+            totals = self._statements.get(statement)
+            if totals is None:
+                if len(self._statements) >= self.max_statements:
+                    statement = OTHER_STATEMENT
+                totals = self._statements.setdefault(statement, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+            engine_totals = self._engine_statements.setdefault(self._engine_names.get(connection.engine, OTHER_STATEMENT), [0, 0.0])
+            engine_totals[0] += 1
+            engine_totals[1] += elapsed
+
+        # Counts the statement against the current request.
+        request_statements = getattr(self._local, 'statements', None)
+        if request_statements is not None:
+            request_statements[statement] += 1
+
+    # Rendering
+
+    def _render_statements(self) -> list:
+        with self._lock:
+            statements = sorted((statement, count, seconds) for statement, (count, seconds) in self._statements.items())
+            n_plus_one = sorted(self._n_plus_one.items())
+            engines = sorted((name, count, seconds) for name, (count, seconds) in self._engine_statements.items())
+
+        lines = ['# HELP xenon_sql_statements_total SQL statements executed.', '# TYPE xenon_sql_statements_total counter']
+        lines += [f'xenon_sql_statements_total{{statement="{_escape(statement)}"}} {count}' for statement, count, seconds in statements]
+        lines += ['# HELP xenon_sql_statement_seconds_total Time spent executing SQL statements.', '# TYPE xenon_sql_statement_seconds_total counter']
+        lines += [f'xenon_sql_statement_seconds_total{{statement="{_escape(statement)}"}} {seconds}' for statement, count, seconds in statements]
+        lines += ['# HELP xenon_sql_n_plus_one_total Requests which repeated a statement enough times to be an N+1 query pattern.', '# TYPE xenon_sql_n_plus_one_total counter']
+        lines += [f'xenon_sql_n_plus_one_total{_format_labels(("endpoint", "statement"), key)} {count}' for key, count in n_plus_one]
+        lines += ['# HELP xenon_sql_engine_statements_total SQL statements executed by each engine.', '# TYPE xenon_sql_engine_statements_total counter']
+        lines += [f'xenon_sql_engine_statements_total{{engine="{_escape(name)}"}} {count}' for name, count, seconds in engines]
+        lines += ['# HELP xenon_sql_engine_seconds_total Time spent executing SQL statements by each engine.', '# TYPE xenon_sql_engine_seconds_total counter']
+        lines += [f'xenon_sql_engine_seconds_total{{engine="{_escape(name)}"}} {seconds}' for name, count, seconds in engines]
+        return lines
+
+    def _render_pools(self) -> list:
+        # Reads the size, checked out & overflow connections of each pool which reports them.
+        gauges = {'size': [], 'checked_out': [], 'overflow': []}
+        for name, engine in sorted(self._engines.items()):
+            pool = engine.pool
+            for gauge, method in (('size', 'size'), ('checked_out', 'checkedout'), ('overflow', 'overflow')):
+                if hasattr(pool, method):
+                    gauges[gauge].append(f'xenon_pool_{gauge}{{engine="{_escape(name)}"}} {getattr(pool, method)()}')
+
+        lines = []
+        for gauge, samples in gauges.items():
+            lines += [f'# HELP xenon_pool_{gauge} Connection pool {gauge.replace("_", " ")} connections.', f'# TYPE xenon_pool_{gauge} gauge', *samples]
+        return lines
+
+    def _render_caches(self) -> list:
+        # Groups the statistics of every cache by metric, as each metric must be written in one block.
+        samples = collections.defaultdict(list)
+        for name, stats in sorted(self._caches.items()):
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    samples[key].append(f'{{cache="{_escape(name)}"}} {value}')
+
+        lines = []
+        for key, values in samples.items():
+            metric = f'xenon_cache_{key}_total' if key in CACHE_COUNTERS else f'xenon_cache_{key}'
+            lines += [f'# HELP {metric} Cache {key.replace("_", " ")}.', f'# TYPE {metric} {"counter" if key in CACHE_COUNTERS else "gauge"}']
+            lines += [metric + value for value in values]
+        return lines
+
+    def render(self) -> str:
+        """ Returns every metric in the Prometheus text format. """
+
+        lines = [*self.request_latency.render(), *self.request_statements.render()]
+        for histogram in list(self._histograms.values()):
+            lines += histogram.render()
+        lines += [*self._render_statements(), *self._render_pools(), *self._render_caches()]
+        return '\n'.join(lines) + '\n'
+
+# The metrics shared by the whole program.
+metrics = Metrics()
@@ -1,15 +1,23 @@
 """ Paths is used to control all the directories & files creation & removal. It also provides the rest of the program with paths to essential directories for easy modifications if required in later 
-version releases. It takes charge of all JSON file parsing & also converts relative paths to absolute. """
+version releases. It takes charge of all JSON file parsing & also converts relative paths to absolute.
+
+JSON files are kept in a shared cache, which is checked against each files modification time & size on every read, so files changed by other processes are read again. Writes are atomic & can
+optionally be delayed so that rapid writes to the same file are combined into one. """
 
 
 
 # Import internal packages
 from source.exceptions import InvalidFileExtension
+from source.caches import LRUCache
+from source.directories import directory_operations
 
 # Import standard packages
 import os
-import shutil
+import atexit
 import json
+import tempfile
+import threading
+import time
 
 
 
@@ -19,6 +27,17 @@ class Paths():
     # Instance
     INSTANCE_ABS_PATH = os.path.join(ABS_PATH, 'instance') # The absolute path to the programs instance directory.
     SETTINGS_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'system.ini')
+    EVENTS_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'events') # The absolute path to the event logs directory.
+    ASSETS_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'assets') # The absolute path to the built static assets & their manifest.
+    APPS_INDEX_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'apps.json') # The absolute path to the index of the installed apps manifests.
+    SCHEDULER_LOCK_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'scheduler.lock') # The lock held by the process which runs the persisted schedules.
+    TEMPLATE_CACHE_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'templates_cache') # The compiled templates, shared by every worker process.
+
+    # Backups
+    BACKUPS_ABS_PATH = os.path.join(ABS_PATH, 'backups') # The absolute path to the snapshots of the instance directory, kept outside it so they survive its loss.
+
+    # Apps
+    APPS_ABS_PATH = os.path.join(ABS_PATH, 'apps') # The absolute path to the installed apps directory.
 
     # Templating & static
     TEMPLATES_ABS_PATH = os.path.join(ABS_PATH, 'templates')
@@ -26,7 +45,13 @@ class Paths():
 
     # Databases
     _DB_URL = 'sqlite:///' 
-    DB_ABS_PATH = _DB_URL + os.path.join(INSTANCE_ABS_PATH, 'xenon.db')
+    DB_FILE_ABS_PATH = os.path.join(INSTANCE_ABS_PATH, 'xenon.db')
+    DB_ABS_PATH = _DB_URL + DB_FILE_ABS_PATH
+
+# Variables
+DEFAULT_JSON_CACHE_ENTRIES = 1024
+DEFAULT_JSON_CACHE_BYTES = 33554432 # 32 MiB of JSON source text.
+DEFAULT_JSON_WRITE_DELAY = 0.5 # Seconds a delayed write waits for further writes to the same file.
 
 def join_paths(*paths: str) -> str:
         """ Returns an absolute path joined to a give path. 
@@ -62,40 +87,300 @@ def delete_file(path: str) -> None:
     Params:
         - path (str) - A path to where the targeted file is located. """
 
-    # Removes the file.
-    os.remove(path)
+    # Drops the files delayed write & removes the file under its write lock, so a flush in progress can not write it again, then drops it from the JSON cache.
+    path = os.path.abspath(path)
+    with _path_lock(path):
+        if _json_writer is not None:
+            _json_writer.cancel(path)
+        os.remove(path)
+    _json_cache.invalidate(path)
+
+class JSONWriteBehind(threading.Thread):
+    """ A daemon thread which writes delayed JSON writes to disk. A write waits `delay` seconds before it is flushed; if the same file is written again in that time, only the newest content is
+    written. Should be used through `write_file_json(..., write_behind=True)`.
+
+    Params:
+        - delay (float) - The number of seconds a write waits for further writes to the same file. """
+
+    def __init__(self, delay: float) -> None:
+        super().__init__(name='json-write-behind', daemon=True)
+        self.delay = delay
+
+        # The pending writes, stored as `path: (text, due_at)`.
+        self._pending = {}
+        self._condition = threading.Condition()
+
+        # Counters reported by `json_cache_stats()`.
+        self.coalesced = 0
+        self.flushed = 0
+
+    def schedule(self, path: str, text: str) -> None:
+        """ Schedules text to be written to a file. Replaces any write to the same file which has not been flushed yet.
+
+        Params:
+            - path (str) - A path to where the targeted file is located.
+            - text (str) - The JSON text to write. """
+
+        with self._condition:
+            # Keeps the original due time if the file already has a pending write, so constant writes still reach the disk.
+            if path in self._pending:
+                self.coalesced += 1
+                due_at = self._pending[path][1]
+            else:
+                due_at = time.monotonic() + self.delay
+
+            self._pending[path] = (text, due_at)
+            self._condition.notify()
+
+    def pending_text(self, path: str) -> str:
+        """ Returns the text waiting to be written to a file, or `None` if it has no pending write.
+
+        Params:
+            - path (str) - A path to where the targeted file is located. """
+
+        with self._condition:
+            pending = self._pending.get(path)
+            return pending[0] if pending is not None else None
+
+    def cancel(self, path: str) -> None:
+        """ Drops the pending write of a file, if it has one.
+
+        Params:
+            - path (str) - A path to where the targeted file is located. """
+
+        with self._condition:
+            self._pending.pop(path, None)
+
+    def flush(self, due_only: bool = False) -> None:
+        """ Writes the pending writes to disk.
+
+        Params:
+            - due_only (bool) - If `True`, only writes which have waited their full delay are written. """
+
+        # Finds the files to flush.
+        with self._condition:
+            now = time.monotonic()
+            paths = [path for path, (_, due_at) in self._pending.items() if not due_only or due_at <= now]
+
+        # Writes each file & drops it from the cache, as its content changed. The pending text is taken & written under the files write lock, so a synchronous write made in between is never
+        # overwritten by the older text. The write stays pending until it is on disk, so readers never see the older file in between.
+        for path in paths:
+            with _path_lock(path):
+                with self._condition:
+                    pending = self._pending.get(path)
+                if pending is None:
+                    continue
+
+                text = pending[0]
+                write_file_atomic(path, text)
+                _json_cache.invalidate(path)
+
+                with self._condition:
+                    if self._pending.get(path, (None,))[0] is text:
+                        del self._pending[path]
+                    self.flushed += 1
+
+    def pending_count(self) -> int:
+        """ Returns the number of files with a pending write. """
+
+        with self._condition:
+            return len(self._pending)
+
+    def run(self) -> None:
+        while True:
+            # Sleeps until the earliest pending write is due.
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                timeout = min(due_at for _, due_at in self._pending.values()) - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+
+            # Writes the writes which are due.
+            self.flush(due_only=True)
+
+# The JSON files, stored as `path: [signature, text, data]`, & the delayed JSON writer. Both are shared by the whole program. `data` is the shared parsed content, parsed on the first read
+# with `copy=False` & `_UNPARSED` until then.
+_json_cache = LRUCache(DEFAULT_JSON_CACHE_ENTRIES, max_cost=DEFAULT_JSON_CACHE_BYTES)
+_json_writer = None
+_UNPARSED = object()
+_json_writer_lock = threading.Lock()
+_json_write_delay = DEFAULT_JSON_WRITE_DELAY
+
+# Serialise the writes to each file, so a delayed write & a synchronous write to the same file can not overtake each other. Paths share a fixed number of locks.
+_path_locks = tuple(threading.Lock() for _ in range(64))
+
+def _path_lock(path: str) -> threading.Lock:
+    """ Returns the write lock of an absolute path. """
 
-def read_file_json(path: str) -> any:
+    return _path_locks[hash(path) % len(_path_locks)]
+
+def _get_json_writer() -> JSONWriteBehind:
+    """ Returns the delayed JSON writer, starting it on first use. """
+
+    global _json_writer
+
+    with _json_writer_lock:
+        if _json_writer is None:
+            _json_writer = JSONWriteBehind(_json_write_delay)
+            _json_writer.start()
+        return _json_writer
+
+def _reset_json_writer_after_fork() -> None:
+    """ Forgets the parents delayed JSON writer in a forked child, as its thread did not survive the fork & its pending writes are still written by the parent. Also replaces the locks which
+    another thread of the parent may have held while forking. The child starts its own writer on first use. """
+
+    global _json_writer, _json_writer_lock, _path_locks
+
+    _json_writer = None
+    _json_writer_lock = threading.Lock()
+    _path_locks = tuple(threading.Lock() for _ in range(len(_path_locks)))
+    _json_cache._lock = threading.Lock()
+
+def configure_json_cache(max_entries: int, max_bytes: int, write_delay: float) -> None:
+    """ Changes the limits of the JSON cache & the delay of delayed JSON writes.
+
+    Params:
+        - max_entries (int) - The maximum number of parsed files kept in the cache.
+        - max_bytes (int) - The maximum total size, in bytes of JSON text, of the parsed files kept in the cache.
+        - write_delay (float) - The number of seconds a delayed write waits for further writes to the same file. """
+
+    global _json_write_delay
+
+    # The writer is not started here, so a process which forks after configuring the cache does not leave its children with a writer whose thread is gone.
+    _json_cache.resize(max_entries, max_cost=max_bytes)
+    _json_write_delay = write_delay
+    with _json_writer_lock:
+        if _json_writer is not None:
+            _json_writer.delay = write_delay
+
+def flush_json_writes() -> None:
+    """ Writes all the delayed JSON writes to disk straight away. This is also called when the program exits. """
+
+    if _json_writer is not None:
+        _json_writer.flush()
+
+def json_cache_stats() -> dict:
+    """ Returns a dictionary of the JSON caches counters & the delayed writers counters. """
+
+    stats = _json_cache.stats()
+    stats['pending_writes'] = _json_writer.pending_count() if _json_writer is not None else 0
+    stats['coalesced_writes'] = _json_writer.coalesced if _json_writer is not None else 0
+    stats['flushed_writes'] = _json_writer.flushed if _json_writer is not None else 0
+    return stats
+
+atexit.register(flush_json_writes)
+
+# Forked processes must not use the parents writer.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_json_writer_after_fork)
+
+def read_file_json(path: str, copy: bool = True) -> any:
     """ Returns the content of a file at a given path & parses it to JSON. 
+    The text of the file is cached until the file changes, so repeated reads of the same file do not touch the disk. If the file has a delayed write which has not been flushed yet, the delayed
+    content is returned.
+    NOTE: With `copy=False`, the returned content is parsed once & shared with the cache & other callers, which saves the parse on hot paths. It must then not be modified.
     
     Params: 
-        - path (str) - A path to where the targeted file is located. The extension of the targeted file must be `.json`. """
+        - path (str) - A path to where the targeted file is located. The extension of the targeted file must be `.json`.
+        - copy (bool) - If `True`, the cached text is parsed into new content, which can be modified freely. If `False`, the shared parsed content is returned. """
 
     # Checks if the path ends with `.json`. If so, raises an exception.
     if not path.endswith('.json'):
         raise InvalidFileExtension('Extension must be \'.json\'.')
-
-    # Opens the given file for reading & json parses the internal content.
-    with open(path, 'r') as f:
-        data = json.load(f)
-
-    # Returns the internal content to the caller.
+    path = os.path.abspath(path)
+
+    # Returns the content of a pending delayed write, as it is newer than the file.
+    if _json_writer is not None:
+        pending_text = _json_writer.pending_text(path)
+        if pending_text is not None:
+            return json.loads(pending_text)
+
+    # Reads the file unless its text is cached & it has not changed since.
+    stat = os.stat(path)
+    signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _json_cache.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, 'r') as f:
+            text = f.read()
+        cached = [signature, text, _UNPARSED]
+        _json_cache.set(path, cached, cost=len(text))
+
+    # Parses a new copy of the content for the caller, as parsing the text is faster than copying the parsed content.
+    if copy:
+        return json.loads(cached[1])
+
+    # Returns the shared content, parsing it on its first use. Two threads may both parse it, which is harmless.
+    data = cached[2]
+    if data is _UNPARSED:
+        data = cached[2] = json.loads(cached[1])
     return data
 
-def write_file_json(path: str, content: any) -> None:
+def write_file_json(path: str, content: any, write_behind: bool = False) -> None:
     """ Attempts to parse content as JSON & writes it to a file at a given path. 
     If the file does not exist, then it will be created.
+    The file is replaced atomically, so a crash never leaves a partly written file. With `write_behind`, the write is delayed & combined with any further writes to the same file made during the 
+    delay; call `flush_json_writes()` to write them straight away.
     
     Params:
-        - path (str) - A path to where the targeted file is located. The extension of the targeted file must be `.json`. """
+        - path (str) - A path to where the targeted file is located. The extension of the targeted file must be `.json`.
+        - content (any) - The content to write.
+        - write_behind (bool) - If `True`, the write is delayed & may be combined with later writes. """
     
     # Checks if the path ends with `.json`. If so, raises an exception.
     if not path.endswith('.json'):
         raise InvalidFileExtension('Extension must be \'.json\'.')
-    
-    # Opens the given file for writing & dumps the json parsed content.
-    with open(path, 'w') as f:
-        json.dump(content, f)
+
+    path = os.path.abspath(path)
+
+    # Parses the content now, so later changes to it by the caller are not written.
+    text = json.dumps(content)
+
+    # Schedules the delayed write.
+    if write_behind:
+        _get_json_writer().schedule(path, text)
+        return
+
+    # Drops any older delayed write & writes the file under its write lock, then drops it from the cache.
+    with _path_lock(path):
+        if _json_writer is not None:
+            _json_writer.cancel(path)
+        write_file_atomic(path, text)
+    _json_cache.invalidate(path)
+
+def write_file_atomic(path: str, content: str | bytes) -> None:
+    """ Writes text or bytes to a file at a given path so that readers only ever see the old or the new content, never a partly written file. The content is written to a temporary file in the same 
+    directory, flushed to disk & then renamed over the target.
+    If the file does not exist, then it will be created.
+
+    Params:
+        - path (str) - A path to where the targeted file is located.
+        - content (str | bytes) - The text or bytes to write. """
+
+    # Creates the temporary file next to the target, so the rename never crosses file systems.
+    directory, name = os.path.split(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory)
+
+    # Writes & flushes the content, then replaces the target. The temporary file is removed if anything fails.
+    try:
+        # Keeps the permissions of the file being replaced, or gives a new file the default permissions, as temporary files are only readable by their owner.
+        if os.path.exists(path):
+            os.chmod(temporary_path, os.stat(path).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary_path, 0o666 & ~umask)
+
+        with os.fdopen(descriptor, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
 
 def rename_file(path: str, new_name: str) -> None:
     """ Renames a file at a given path.
@@ -150,7 +435,7 @@ def delete_directory_full(path: str) -> None:
         - path (str) - The path of which the targeted directory is located. """
 
     # Deletes the directory & all its internal content.
-    shutil.rmtree(path)
+    directory_operations.delete_tree(path)
 
 def delete_directory_content(path: str) -> None:
     """ Deletes all the content in a directory at a given path. Will not delete the directory just the content inside.
@@ -159,13 +444,8 @@ def delete_directory_content(path: str) -> None:
     Params:
         - path (str) - The path of which the targeted directory is located. """
     
-    # Gets all the directories & files in the given directory.
-    content_found = find_content(path)
-
-    # Iterates though the content & deletes all the sub-content found.
-    for content in content_found:
-        content_complete_path = join_paths(path, content)
-        shutil.rmtree(content_complete_path)
+    # Deletes all the files & directories inside the given directory, keeping the directory itself.
+    directory_operations.delete_tree(path, keep_root=True)
 
 def rename_directory(path: str, new_name: str) -> None:
     """ Renames a directory at a given path. It renames it to parameter `new_name`.
@@ -184,7 +464,19 @@ def find_content(path: str) -> list[str]:
         - path (str) - The path in which the targeted directory is located. """
 
     # Returns a list of all the directories & files the directory.
-    return os.listdir(path)
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries]
+
+def scan_content(path: str) -> dict[str, bool]:
+    """ Returns a dictionary of the name of all the content found in a directory at a given path & whether it is a directory. Use this rather than calling `file_exists()` or 
+    `directory_exists()` for many entries of the same directory, as the whole directory is read at once.
+    
+    params:
+        - path (str) - The path in which the targeted directory is located. """
+
+    # Returns the name & type of each entry, as read by `os.scandir` without a `stat` call per entry.
+    with os.scandir(path) as entries:
+        return {entry.name: entry.is_dir() for entry in entries}
 
 def directory_exists(path: str) -> bool:
     """ Returns a bool based on whether a directory at a given path exists..
@@ -0,0 +1,76 @@
+""" Permission checks for Xenon. Each permission is a `Boolean` column of the `ProfileTypes` table & has a bit in `PERMISSION_BITS`. The permissions of a profile type are compiled into one bitmask,
+which `DatabasesManager.load_user()` stores on the users snapshot as `current_user.permissions`. Checking any number of permissions is then a single bit test, without touching the database. The
+masks are cached & invalidated whenever a profile type changes. Example:
+```python
+from source.permissions import permission_required
+
+@settings_r.route('/users')
+@permission_required('manage_users')
+def users():
+    ...
+```
+```html
+{% if has_permission('manage_users') %}<a href="/settings/users">Users</a>{% endif %}
+``` """
+
+# Import internal packages
+from source.exceptions import UnknownPermission
+
+# Import external packages
+from flask import abort, current_app
+from flask_login import current_user
+
+# Import standard packages
+import functools
+
+@functools.lru_cache(maxsize=None)
+def required_mask(*names: str) -> int:
+    """ Returns the bitmask of the given permissions. Raises `UnknownPermission` if a name is not a permission column of `ProfileTypes`.
+
+    Params:
+        - names (str) - The names of the permissions. """
+
+    from source.databases import PERMISSION_BITS
+
+    mask = 0
+    for name in names:
+        try:
+            mask |= PERMISSION_BITS[name]
+        except KeyError:
+            raise UnknownPermission(f'\'{name}\' is not a permission. Permissions are the Boolean columns of ProfileTypes.') from None
+    return mask
+
+def has_permission(*names: str, user: object = None) -> bool:
+    """ Returns whether a user has every one of the given permissions. Registered as a template global.
+
+    Params:
+        - names (str) - The names of the permissions.
+        - user (object) - The user to check, usually a `UserSnapshot`. Defaults to `current_user`. """
+
+    user = current_user if user is None else user
+    mask = required_mask(*names)
+    return bool(user.is_authenticated) and getattr(user, 'permissions', 0) & mask == mask
+
+def permission_required(*names: str) -> callable:
+    """ A route decorator which only lets users with every one of the given permissions through. Anonymous users are handled by the login managers `unauthorized()`, which redirects them to the
+    login view if one is set, & users without the permissions get `403 Forbidden`. Must be applied below the route decorator.
+
+    Params:
+        - names (str) - The names of the permissions. """
+
+    def decorator(view: callable) -> callable:
+        @functools.wraps(view)
+        def wrapper(*args: object, **kwargs: object) -> object:
+            if not current_user.is_authenticated:
+                return current_app.login_manager.unauthorized()
+
+            # The mask is resolved on the first request rather than at import, so routes can be imported before the database models.
+            mask = required_mask(*names)
+            if getattr(current_user, 'permissions', 0) & mask != mask:
+                abort(403)
+
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
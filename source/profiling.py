@@ -0,0 +1,93 @@
+""" Startup profiling for Xenon. The start up sequence is split into named stages, each of which is timed by the shared `startup_profiler`. Profiling is always on, as timing a handful of stages
+costs nothing; the report is printed when the server is started with `python main.py --profile-startup` or the `XENON_PROFILE_STARTUP` environment variable is set. Example:
+```python
+from source.profiling import startup_profiler
+
+with startup_profiler.stage('settings'):
+    settings_manager = SettingsManager()
+
+startup_profiler.report()
+``` """
+
+# Import standard packages
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Variables
+PROFILE_ENVIRONMENT_VARIABLE = 'XENON_PROFILE_STARTUP'
+
+class StartupProfiler():
+    """ Records how long each stage of the start up sequence takes. Stages may be nested, in which case the inner stages are indented in the report. """
+
+    def __init__(self) -> None:
+        # The time this module was imported, which is close to when the process started importing the program.
+        self.started = time.perf_counter()
+
+        # The recorded stages, stored as `(depth, name, seconds)` in the order they finished.
+        self.stages = []
+        self._depth = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether the report was asked for through the environment. """
+
+        return bool(os.environ.get(PROFILE_ENVIRONMENT_VARIABLE))
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> None:
+        """ Times the block as a stage of the start up sequence.
+
+        Params:
+            - name (str) - The name of the stage, shown in the report. """
+
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._depth.value = depth
+            with self._lock:
+                self.stages.append((depth, name, elapsed))
+
+    def total(self) -> float:
+        """ Returns the number of seconds since this module was imported. """
+
+        return time.perf_counter() - self.started
+
+    def report(self, stream: object = None) -> None:
+        """ Prints the time of every recorded stage, inner stages indented below the stage they ran in.
+
+        Params:
+            - stream (object) - The file to print to. Defaults to `sys.stderr`. """
+
+        stream = stream or sys.stderr
+
+        # Stages finish innermost first, so the list is rebuilt with each stage ahead of the stages nested in it.
+        ordered, pending = [], []
+        for depth, name, elapsed in self.stages:
+            children = []
+            while pending and pending[-1][0] > depth:
+                children.insert(0, pending.pop())
+            pending.append((depth, name, elapsed, children))
+
+        def flatten(entries: list) -> None:
+            for depth, name, elapsed, children in entries:
+                ordered.append((depth, name, elapsed))
+                flatten(children)
+
+        flatten(pending)
+
+        print('Startup profile', file=stream)
+        for depth, name, elapsed in ordered:
+            print(f'  {"  " * depth}{name:<{40 - 2 * depth}} {elapsed * 1000:9.1f} ms', file=stream)
+        print(f'  {"total since import":<40} {self.total() * 1000:9.1f} ms', file=stream)
+
+# The profiler shared by the whole program.
+startup_profiler = StartupProfiler()
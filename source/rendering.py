@@ -0,0 +1,169 @@
+""" Template rendering caches. Two caches sit in front of jinja:
+    - The bytecode cache keeps every compiled template in `/instance/templates_cache`, so a newly started worker loads the compiled code rather than parsing & compiling the template again. Jinja
+    checks each entry against the checksum of the templates source, so changed templates are compiled again.
+    - The fragment cache keeps rendered fragments in memory. Many fragments, such as lists & widgets, are the same for every user of a profile type, so a fragment is keyed by its app, template,
+    arguments & the profile type of the current user. Entries expire after a time-to-live & the cache is bounded by both its number of entries & the total length of the rendered text.
+
+A fragment names the tables it is rendered from. The `DatabasesManager` reports every table it writes to once the write is committed, which retires the fragments rendered from that table, & a
+settings change retires every fragment. Each worker process has its own fragment cache, but the generations of the tables are kept in the `shared_generations` counters of `/source/caches.py`, so a
+table written by any worker retires its fragments in every worker. The limits are set in the `CACHE` section of `/instance/system.ini`. Example:
+```html
+{{ render_cached('widgets/profile_types.html', tables=('profile_types',)) }}
+```
+```python
+from source.rendering import render_cached
+
+panel = render_cached('widgets/profile_types.html', tables=('profile_types',), load=lambda: {'profile_types': load_profile_types()})
+return render_template('dashboard.html', panel=panel)
+```
+
+The arguments are part of the key, so they should be values such as ids & strings. Rows are queried in `load`, which is only called when the fragment is not cached.
+
+NOTE: Only fragments which are explicitly the same for every user of a profile type should be cached. Full pages, which show the current user, flashed messages, CSRF tokens & the like, must be
+rendered with `render_template()`, with their shared parts included through `render_cached()`. """
+
+# Import internal packages
+from source.caches import LRUCache, shared_generations
+from source.paths import Paths, create_directory, directory_exists
+
+# Import external packages
+from flask import current_app, render_template
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+# Import standard packages
+import threading
+
+# Variables
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_BYTES = 8388608 # 8 MiB of rendered text.
+DEFAULT_TTL = 60 # Seconds.
+
+CURRENT_PROFILE = object() # Keys a fragment by the profile type of the current user.
+
+def create_bytecode_cache(path: str = Paths.TEMPLATE_CACHE_ABS_PATH) -> FileSystemBytecodeCache:
+    """ Returns a jinja bytecode cache which stores the compiled templates in a directory, creating the directory if it does not exist. Jinja writes each entry to a temporary file & renames it,
+    so the worker processes can share the directory.
+
+    Params:
+        - path (str) - The directory of the compiled templates. Defaults to the `/instance/templates_cache` directory. """
+
+    if not directory_exists(path):
+        create_directory(path)
+
+    return FileSystemBytecodeCache(path)
+
+class FragmentCache():
+    """ Caches rendered templates per profile type. See the module for details. The `fragment_cache` instance is shared by the whole program.
+
+    Rather than searching the cache for the fragments of a changed table, every table has a generation in `shared_generations` which is bumped when it changes in any process, & the generations of
+    a fragments tables are part of its key. Fragments rendered from an older generation are never looked up again & leave the cache as it evicts or expires them. A fragment which was being
+    rendered while its table changed is stored under the older generation, so it is never served.
+
+    Params:
+        - max_entries (int) - The maximum number of fragments kept in the cache. `0` turns the cache off.
+        - max_bytes (int) - The maximum total length of the fragments kept in the cache.
+        - ttl (float) - The number of seconds a fragment stays valid. """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES, ttl: float = DEFAULT_TTL) -> None:
+        self.cache = LRUCache(max_entries, ttl, max_bytes)
+
+        # The generation of the whole cache, bumped by settings changes. The tables generations are shared by the processes, see `shared_generations`.
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        # Renders which could not be cached, as their arguments are not hashable.
+        self.uncacheable = 0
+
+    def configure(self, max_entries: int, max_bytes: int, ttl: float) -> None:
+        """ Changes the limits of the cache & retires every fragment, as they may have been rendered with the previous settings. Called whenever the settings change.
+
+        Params:
+            - max_entries (int) - The maximum number of fragments kept in the cache.
+            - max_bytes (int) - The maximum total length of the fragments kept in the cache.
+            - ttl (float) - The number of seconds a fragment stays valid. """
+
+        self.cache.resize(max_entries, ttl, max_bytes)
+        self.clear()
+
+    def tables_changed(self, table_names: list[str]) -> None:
+        """ Retires the fragments rendered from some tables. Called by the `DatabasesManager` whenever it writes rows.
+
+        Params:
+            - table_names (list[str]) - The names of the changed tables. """
+
+        shared_generations.bump(*(('table', name) for name in table_names))
+
+    def clear(self) -> None:
+        """ Retires every fragment. """
+
+        with self._lock:
+            self._generation += 1
+        self.cache.clear()
+
+    def render(self, template_name: str, tables: tuple = (), profile_type: object = CURRENT_PROFILE, load: callable = None, **arguments: object) -> Markup:
+        """ Returns a rendered template from the cache, rendering it with `render_template()` & storing it on a miss. Must be called inside a request or app context. The result is marked as
+        safe, so it can be returned from a route or included in another template.
+
+        Params:
+            - template_name (str) - The name of the template.
+            - tables (tuple) - The names of the tables, or the table objects, the template is rendered from.
+            - profile_type (object) - The profile type the fragment is cached for. Defaults to the profile type of the current user, which is `None` for anonymous users.
+            - load (callable) - Called without arguments on a miss, returns a dictionary of further variables for the template, such as queried rows. These are not part of the key.
+            - arguments (object) - The variables passed to the template. Must be hashable to be cached. """
+
+        # Builds the key from the current generations of the fragments tables.
+        if profile_type is CURRENT_PROFILE:
+            profile_type = getattr(current_user, 'profile_type', None)
+        tables = tuple(getattr(table, '__tablename__', table) for table in tables)
+        generations = (self._generation, *(shared_generations.get(('table', name)) for name in tables))
+        key = (current_app.name, template_name, profile_type, tables, generations, tuple(sorted(arguments.items())))
+
+        # Renders the template without caching it if any argument is not hashable.
+        try:
+            hash(key)
+        except TypeError:
+            self.uncacheable += 1
+            return self._render(template_name, load, arguments)
+
+        # Returns the cached fragment, or renders & stores it, counting its length against the caches size.
+        fragment = self.cache.get(key)
+        if fragment is None:
+            fragment = self._render(template_name, load, arguments)
+            self.cache.set(key, fragment, len(fragment))
+
+        return fragment
+
+    @staticmethod
+    def _render(template_name: str, load: callable, arguments: dict) -> Markup:
+        """ Renders a template with its arguments & the variables returned by `load`.
+
+        Params:
+            - template_name (str) - The name of the template.
+            - load (callable) - Returns a dictionary of further variables, or `None`.
+            - arguments (dict) - The variables passed to the template. """
+
+        context = dict(load(), **arguments) if load is not None else arguments
+        return Markup(render_template(template_name, **context))
+
+    def stats(self) -> dict:
+        """ Returns a dictionary of the caches counters & current size. """
+
+        stats = self.cache.stats()
+        stats['uncacheable'] = self.uncacheable
+        return stats
+
+fragment_cache = FragmentCache()
+
+def render_cached(template_name: str, tables: tuple = (), profile_type: object = CURRENT_PROFILE, load: callable = None, **arguments: object) -> Markup:
+    """ Renders a template through the shared `fragment_cache`. See `FragmentCache.render()`.
+
+    Params:
+        - template_name (str) - The name of the template.
+        - tables (tuple) - The names of the tables, or the table objects, the template is rendered from.
+        - profile_type (object) - The profile type the fragment is cached for. Defaults to the profile type of the current user.
+        - load (callable) - Called on a miss, returns a dictionary of further variables for the template.
+        - arguments (object) - The variables passed to the template. """
+
+    return fragment_cache.render(template_name, tables, profile_type, load, **arguments)
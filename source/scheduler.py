@@ -0,0 +1,879 @@
+""" The automation scheduler. Jobs are functions run by a trigger:
+    - `CronTrigger('0 7 * * mon-fri')` - A cron expression of minute, hour, day of month, month & day of week, evaluated in a timezone & correct across daylight saving time changes. A time which is
+    skipped when the clocks go forward runs when they do, & a time which is repeated when the clocks go back runs once, unless the hour is `*`.
+    - `IntervalTrigger(60)` - Every number of seconds.
+    - `DelayTrigger(30)` - Once, a number of seconds from now. `DateTrigger(when)` runs once at a datetime.
+
+Due times are kept in a hierarchical timer wheel, so adding & cancelling a job takes constant time however many jobs are scheduled, & each tick only looks at the jobs which are due. Due jobs are run
+by a bounded thread pool inside the app context; when the pool & its queue are full, or a jobs previous run has not finished, the run is skipped & counted. How late each run starts, & how much that
+lateness varies between runs of a job (jitter), are recorded in the metrics.
+
+Jobs scheduled with `persist=True` are stored in the `Schedules` table of the system database & restored when the scheduler starts, in a single query. Their function is stored by name, so it must be
+importable as `<module>:<qualified name>`, & their arguments must be JSON serialisable. In production mode every worker runs a scheduler for its own jobs, while the persisted jobs are only run by
+the worker holding the `/instance/scheduler.lock` file lock; the others save their persisted jobs to the database, where the lock holder picks them up within a second. Settings are read from the
+`SCHEDULER` section of `/instance/system.ini`. Example:
+```python
+from source.scheduler import scheduler, CronTrigger, DelayTrigger
+
+scheduler.schedule(CronTrigger('0 7 * * mon-fri', 'Europe/London'), 'automations.morning:open_blinds', job_id='open-blinds', persist=True)
+scheduler.schedule(DelayTrigger(30), lamp.turn_off)
+``` """
+
+# Import internal packages
+from source.exceptions import InvalidSchedule
+from source.metrics import metrics, Histogram
+from source.paths import Paths
+
+import source.helpers as helpers
+
+# Import standard packages
+import bisect
+import concurrent.futures
+import datetime
+import fcntl
+import functools
+import importlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+# Variables
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 64
+DEFAULT_MISFIRE_GRACE = 300.0 # Seconds.
+
+TICK = 0.05 # Seconds per timer wheel tick.
+WHEEL_BITS = 6 # Each level of the wheel has `2 ** WHEEL_BITS` slots.
+WHEEL_LEVELS = 5 # Together covering `2 ** (WHEEL_BITS * WHEEL_LEVELS)` ticks, about 621 days. Later jobs wait in the last level & are placed again as it turns.
+SYNC_INTERVAL = 1.0 # Seconds between checks for the lock & for persisted jobs saved by other processes.
+PERSIST_INTERVAL = 5.0 # Seconds between writes of the next run times of persisted jobs.
+MAX_CRON_YEARS = 8 # Years searched for the next match of a cron expression before it is considered never to match.
+DST_WINDOW = datetime.timedelta(hours=3) # Longer than any daylight saving time change.
+EPOCH = datetime.datetime(1970, 1, 1) # The naive UTC datetimes of the database are converted to UNIX timestamps from here.
+
+LATENESS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0, 300.0) # Seconds.
+
+MONTH_NAMES = {name: index for index, name in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+WEEKDAY_NAMES = {name: index for index, name in enumerate(('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))}
+CRON_ALIASES = {'@yearly': '0 0 1 1 *', '@annually': '0 0 1 1 *', '@monthly': '0 0 1 * *', '@weekly': '0 0 * * 0', '@daily': '0 0 * * *', '@midnight': '0 0 * * *', '@hourly': '0 * * * *'}
+
+logger = logging.getLogger(__name__)
+
+class TimerWheel():
+    """ A hierarchical timer wheel. Entries are placed in the slot of the lowest level whose span covers their due tick, & are moved down a level each time the level above turns to their slot, until
+    they expire from the first level. Adding & removing an entry takes constant time. Entries can be any object with writable `tick` & `slot` attributes.
+
+    Params:
+        - current (int) - The tick the wheel starts at.
+        - levels (int) - The number of levels.
+        - bits (int) - Each level has `2 ** bits` slots. """
+
+    def __init__(self, current: int = 0, levels: int = WHEEL_LEVELS, bits: int = WHEEL_BITS) -> None:
+        self.current = current
+        self.levels = levels
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.size = 0
+
+        # Each slot is a dictionary used as an ordered set, so entries can be removed without searching.
+        self.slots = [[{} for _ in range(1 << bits)] for _ in range(levels)]
+
+    def add(self, entry: object, tick: int) -> None:
+        """ Adds an entry which expires at a tick. An entry whose tick has passed expires on the next tick.
+
+        Params:
+            - entry (object) - The entry.
+            - tick (int) - The tick the entry expires at. """
+
+        entry.tick = tick
+        tick = max(tick, self.current + 1)
+        delta = tick - self.current
+
+        # Finds the lowest level whose span covers the tick. Ticks beyond the last level are placed in its furthest slot & placed again when it is reached.
+        for level in range(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                break
+        else:
+            tick = self.current + (1 << (self.bits * self.levels)) - 1
+
+        slot = self.slots[level][(tick >> (self.bits * level)) & self.mask]
+        slot[entry] = None
+        entry.slot = slot
+        self.size += 1
+
+    def remove(self, entry: object) -> None:
+        """ Removes an entry which has not expired. Does nothing if it is not in the wheel.
+
+        Params:
+            - entry (object) - The entry. """
+
+        slot = entry.slot
+        if slot is not None:
+            del slot[entry]
+            entry.slot = None
+            self.size -= 1
+
+    def advance(self, tick: int) -> list:
+        """ Turns the wheel up to a tick & returns the entries which expired, in the order they expired.
+
+        Params:
+            - tick (int) - The current tick. """
+
+        expired = []
+        while self.current < tick:
+            # Skips straight to the tick when the wheel is empty.
+            if not self.size:
+                self.current = tick
+                break
+
+            self.current += 1
+            current = self.current
+
+            # Moves the entries of each higher level slot which has come round down the wheel, starting from the second level, for as long as the level below has wrapped. Entries due on this
+            # tick expire straight away.
+            for level in range(1, self.levels):
+                if (current >> (self.bits * (level - 1))) & self.mask:
+                    break
+
+                index = (current >> (self.bits * level)) & self.mask
+                slot = self.slots[level][index]
+                if slot:
+                    self.slots[level][index] = {}
+                    self.size -= len(slot)
+                    for entry in slot:
+                        if entry.tick <= current:
+                            entry.slot = None
+                            expired.append(entry)
+                        else:
+                            self.add(entry, entry.tick)
+
+            # Expires the entries of the first level slot.
+            index = current & self.mask
+            slot = self.slots[0][index]
+            if slot:
+                self.slots[0][index] = {}
+                self.size -= len(slot)
+                for entry in slot:
+                    entry.slot = None
+                expired.extend(slot)
+
+        return expired
+
+def _parse_cron_field(field: str, low: int, high: int, names: dict) -> tuple:
+    """ Returns the sorted values matched by one field of a cron expression. Raises `InvalidSchedule` if it is not valid.
+
+    Params:
+        - field (str) - The field, made of comma separated values, `<start>-<end>` ranges & `*`, each optionally followed by `/<step>`.
+        - low (int) - The lowest value of the field.
+        - high (int) - The highest value of the field.
+        - names (dict) - The values of the names accepted by the field. """
+
+    def value(text: str) -> int:
+        number = names[text] if text in names else int(text)
+        if not low <= number <= high:
+            raise ValueError(f'{number} is not between {low} & {high}')
+        return number
+
+    values = set()
+    for part in field.lower().split(','):
+        try:
+            range_text, _, step_text = part.partition('/')
+            step = int(step_text) if step_text else 1
+            if step < 1:
+                raise ValueError('the step must be positive')
+
+            if range_text == '*':
+                start, end = low, high
+            else:
+                start_text, _, end_text = range_text.partition('-')
+                start = value(start_text)
+                end = value(end_text) if end_text else (high if step_text else start)
+                if end < start:
+                    raise ValueError(f'the range {range_text} is reversed')
+        except (KeyError, ValueError) as exception:
+            raise InvalidSchedule(f'Invalid cron field \'{field}\': {exception}.') from None
+
+        values.update(range(start, end + 1, step))
+
+    return tuple(sorted(values))
+
+class CronTrigger():
+    """ Runs on the times matching a cron expression in a timezone. See the module for details.
+
+    Params:
+        - expression (str) - The cron expression: minute, hour, day of month, month & day of week, or one of `@hourly`, `@daily`, `@weekly`, `@monthly` & `@yearly`. Months & days of the week
+        may be given by their first three letters, & Sunday is `0` or `7`. When both days of the month & of the week are restricted, either matching is enough, as in cron.
+        - timezone (str) - The IANA name of the timezone, such as `Europe/London`. If `None`, the schedulers timezone. """
+
+    kind = 'cron'
+
+    def __init__(self, expression: str, timezone: str = None) -> None:
+        self.expression = expression
+        self.timezone_name = timezone
+        self.timezone = helpers.get_timezone(timezone) if timezone else None
+
+        fields = CRON_ALIASES.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise InvalidSchedule(f'Cron expression \'{expression}\' must have 5 fields: minute, hour, day of month, month & day of week.')
+
+        self.minutes = _parse_cron_field(fields[0], 0, 59, {})
+        self.hours = _parse_cron_field(fields[1], 0, 23, {})
+        self.hour_set = frozenset(self.hours)
+        self.days = frozenset(_parse_cron_field(fields[2], 1, 31, {}))
+        self.months = frozenset(_parse_cron_field(fields[3], 1, 12, MONTH_NAMES))
+        self.weekdays = frozenset(value % 7 for value in _parse_cron_field(fields[4], 0, 7, WEEKDAY_NAMES))
+
+        # Whether a field matches everything decides how days are matched & whether repeated times run twice.
+        self.hour_wildcard = len(self.hours) == 24
+        self.day_wildcard = fields[2].startswith('*')
+        self.weekday_wildcard = fields[4].startswith('*')
+
+    @property
+    def spec(self) -> str:
+        return f'cron:{self.expression}'
+
+    def _day_matches(self, wall: datetime.datetime) -> bool:
+        day = wall.day in self.days
+        weekday = (wall.weekday() + 1) % 7 in self.weekdays
+        if self.day_wildcard or self.weekday_wildcard:
+            return day and weekday
+        return day or weekday
+
+    def _next_wall(self, wall: datetime.datetime) -> datetime.datetime:
+        """ Returns the first local wall time, at or after a naive wall time, which matches the expression. Returns `None` if nothing matches within `MAX_CRON_YEARS`. """
+
+        wall = wall.replace(second=0, microsecond=0)
+        last_year = wall.year + MAX_CRON_YEARS
+        while wall.year <= last_year:
+            # Skips to the next month, day or matching hour whenever the current one does not match.
+            if wall.month not in self.months:
+                wall = (wall.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(wall):
+                wall = (wall + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif wall.hour not in self.hour_set:
+                index = bisect.bisect_left(self.hours, wall.hour)
+                if index < len(self.hours):
+                    wall = wall.replace(hour=self.hours[index], minute=0)
+                else:
+                    wall = (wall + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            else:
+                index = bisect.bisect_left(self.minutes, wall.minute)
+                if index < len(self.minutes):
+                    return wall.replace(minute=self.minutes[index])
+                wall = (wall + datetime.timedelta(hours=1)).replace(minute=0)
+
+        return None
+
+    def _instants(self, wall: datetime.datetime, timezone: datetime.tzinfo) -> list:
+        """ Returns the instants at which a local wall time occurs. A time skipped by a daylight saving time change occurs when the clocks go forward, & a repeated time occurs twice only when the
+        hour is `*`. """
+
+        first = wall.replace(tzinfo=timezone, fold=0)
+        second = wall.replace(tzinfo=timezone, fold=1)
+        if first.utcoffset() == second.utcoffset():
+            return [first]
+
+        # Finds the end of a skipped interval, the first wall time which exists after it.
+        if first.astimezone(datetime.timezone.utc).astimezone(timezone).replace(tzinfo=None) != wall:
+            while first.astimezone(datetime.timezone.utc).astimezone(timezone).replace(tzinfo=None) != wall:
+                wall += datetime.timedelta(minutes=1)
+                first = wall.replace(tzinfo=timezone)
+            return [first]
+
+        return [first, second] if self.hour_wildcard else [first]
+
+    def next_after(self, after: datetime.datetime, timezone: datetime.tzinfo = datetime.timezone.utc) -> datetime.datetime:
+        """ Returns the first instant after a timezone aware datetime which matches the expression, or `None` if there is none.
+
+        Params:
+            - after (datetime.datetime) - The timezone aware datetime.
+            - timezone (datetime.tzinfo) - The timezone used if the trigger was not given one. """
+
+        # Compares instants in UTC, as datetimes sharing a timezone are compared by their wall time, ignoring which of a repeated hour they are in.
+        timezone = self.timezone or timezone
+        after = after.astimezone(datetime.timezone.utc)
+        local_after = after.astimezone(timezone)
+        wall = self._next_wall(local_after.replace(tzinfo=None) + datetime.timedelta(minutes=1))
+        if wall is None:
+            return None
+
+        # Returns straight away unless a daylight saving time change is near, as wall times then map to instants in order.
+        instant = wall.replace(tzinfo=timezone)
+        if instant.utcoffset() == local_after.utcoffset() and instant.utcoffset() == wall.replace(tzinfo=timezone, fold=1).utcoffset() and instant > after:
+            return instant.astimezone(datetime.timezone.utc)
+
+        # Near a change, searches the wall times from before `after` for the earliest instant after it, as a repeated hour maps later wall times to earlier instants.
+        best = best_wall = None
+        wall = local_after.replace(tzinfo=None) - DST_WINDOW
+        while True:
+            wall = self._next_wall(wall)
+            if wall is None or (best_wall is not None and wall > best_wall + DST_WINDOW):
+                return best
+
+            for instant in self._instants(wall, timezone):
+                instant = instant.astimezone(datetime.timezone.utc)
+                if instant > after and (best is None or instant < best):
+                    best, best_wall = instant, wall
+            wall += datetime.timedelta(minutes=1)
+
+    def first_after(self, now: datetime.datetime, timezone: datetime.tzinfo = datetime.timezone.utc) -> datetime.datetime:
+        return self.next_after(now, timezone)
+
+class IntervalTrigger():
+    """ Runs every number of seconds, counted from the previous due time so runs do not drift.
+
+    Params:
+        - seconds (float) - The interval. """
+
+    kind = 'interval'
+    timezone_name = None
+
+    def __init__(self, seconds: float) -> None:
+        if not seconds > 0:
+            raise InvalidSchedule('An interval must be a positive number of seconds.')
+        self.seconds = float(seconds)
+
+    @property
+    def spec(self) -> str:
+        return f'interval:{self.seconds:g}'
+
+    def next_after(self, after: datetime.datetime, timezone: datetime.tzinfo = None) -> datetime.datetime:
+        return after + datetime.timedelta(seconds=self.seconds)
+
+    def first_after(self, now: datetime.datetime, timezone: datetime.tzinfo = None) -> datetime.datetime:
+        return self.next_after(now)
+
+class DateTrigger():
+    """ Runs once at a datetime. A datetime which has passed runs straight away.
+
+    Params:
+        - when (datetime.datetime) - The timezone aware datetime. """
+
+    kind = 'date'
+    timezone_name = None
+
+    def __init__(self, when: datetime.datetime) -> None:
+        if when.tzinfo is None:
+            raise InvalidSchedule('A date trigger must be given a timezone aware datetime.')
+        self.when = when.astimezone(datetime.timezone.utc)
+
+    @property
+    def spec(self) -> str:
+        return f'date:{self.when.isoformat()}'
+
+    def next_after(self, after: datetime.datetime, timezone: datetime.tzinfo = None) -> datetime.datetime:
+        return self.when if self.when > after else None
+
+    def first_after(self, now: datetime.datetime, timezone: datetime.tzinfo = None) -> datetime.datetime:
+        return self.when
+
+class DelayTrigger(DateTrigger):
+    """ Runs once, a number of seconds from now.
+
+    Params:
+        - seconds (float) - The delay. """
+
+    def __init__(self, seconds: float) -> None:
+        super().__init__(helpers.get_current_utc_datetime() + datetime.timedelta(seconds=seconds))
+
+@functools.lru_cache(maxsize=1024)
+def parse_trigger(spec: str, timezone: str = None) -> object:
+    """ Returns the trigger of a specification: `cron:<expression>`, `interval:<seconds>`, `date:<ISO 8601 datetime>` or `delay:<seconds>`. Raises `InvalidSchedule` if it is not valid. Triggers
+    are immutable, so the same trigger is returned for the same specification.
+
+    Params:
+        - spec (str) - The specification.
+        - timezone (str) - The IANA name of the timezone of cron triggers. If `None`, the schedulers timezone. """
+
+    kind, _, value = spec.partition(':')
+    try:
+        if kind == 'cron':
+            return CronTrigger(value, timezone)
+        if kind == 'interval':
+            return IntervalTrigger(float(value))
+        if kind == 'date':
+            return DateTrigger(datetime.datetime.fromisoformat(value))
+        if kind == 'delay':
+            return DelayTrigger(float(value))
+    except ValueError as exception:
+        raise InvalidSchedule(f'Invalid trigger \'{spec}\': {exception}.') from None
+
+    raise InvalidSchedule(f'Invalid trigger \'{spec}\': must start with cron:, interval:, date: or delay:.')
+
+def resolve_target(target: str) -> callable:
+    """ Returns the function named by a `<module>:<qualified name>` target. """
+
+    module_name, _, qualified_name = target.partition(':')
+    value = importlib.import_module(module_name)
+    for name in qualified_name.split('.'):
+        value = getattr(value, name)
+    return value
+
+def target_name(func: callable) -> str:
+    """ Returns the `<module>:<qualified name>` target of a module level function. Raises `InvalidSchedule` if it cannot be imported by that name. """
+
+    target = f'{func.__module__}:{func.__qualname__}'
+    if '<' in target:
+        raise InvalidSchedule(f'{target} cannot be persisted, as it cannot be imported by name. Persisted jobs must run module level functions.')
+    return target
+
+class Job():
+    """ A scheduled job. Returned by `Scheduler.schedule()`.
+
+    Properties:
+        - id (str) - The id of the job.
+        - trigger (object) - The trigger.
+        - due (float) - The UNIX timestamp the job is next due at.
+        - persist (bool) - Whether the job is stored in the system database.
+        - owner (str) - The owner given when scheduling, such as an app id. """
+
+    __slots__ = ('id', 'trigger', 'func', 'target', 'args', 'kwargs', 'owner', 'persist', 'due', 'tick', 'slot', 'running', 'lateness')
+
+    def __init__(self, job_id: str, trigger: object, func: callable, target: str, args: tuple, kwargs: dict, owner: str, persist: bool) -> None:
+        self.id = job_id
+        self.trigger = trigger
+        self.func = func
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.owner = owner
+        self.persist = persist
+        self.due = None
+        self.tick = None
+        self.slot = None
+        self.running = False
+        self.lateness = None
+
+    def __repr__(self) -> str:
+        return f'<Job {self.id} {self.trigger.spec}>'
+
+class Scheduler():
+    """ Runs jobs on cron, interval & one off triggers. See the module for details. The `scheduler` instance is shared by the whole program. It is started by `main.py` in development mode & by
+    every worker in production mode, & restarts itself in a forked process.
+
+    Params:
+        - workers (int) - The number of threads running jobs.
+        - max_pending (int) - The number of due jobs which can wait for a thread before runs are skipped.
+        - misfire_grace (float) - The number of seconds a persisted job missed while the server was down is still run after a restart. Older missed runs are skipped.
+        - timezone (str) - The IANA name of the timezone cron triggers are evaluated in. Empty for the systems local timezone.
+        - lock_path (str) - The lock file held by the process which runs the persisted jobs. Defaults to the `/instance/scheduler.lock` file. """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, max_pending: int = DEFAULT_MAX_PENDING, misfire_grace: float = DEFAULT_MISFIRE_GRACE, timezone: str = '',
+                 lock_path: str = Paths.SCHEDULER_LOCK_ABS_PATH) -> None:
+        self.configure(workers, max_pending, misfire_grace, timezone)
+        self.lock_path = lock_path
+        self.app = None
+
+        # The jobs by id, & the wheel of their due ticks. The wheel counts ticks of the monotonic clock, so changes to the system clock do not move it.
+        self.jobs = {}
+        self.wheel = TimerWheel(self._monotonic_tick())
+        self._lock = threading.RLock()
+
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._executor = None
+        self._slots = None
+
+        # The state of the persisted jobs: whether this process holds the lock, the last revision read & the jobs whose next run has not been saved.
+        self.leader = False
+        self._lock_file = None
+        self._revision = 0
+        self._unsaved = set()
+        self._finished = set()
+
+        # The counters are updated from the pool threads, so they are guarded by their own lock.
+        self._counters_lock = threading.Lock()
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lateness = Histogram('xenon_scheduler_lateness_seconds', 'Time between a jobs due time & the start of its run.', ('trigger',), LATENESS_BUCKETS)
+        self.jitter = Histogram('xenon_scheduler_jitter_seconds', 'Change in lateness between consecutive runs of a job.', ('trigger',), LATENESS_BUCKETS)
+
+    def configure(self, workers: int, max_pending: int, misfire_grace: float, timezone: str) -> None:
+        """ Applies new settings. The pool size applies the next time the scheduler starts. Called by `/source/server.py` whenever the settings are loaded.
+
+        Params:
+            - workers (int) - The number of threads running jobs.
+            - max_pending (int) - The number of due jobs which can wait for a thread.
+            - misfire_grace (float) - The number of seconds a missed persisted job is still run after a restart.
+            - timezone (str) - The IANA name of the timezone cron triggers are evaluated in. """
+
+        self.workers = workers
+        self.max_pending = max_pending
+        self.misfire_grace = misfire_grace
+        self.timezone_name = timezone
+        self.timezone = helpers.get_timezone(timezone)
+
+    @staticmethod
+    def _monotonic_tick() -> int:
+        return int(time.monotonic() / TICK)
+
+    # Lifecycle
+
+    def start(self, app: object = None) -> None:
+        """ Starts the scheduler thread & the job pool, if they are not running in this process. Jobs scheduled earlier in this process are kept, while those inherited from a parent process
+        are dropped.
+
+        Params:
+            - app (Flask) - The app whose context jobs run in, & whose databases manager stores the persisted jobs. """
+
+        with self._lock:
+            if app is not None:
+                self.app = app
+            if self._pid == os.getpid():
+                return
+
+            # Drops the jobs & lock inherited from the parent process.
+            if self._pid is not None:
+                self.jobs.clear()
+                self.wheel = TimerWheel(self._monotonic_tick())
+                self._unsaved.clear()
+                self._finished.clear()
+                self.leader = False
+                self._lock_file = None
+
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='scheduler')
+            self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+        metrics.register_histogram(self.lateness)
+        metrics.register_histogram(self.jitter)
+        metrics.register_cache('scheduler', self.stats)
+
+    def stop(self, timeout: float = None) -> None:
+        """ Stops the scheduler thread, saves the next run times of the persisted jobs & releases the lock. Running jobs are waited for. The jobs are kept & run again if it is restarted.
+
+        Params:
+            - timeout (float) - The number of seconds to wait for the scheduler thread. If `None`, waits until it stops. """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+            thread, executor = self._thread, self._executor
+
+        self._stopping.set()
+        thread.join(timeout)
+        executor.shutdown(wait=True)
+
+        # Saves the persisted jobs & hands the lock to another process.
+        if self.leader:
+            self._save()
+            self.leader = False
+            os.close(self._lock_file)
+            self._lock_file = None
+
+    def _run(self) -> None:
+        """ Turns the wheel every tick & dispatches the due jobs. Syncs & saves the persisted jobs periodically. """
+
+        next_sync = next_save = 0.0
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = self.wheel.advance(int(now / TICK))
+            for job in due:
+                self._dispatch(job)
+
+            # Takes the lock if it is free, reads the persisted jobs saved since the last sync & saves the next run times.
+            if now >= next_sync and self.app is not None:
+                next_sync = now + SYNC_INTERVAL
+                try:
+                    self._sync()
+                except Exception:
+                    logger.exception('Failed to sync the persisted schedules.')
+            if now >= next_save and self.leader:
+                next_save = now + PERSIST_INTERVAL
+                try:
+                    self._save()
+                except Exception:
+                    logger.exception('Failed to save the persisted schedules.')
+
+            # Sleeps until the next tick.
+            self._stopping.wait(max(0.0, (int(now / TICK) + 1) * TICK - time.monotonic()))
+
+    # Scheduling
+
+    def schedule(self, trigger: object, func: object, args: tuple = (), kwargs: dict = None, job_id: str = None, persist: bool = False, owner: str = None) -> Job:
+        """ Schedules a job & returns it. A job with the same id is replaced. Thread safe.
+
+        Params:
+            - trigger (object) - A `CronTrigger`, `IntervalTrigger`, `DateTrigger` or `DelayTrigger`, or a trigger specification for `parse_trigger()`.
+            - func (callable | str) - The function to run, or its `<module>:<qualified name>` target.
+            - args (tuple) - The positional arguments of the function.
+            - kwargs (dict) - The keyword arguments of the function.
+            - job_id (str) - The id of the job. Defaults to a random id.
+            - persist (bool) - Whether to store the job in the system database, so it is restored after a restart. Requires `start()` to have been given the app.
+            - owner (str) - The owner of the job, such as an app id, so `cancel_owner()` can cancel it. """
+
+        if isinstance(trigger, str):
+            trigger = parse_trigger(trigger)
+
+        target = func if isinstance(func, str) else None
+        if persist:
+            target = target or target_name(func)
+            arguments = json.dumps({'args': list(args), 'kwargs': kwargs or {}})
+
+        job = Job(job_id or uuid.uuid4().hex, trigger, None if target else func, target, tuple(args), kwargs or {}, owner, persist)
+        due = trigger.first_after(helpers.get_current_utc_datetime(), self.timezone)
+        if due is None:
+            raise InvalidSchedule(f'Trigger \'{trigger.spec}\' never fires.')
+        job.due = due.timestamp()
+        self.start()
+
+        # Saves a persisted job to the database. Other processes only add it through the database, so it is run by the lock holder.
+        if persist:
+            if self.app is None:
+                raise RuntimeError('Persisted jobs require the scheduler to be started with the app.')
+            with self.app.app_context():
+                self.app.extensions['xenon'].databases_manager.save_schedule({
+                    'id': job.id, 'trigger': trigger.spec, 'timezone': trigger.timezone_name or '', 'target': target, 'arguments': arguments, 'owner': owner,
+                    'next_run': _to_database(job.due)
+                })
+            if not self.leader:
+                return job
+
+        self._add(job)
+        return job
+
+    def _add(self, job: Job) -> None:
+        with self._lock:
+            previous = self.jobs.get(job.id)
+            if previous is not None:
+                self.wheel.remove(previous)
+            self.jobs[job.id] = job
+            self.wheel.add(job, self._due_tick(job.due))
+
+    @staticmethod
+    def _due_tick(due: float) -> int:
+        # Converts a UNIX timestamp to a tick of the monotonic clock, rounding up so jobs never run early.
+        return math.ceil((due + time.monotonic() - time.time()) / TICK)
+
+    def cancel(self, job_id: str) -> bool:
+        """ Cancels a job. Persisted jobs are also removed from the database. Returns whether a job was cancelled in this process. Thread safe.
+
+        Params:
+            - job_id (str) - The id of the job. """
+
+        with self._lock:
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                self.wheel.remove(job)
+                self._unsaved.discard(job_id)
+
+        # Marks the persisted job as cancelled, so the lock holder removes it too.
+        if (job is None or job.persist) and self.app is not None:
+            with self.app.app_context():
+                self.app.extensions['xenon'].databases_manager.cancel_schedules([job_id])
+
+        return job is not None
+
+    def cancel_owner(self, owner: str) -> None:
+        """ Cancels every job of an owner which is not persisted, for example when an app is unloaded, as its functions belong to the unloaded modules. Thread safe.
+
+        Params:
+            - owner (str) - The owner given when scheduling. """
+
+        with self._lock:
+            for job in [job for job in self.jobs.values() if job.owner == owner and not job.persist]:
+                del self.jobs[job.id]
+                self.wheel.remove(job)
+
+    # Running
+
+    def _dispatch(self, job: Job) -> None:
+        """ Starts a due job in the pool, records its lateness & schedules its next run. """
+
+        now = time.time()
+        if now < job.due:
+            # The system clock was turned back since the job was placed, so it is placed again.
+            with self._lock:
+                if self.jobs.get(job.id) is job:
+                    self.wheel.add(job, self._due_tick(job.due))
+            return
+
+        # Records how late the run is, & how much that differs from the jobs previous run.
+        lateness = now - job.due
+        self.lateness.observe((job.trigger.kind,), lateness)
+        if job.lateness is not None:
+            self.jitter.observe((job.trigger.kind,), abs(lateness - job.lateness))
+        job.lateness = lateness
+
+        # Schedules the next run from the due time, so runs do not drift, skipping the runs which were missed.
+        due = datetime.datetime.fromtimestamp(job.due, datetime.timezone.utc)
+        following = job.trigger.next_after(due, self.timezone)
+        if following is not None and following.timestamp() <= now:
+            following = job.trigger.next_after(datetime.datetime.fromtimestamp(now, datetime.timezone.utc), self.timezone)
+
+        with self._lock:
+            if self.jobs.get(job.id) is job:
+                if following is None:
+                    del self.jobs[job.id]
+                    if job.persist:
+                        self._finished.add(job.id)
+                else:
+                    job.due = following.timestamp()
+                    self.wheel.add(job, self._due_tick(job.due))
+                if job.persist:
+                    self._unsaved.add(job.id)
+
+        # Runs the job, unless its previous run has not finished or the pool is full.
+        if job.running or not self._slots.acquire(blocking=False):
+            with self._counters_lock:
+                self.skipped += 1
+            logger.warning('Skipped a run of job %s, as %s.', job.id, 'its previous run has not finished' if job.running else 'the scheduler pool is full')
+            return
+
+        job.running = True
+        self._executor.submit(self._run_job, job)
+
+    def _run_job(self, job: Job) -> None:
+        try:
+            func = job.func or resolve_target(job.target)
+            if self.app is not None:
+                with self.app.app_context():
+                    func(*job.args, **job.kwargs)
+            else:
+                func(*job.args, **job.kwargs)
+            with self._counters_lock:
+                self.runs += 1
+        except Exception:
+            with self._counters_lock:
+                self.errors += 1
+            logger.exception('Job %s failed.', job.id)
+        finally:
+            # Also clears the job which replaced this one while it ran, as it took over the running flag.
+            with self._lock:
+                current = self.jobs.get(job.id)
+                if current is not None:
+                    current.running = False
+            job.running = False
+            self._slots.release()
+
+    # Persistence
+
+    def _sync(self) -> None:
+        """ Takes the lock if no other process holds it, then adds, replaces & removes the persisted jobs saved since the last sync. Called by the scheduler thread. """
+
+        # Tries to take the lock. Only the process which holds it runs the persisted jobs.
+        if not self.leader:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            lock_file = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock_file)
+                return
+
+            self.leader, self._lock_file, self._revision = True, lock_file, 0
+            logger.info('Process %d is running the persisted schedules.', os.getpid())
+
+        with self.app.app_context():
+            databases_manager = self.app.extensions['xenon'].databases_manager
+            rows = databases_manager.schedule_changes(self._revision)
+            if not rows:
+                return
+
+            # Builds the jobs, decoding each distinct arguments string once, as most schedules share them.
+            started = time.perf_counter()
+            now = time.time()
+            jobs, cancelled, arguments = [], [], {}
+            for row in rows:
+                self._revision = max(self._revision, row.revision)
+                if row.cancelled:
+                    cancelled.append(row.id)
+                    continue
+
+                try:
+                    if row.arguments not in arguments:
+                        arguments[row.arguments] = json.loads(row.arguments)
+                    jobs.append(self._restore(row, arguments[row.arguments], now))
+                except Exception:
+                    logger.exception('Failed to restore schedule %s.', row.id)
+
+            # Adds & removes the jobs together, converting their due times to ticks with one reading of the clocks. Rows which match the loaded job, such as the next run times this process
+            # saved itself, are skipped, & a changed job takes over the running flag & lateness of the job it replaces, so runs do not overlap & the jitter is not reset.
+            offset = time.monotonic() - time.time()
+            with self._lock:
+                for job_id in cancelled:
+                    job = self.jobs.pop(job_id, None)
+                    if job is not None:
+                        self.wheel.remove(job)
+                for job in jobs:
+                    previous = self.jobs.get(job.id)
+                    if previous is not None:
+                        if _same_definition(previous, job):
+                            continue
+                        self.wheel.remove(previous)
+                        job.running, job.lateness = previous.running, previous.lateness
+                    self.jobs[job.id] = job
+                    self.wheel.add(job, math.ceil((job.due + offset) / TICK))
+
+            if cancelled:
+                databases_manager.prune_schedules()
+
+        logger.info('Read %d persisted schedules in %.1f ms.', len(rows), (time.perf_counter() - started) * 1000)
+
+    def _restore(self, row: object, arguments: dict, now: float) -> Job:
+        """ Returns the job of a persisted schedule. A run missed by more than the misfire grace is skipped. """
+
+        trigger = parse_trigger(row.trigger, row.timezone or None)
+        job = Job(row.id, trigger, None, row.target, tuple(arguments.get('args', ())), arguments.get('kwargs', {}), row.owner, True)
+
+        # Reads the naive UTC due time as a UNIX timestamp.
+        due = (row.next_run - EPOCH).total_seconds() if row.next_run is not None else None
+        if due is None or due < now - self.misfire_grace:
+            due = trigger.next_after(datetime.datetime.fromtimestamp(now, datetime.timezone.utc), self.timezone)
+            if due is None:
+                raise InvalidSchedule(f'Trigger \'{trigger.spec}\' never fires again.')
+            due = due.timestamp()
+
+        job.due = due
+        return job
+
+    def _save(self) -> None:
+        """ Writes the next run times of the persisted jobs which ran since the last save, & cancels the finished ones so their rows are pruned. """
+
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, set()
+            finished, self._finished = self._finished, set()
+            rows = [{'id': job_id, 'next_run': _to_database(self.jobs[job_id].due)} for job_id in unsaved if job_id in self.jobs]
+
+        if not rows and not finished:
+            return
+
+        with self.app.app_context():
+            databases_manager = self.app.extensions['xenon'].databases_manager
+            databases_manager.update_rows(_schedules_table(), rows)
+            databases_manager.cancel_schedules(finished)
+
+    def stats(self) -> dict:
+        """ Returns the schedulers statistics, reported in the metrics as the `scheduler` cache. """
+
+        with self._counters_lock:
+            return {'size': len(self.jobs), 'leader': int(self.leader), 'runs': self.runs, 'skipped': self.skipped, 'errors': self.errors}
+
+def _same_definition(job: Job, other: Job) -> bool:
+    """ Returns a bool based on whether two jobs run the same target with the same trigger & arguments. """
+
+    first, second = ((each.target, each.trigger.spec, getattr(each.trigger, 'timezone', None), each.args, each.kwargs, each.owner) for each in (job, other))
+    return first == second
+
+def _to_database(timestamp: float) -> datetime.datetime:
+    """ Returns a UNIX timestamp as the naive UTC datetime stored in the database. """
+
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+
+def _schedules_table() -> type:
+    from source.databases import Schedules
+    return Schedules
+
+# The scheduler shared by the whole program.
+scheduler = Scheduler()
@@ -1,34 +1,280 @@
-""" This is the centralized server configuration file. Everything relating to the server is built out from here. Here we handle the server configuration, system routing, applications, application 
-routing, databases, authentication, context processing etc. """
+""" This is the centralized server configuration file. Everything relating to the server is built out from here. Here we handle the server configuration, system routing, applications, application
+routing, databases, authentication, context processing etc.
+
+Nothing is set up when this module is imported. The `Flask` instance is built by `create_app()`, & the databases manager is only created the first time it is used, usually by the first
+authenticated request. For compatibility, `server`, `settings_manager` & `databases_manager` can still be imported from this module, which creates a default app on first access. """
 
 # Import internal packages
 from source.config import SettingsManager
-from source.databases import DatabasesManager
-from source.databases import Users
+from source.events import event_bus
+from source.hashing import password_hasher
+from source.metrics import metrics
 from source.paths import Paths
-from routes import base_r
+from source.paths import configure_json_cache, json_cache_stats
+from source.profiling import startup_profiler
+from source.rendering import create_bytecode_cache, fragment_cache, render_cached
+from source.scheduler import scheduler
 
 # Import external packages
-from flask import Flask
-from flask_login import LoginManager
+from flask import Flask, current_app
+
+# Import standard packages
+import threading
+
+class Services():
+    """ Holds the managers used by an app. Stored on the app as `app.extensions['xenon']`, & reachable inside a request through `get_services()`. The databases manager is created on first access,
+    as creating the engines & tables is the most expensive part of start up.
+
+    Params:
+        - settings_manager (SettingsManager) - The settings manager of the app. """
+
+    def __init__(self, settings_manager: SettingsManager) -> None:
+        self.settings_manager = settings_manager
+        self.app_registry = None
+        self._databases_manager = None
+        self._engine_registry = None
+        self._backup_manager = None
+        self._lock = threading.Lock()
+
+    @property
+    def databases_manager(self) -> object:
+        """ The `DatabasesManager` of the app, created on first access. """
+
+        if self._databases_manager is None:
+            with self._lock:
+                if self._databases_manager is None:
+                    with startup_profiler.stage('databases manager'):
+                        from source.databases import DatabasesManager
+                        self._databases_manager = DatabasesManager(self.settings_manager)
+
+        return self._databases_manager
+
+    @property
+    def engine_registry(self) -> object:
+        """ The `EngineRegistry` of the installed apps databases, created on first access. """
+
+        if self._engine_registry is None:
+            with self._lock:
+                if self._engine_registry is None:
+                    from source.engines import EngineRegistry
+                    self._engine_registry = EngineRegistry(self.settings_manager)
+                    metrics.register_cache('app_engines', self._engine_registry.stats)
+
+        return self._engine_registry
+
+    @property
+    def backup_manager(self) -> object:
+        """ The `BackupManager` of the instance directory, created on first access. """
+
+        if self._backup_manager is None:
+            with self._lock:
+                if self._backup_manager is None:
+                    from source.backup import BackupManager
+                    self._backup_manager = BackupManager(self.settings_manager)
+                    metrics.register_cache('backups', self._backup_manager.stats)
+
+        return self._backup_manager
+
+    def release_app(self, app_id: str) -> None:
+        """ Removes the event subscriptions & scheduled jobs & closes the databases of an app when it is unloaded. Persisted jobs are kept, as they run by name. Does not create the engine
+        registry if no app database has been opened.
+
+        Params:
+            - app_id (str) - The id of the app. """
+
+        event_bus.unsubscribe_owner(app_id)
+        scheduler.cancel_owner(app_id)
+        if self._engine_registry is not None:
+            self._engine_registry.close(app_id)
+
+    @property
+    def databases_manager_loaded(self) -> bool:
+        """ Whether the databases manager has been created yet. """
+
+        return self._databases_manager is not None
+
+    def remove_sessions(self, exception: BaseException = None) -> None:
+        """ Removes the current threads database sessions at the end of a request. Does nothing if the databases manager has not been created, rather than creating it.
+
+        Params:
+            - exception (BaseException) - The exception which ended the request, if any. Passed by flask. """
+
+        if self._databases_manager is not None:
+            self._databases_manager.remove_sessions(exception)
+
+    def reset_after_fork(self) -> None:
+        """ Resets the state inherited from the parent process. Called in each worker of the production server, see `/source/serving.py`. """
+
+        if self._databases_manager is not None:
+            self._databases_manager.reset_after_fork()
+        if self._engine_registry is not None:
+            self._engine_registry.reset_after_fork()
+
+    def apply_settings(self, old_settings: object, settings: object) -> None:
+        """ Applies reloaded settings to the managers. Registered as a `SettingsManager` listener.
+
+        Params:
+            - old_settings (Settings) - The previous settings snapshot.
+            - settings (Settings) - The new settings snapshot. """
+
+        if self._databases_manager is not None:
+            self._databases_manager.apply_settings(settings)
+        if self._engine_registry is not None:
+            self._engine_registry.apply_settings(settings)
+        if self.app_registry is not None:
+            self.app_registry.idle_timeout = settings.apps_idle_timeout
+        if settings.backup_schedule != old_settings.backup_schedule and (settings.backup_schedule or self._databases_manager is not None):
+            from source.backup import schedule_backups
+            schedule_backups(self.databases_manager, settings)
+        configure_services(settings)
+
+def configure_services(settings: object) -> None:
+    """ Applies settings to the services shared by the whole program.
+
+    Params:
+        - settings (Settings) - The settings snapshot. """
+
+    password_hasher.configure(settings.hashing_workers, settings.hashing_max_pending, settings.hashing_queue_timeout, settings.hashing_method)
+    configure_json_cache(settings.cache_json_entries, settings.cache_json_bytes, settings.cache_json_write_delay)
+    metrics.configure(settings.metrics_enabled, settings.metrics_n_plus_one_threshold, settings.metrics_allowed_addresses)
+    event_bus.configure(settings.events_queue_size, settings.events_overflow, settings.events_publish_timeout)
+    scheduler.configure(settings.scheduler_workers, settings.scheduler_max_pending, settings.scheduler_misfire_grace, settings.scheduler_timezone)
+    fragment_cache.configure(settings.cache_fragment_entries, settings.cache_fragment_bytes, settings.cache_fragment_ttl)
+
+def create_app(settings_manager: SettingsManager = None) -> Flask:
+    """ Builds & returns the `Flask` instance. The databases manager is not created here, it is created by the first request which needs it.
+
+    Params:
+        - settings_manager (SettingsManager) - The settings manager to use. If `None`, one is created for the `/instance/system.ini` file. """
+
+    with startup_profiler.stage('create_app'):
+        # Server configuration
+        with startup_profiler.stage('flask'):
+            server = Flask(__name__, template_folder=Paths.TEMPLATES_ABS_PATH, static_folder=Paths.STATIC_ABS_PATH)
+
+        # Settings
+        with startup_profiler.stage('settings'):
+            if settings_manager is None:
+                settings_manager = SettingsManager()
+            services = Services(settings_manager)
+            server.extensions['xenon'] = services
+            configure_services(settings_manager.settings)
+            settings_manager.add_listener(services.apply_settings)
+
+        # Request & SQL instrumentation
+        with startup_profiler.stage('metrics'):
+            metrics.init_app(server)
+            metrics.register_cache('json', json_cache_stats)
+            metrics.register_cache('events', event_bus.stats)
+            metrics.register_cache('fragments', fragment_cache.stats)
+
+        # Templates. The compiled templates are shared by every worker through the bytecode cache, & `render_cached` is available to templates for caching their fragments.
+        with startup_profiler.stage('templates'):
+            if settings_manager.cache_template_bytecode:
+                server.jinja_env.bytecode_cache = create_bytecode_cache()
+            server.add_template_global(render_cached)
+
+        # Static assets
+        with startup_profiler.stage('assets'):
+            from source.assets import asset_pipeline, asset_url
+
+            if settings_manager.assets_build_on_startup:
+                asset_pipeline.build()
+            else:
+                asset_pipeline.load()
+            server.add_template_global(asset_url)
+
+        # Authentication
+        with startup_profiler.stage('login manager'):
+            from flask_login import LoginManager
+
+            login_manager = LoginManager()
+            login_manager.init_app(server)
+
+            # Login user callback
+            @login_manager.user_loader
+            def load_user(user_id):
+                return services.databases_manager.load_user(user_id)
+
+            # Permission checks in templates
+            from source.permissions import has_permission
+            server.add_template_global(has_permission)
+
+        # Blueprint registration
+        with startup_profiler.stage('blueprints'):
+            from routes import base_r
+            server.register_blueprint(base_r)
+
+        # Installed apps. Only the index is brought up to date here, each app is loaded by its first request.
+        with startup_profiler.stage('apps'):
+            from source.apps import AppRegistry, AppDispatcher
+
+            services.app_registry = AppRegistry(idle_timeout=settings_manager.apps_idle_timeout, on_unload=services.release_app)
+            services.app_registry.refresh()
+            server.wsgi_app = AppDispatcher(server.wsgi_app, services.app_registry, lambda app_id, directory: create_child_app(server, app_id, directory))
+
+        # Database session teardown
+        server.teardown_appcontext(services.remove_sessions)
+
+    return server
+
+def create_child_app(server: Flask, app_id: str, directory: str) -> Flask:
+    """ Builds the `Flask` instance serving an installed app, which shares the configuration, services, login manager & template globals of the main app. Called by the app registry when the
+    app is loaded, see `/source/apps.py`.
+
+    Params:
+        - server (Flask) - The main app.
+        - app_id (str) - The id of the installed app.
+        - directory (str) - The absolute path of the installed apps directory. """
+
+    from jinja2 import ChoiceLoader
+
+    child = Flask(f'xenon_apps.{app_id}', root_path=directory, template_folder='templates', static_url_path=f'/apps/{app_id}/static')
+    child.config.update(server.config)
+
+    # Shares the services & authentication of the main app.
+    services = server.extensions['xenon']
+    child.extensions['xenon'] = services
+    server.login_manager.init_app(child)
+    metrics.init_app(child)
+    child.teardown_appcontext(services.remove_sessions)
+
+    # Templates are looked up in the apps `templates` directory first, then in the main apps, so apps can extend its layouts.
+    child.jinja_env.globals.update({name: value for name, value in server.jinja_env.globals.items() if name not in child.jinja_env.globals})
+    child.jinja_env.loader = ChoiceLoader([child.jinja_env.loader, server.jinja_env.loader])
+    child.jinja_env.bytecode_cache = server.jinja_env.bytecode_cache
+
+    return child
+
+def get_services() -> Services:
+    """ Returns the `Services` of the app handling the current request. """
+
+    return current_app.extensions['xenon']
+
+def get_databases_manager() -> object:
+    """ Returns the `DatabasesManager` of the app handling the current request, creating it if this is its first use. """
+
+    return get_services().databases_manager
 
-# Variables
-server = Flask(__name__)
-settings_manager = SettingsManager()
-databases_manager = DatabasesManager()
-login_manager = LoginManager()
+# The default app, created on first access to one of the compatibility names below.
+_default_app = None
+_default_app_lock = threading.Lock()
 
-# Server configuration
-server.template_folder = Paths.TEMPLATES_ABS_PATH
-server.static_folder = Paths.STATIC_ABS_PATH
+def _get_default_app() -> Flask:
+    global _default_app
 
-# Initialization
-login_manager.init_app(server)
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
 
-# Blueprint registration
-server.register_blueprint(base_r)
+def __getattr__(name: str) -> object:
+    # Keeps `from source.server import server, settings_manager, databases_manager` working without doing any set up at import time.
+    if name == 'server':
+        return _get_default_app()
+    if name == 'settings_manager':
+        return _get_default_app().extensions['xenon'].settings_manager
+    if name == 'databases_manager':
+        return _get_default_app().extensions['xenon'].databases_manager
 
-# Login user callback
-@login_manager.user_loader
-def load_user(user_id):
-    return databases_manager.session.query(Users).filter_by(id=user_id).first()
\ No newline at end of file
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
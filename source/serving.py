@@ -0,0 +1,379 @@
+""" The production server. A master process binds the listening socket, builds the app once & then forks a number of worker processes, which all accept connections from the shared socket.
+Each worker serves requests on a bounded pool of threads, keeps HTTP/1.1 connections alive between requests & sends files with `sendfile`. Selected with `mode = production` in the `SERVER` section of the
+`/instance/system.ini` file.
+
+The master & each worker watch the settings file. Workers apply most settings as they change, so the master only restarts the workers gracefully when a `SERVER` setting they were started
+with changes or it receives `SIGHUP`: new workers are started first, then the old ones finish their in-flight requests & exit. Each worker runs the automation scheduler of
+`/source/scheduler.py`. `SIGTERM` or `SIGINT` stops the server gracefully. Requires a platform with `os.fork`. """
+
+# Import internal packages
+from source.paths import flush_json_writes
+from source.scheduler import scheduler
+
+# Import external packages
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Import standard packages
+import concurrent.futures
+import io
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+# Variables
+RESPAWN_DELAY = 1.0 # Seconds to wait before replacing a worker which exited unexpectedly.
+
+# The settings a worker is started with, so changing them restarts the workers. Changing `server_mode` or `server_debug` needs the whole server to be restarted.
+RESTART_SETTINGS = ('server_host', 'server_port', 'server_workers', 'server_threads', 'server_keepalive', 'server_graceful_timeout')
+
+logger = logging.getLogger(__name__)
+
+class SendfileWrapper():
+    """ The `wsgi.file_wrapper` of the production server. Once werkzeug has sent the headers, the file is copied to the socket by the kernel with `sendfile`, rather than read into python &
+    written back out. Falls back to reading blocks when the response has no `Content-Length`, as werkzeug then uses chunked encoding.
+
+    Params:
+        - handler (KeepAliveRequestHandler) - The handler of the connection the file is sent on.
+        - file (object) - The file to send, opened in binary mode.
+        - block_size (int) - The number of bytes read at a time by the fallback. """
+
+    def __init__(self, handler: 'KeepAliveRequestHandler', file: object, block_size: int = 8192) -> None:
+        self.handler = handler
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self) -> object:
+        # Yields nothing first, which makes werkzeug send the headers.
+        yield b''
+
+        length = self.handler.response_length
+        if length is not None and hasattr(self.file, 'fileno'):
+            self.handler.request.sendfile(self.file, offset=self.file.tell(), count=length)
+            return
+
+        while data := self.file.read(self.block_size):
+            yield data
+
+    def close(self) -> None:
+        self.file.close()
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """ Handles the requests of one connection, keeping it open between requests. Idle connections are closed after the servers keep-alive timeout, & every connection is closed after its
+    current request once the worker starts shutting down.
+
+    Werkzeug's handler closes the connection after every response & then discards anything left to read on the socket, which would swallow the next request on a kept alive connection. Requests
+    without a body have nothing to discard, so the handler skips that step for them & keeps the connection open. Requests with a body are answered on a closing connection as before. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        # The socket timeout closes connections which stay idle for longer than the keep-alive timeout.
+        self.timeout = self.server.keepalive
+        self.keep_alive = False
+        self.response_length = None
+        super().setup()
+
+        # Werkzeug writes the headers & the body separately. Without this, the body of a response on a kept alive connection waits for the clients delayed acknowledgement.
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def run_wsgi(self) -> None:
+        # Decides whether the connection stays open after this request.
+        has_body = self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers
+        self.keep_alive = not (self.close_connection or has_body or self.server.stopping.is_set())
+        self.response_length = None
+
+        connection, rfile = self.connection, self.rfile
+        try:
+            super().run_wsgi()
+        finally:
+            self.connection, self.rfile = connection, rfile
+
+        if not self.keep_alive:
+            self.close_connection = True
+
+    def make_environ(self) -> dict:
+        environ = super().make_environ()
+        environ['wsgi.file_wrapper'] = lambda file, block_size=8192: SendfileWrapper(self, file, block_size)
+
+        # The environment keeps the real socket & stream. The handlers own are replaced by an empty stream at its end, so the discarding step after the response finds nothing to read.
+        if self.keep_alive:
+            self.connection, self.rfile = self.server.eof_socket, io.BytesIO()
+
+        return environ
+
+    def send_header(self, keyword: str, value: str) -> None:
+        # Werkzeug always asks for the connection to be closed.
+        if keyword.lower() == 'connection' and self.keep_alive:
+            value = 'keep-alive'
+
+        # Records the length of the response for `SendfileWrapper`.
+        if keyword.lower() == 'content-length':
+            self.response_length = int(value)
+
+        super().send_header(keyword, value)
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """ A WSGI server which serves each connection on a bounded pool of threads. When every thread is busy, the server stops accepting connections, leaving them to the other workers.
+
+    Params:
+        - host (str) - The host the socket is bound to.
+        - port (int) - The port the socket is bound to.
+        - app (object) - The WSGI application.
+        - fd (int) - The file descriptor of the listening socket, shared with the other workers.
+        - threads (int) - The number of connections served at once.
+        - keepalive (float) - The number of seconds an idle connection is kept open. """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host: str, port: int, app: object, fd: int, threads: int, keepalive: float) -> None:
+        self.keepalive = keepalive
+        self.stopping = threading.Event()
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+        # A socket which is always readable & at its end, used by `KeepAliveRequestHandler` in place of the connection after each request.
+        self.eof_socket, peer = socket.socketpair()
+        peer.close()
+
+        # The socket is already bound, so werkzeug uses it rather than binding a new one.
+        super().__init__(host, port, app, handler=KeepAliveRequestHandler, fd=fd)
+
+    def process_request(self, request: socket.socket, client_address: tuple) -> None:
+        # Waits for a free thread before handing over the connection, so no more connections are accepted than can be served.
+        self._slots.acquire()
+        self._executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request: socket.socket, client_address: tuple) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def stop(self, timeout: float) -> None:
+        """ Stops accepting connections & waits up to `timeout` seconds for the in-flight requests to finish. Must not be called from the thread running `serve_forever()`.
+
+        Params:
+            - timeout (float) - The number of seconds to wait for in-flight requests. """
+
+        self.stopping.set()
+        self.shutdown()
+
+        # Waits for the request threads. Connections idling in keep-alive close at their next request or after the keep-alive timeout.
+        waiter = threading.Thread(target=self._executor.shutdown, kwargs={'wait': True}, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+
+class PreforkServer():
+    """ The master process of the production server. See the module for details. Example:
+    ```python
+    from source.serving import PreforkServer
+    from source.server import create_app
+
+    PreforkServer(create_app()).run()
+    ```
+
+    Params:
+        - app (Flask) - The app to serve. It is built once in the master & inherited by every worker. Its settings manager provides the host, port & worker settings. """
+
+    def __init__(self, app: object) -> None:
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('The production server requires a platform with \'os.fork\'.')
+
+        self.app = app
+        self.services = app.extensions['xenon']
+        self.settings_manager = self.services.settings_manager
+
+        # The worker process ids, & the ids of the workers which are being replaced.
+        self.workers = set()
+        self.retiring = set()
+
+        self._socket = None
+        self._address = None
+        self._stopping = False
+        self._reload_requested = False
+        self._wakeup = threading.Event()
+        self._master_pid = os.getpid()
+
+    def _bind(self) -> None:
+        """ Binds the listening socket to the configured host & port, replacing the current socket if the address changed. """
+
+        settings = self.settings_manager.settings
+        address = (settings.server_host, settings.server_port)
+        if address == self._address:
+            return
+
+        # Binds the new socket before closing the old one, so a failure leaves the server running.
+        new_socket = socket.create_server(address, family=socket.AF_INET6 if ':' in settings.server_host else socket.AF_INET, backlog=1024)
+        new_socket.set_inheritable(True)
+
+        if self._socket is not None:
+            self._socket.close()
+
+        self._socket, self._address = new_socket, address
+        logger.info('Listening on http://%s:%d', *address)
+
+    def _spawn_worker(self) -> None:
+        """ Forks a worker process which serves the app until it is told to stop. """
+
+        settings = self.settings_manager.settings
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+
+        # In the worker. The exit status is 0 unless serving failed.
+        status = 0
+        try:
+            self._run_worker(settings)
+        except BaseException:
+            logger.exception('Worker %d failed.', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _run_worker(self, settings: object) -> None:
+        """ Serves requests in a worker process until `SIGTERM` or `SIGINT` is received.
+
+        Params:
+            - settings (Settings) - The settings snapshot the worker was started with. """
+
+        # Resets the state inherited from the master & watches the settings file, so the other settings are applied without a restart.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.settings_manager.reset_after_fork()
+        self.settings_manager.start_watching()
+        self.services.reset_after_fork()
+        scheduler.start(self.app)
+
+        server = ThreadPoolWSGIServer(*self._address, self.app, self._socket.fileno(), settings.server_threads, settings.server_keepalive)
+
+        # Stops gracefully on a signal. `shutdown()` blocks until `serve_forever()` returns, so it is called from another thread.
+        def stop(signal_number: int, frame: object) -> None:
+            threading.Thread(target=server.stop, args=(settings.server_graceful_timeout,), daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        server.serve_forever(poll_interval=0.5)
+        server.stop(settings.server_graceful_timeout)
+        scheduler.stop(settings.server_graceful_timeout)
+        self.settings_manager.stop_watching()
+
+        # Writes the delayed JSON writes, as the worker exits with `os._exit()`, which skips the `atexit` handlers.
+        flush_json_writes()
+
+    def _signal(self, pids: set, signal_number: int) -> None:
+        """ Sends a signal to processes which may already have exited. """
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal_number)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self) -> None:
+        """ Collects the workers which have exited, replacing those which exited unexpectedly. """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+
+            self.workers.discard(pid)
+            if not self._stopping:
+                logger.warning('Worker %d exited with status %d, replacing it.', pid, os.waitstatus_to_exitcode(status))
+                time.sleep(RESPAWN_DELAY)
+                self._spawn_worker()
+
+    def reload(self) -> None:
+        """ Restarts the workers gracefully with the current settings. New workers are started before the old ones are stopped, so requests keep being served. """
+
+        self._bind()
+
+        old_workers = self.workers
+        self.workers = set()
+        self.retiring |= old_workers
+
+        for _ in range(self.settings_manager.settings.server_workers):
+            self._spawn_worker()
+
+        self._signal(old_workers, signal.SIGTERM)
+
+    def _settings_changed(self, old_settings: object, settings: object) -> None:
+        """ Restarts the workers if a setting they were started with changed. Registered as a `SettingsManager` listener in the master, & ignored in the workers which inherit it.
+
+        Params:
+            - old_settings (Settings) - The previous settings snapshot.
+            - settings (Settings) - The new settings snapshot. """
+
+        if os.getpid() != self._master_pid:
+            return
+
+        if any(getattr(old_settings, name) != getattr(settings, name) for name in RESTART_SETTINGS):
+            self._request_reload()
+        elif (old_settings.server_mode, old_settings.server_debug) != (settings.server_mode, settings.server_debug):
+            logger.warning('The server mode & debug settings only take effect when the server is restarted.')
+
+    def _request_reload(self, *args: object) -> None:
+        # Called by the settings listener & the `SIGHUP` handler. The reload itself runs on the main thread.
+        self._reload_requested = True
+        self._wakeup.set()
+
+    def _request_stop(self, *args: object) -> None:
+        self._stopping = True
+        self._wakeup.set()
+
+    def run(self) -> None:
+        """ Starts the workers & supervises them until the server is stopped. """
+
+        # Binds the socket & starts the workers.
+        self._bind()
+        for _ in range(self.settings_manager.settings.server_workers):
+            self._spawn_worker()
+
+        # Restarts the workers when the settings they were started with change or `SIGHUP` is received, & stops on `SIGTERM` or `SIGINT`. The settings file is only watched once the first
+        # workers are forked, & each worker forgets the masters watcher & starts its own.
+        self.settings_manager.add_listener(self._settings_changed)
+        self.settings_manager.start_watching()
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        # Supervises the workers.
+        while not self._stopping:
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+
+            if self._reload_requested and not self._stopping:
+                self._reload_requested = False
+                logger.info('Reloading the workers.')
+                self.reload()
+
+            self._reap()
+
+        # Stops the workers gracefully & waits for them to exit.
+        self._signal(self.workers | self.retiring, signal.SIGTERM)
+        for pid in self.workers | self.retiring:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+        self._socket.close()
+        self.settings_manager.stop_watching()
+        self.settings_manager.remove_listener(self._settings_changed)